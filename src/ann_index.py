@@ -0,0 +1,256 @@
+"""Approximate nearest neighbour search over the film embeddings, without an N x N similarity matrix.
+
+An inverted file (IVF) index clusters the L2 normalised film vectors around num_lists centroids with spherical
+k-means. A query is compared to the centroids and only the films in the num_probes closest lists are scored exactly,
+so a search costs O(num_lists + N * num_probes / num_lists) dot products rather than O(N). Raising num_probes trades
+speed for recall, and probing every list gives the exact result.
+
+Films can be added, updated and removed without rebuilding the index, which assigns them to their closest centroid.
+Vectors may be dense arrays, e.g. the collaborative SVD embeddings, or sparse matrices, e.g. TF-IDF features.
+"""
+
+import os
+import sys
+from typing import Iterable, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix, issparse, vstack
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.utils.extmath import safe_sparse_dot
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from utils import get_liked_ids
+import config
+
+Vectors = Union[np.ndarray, csr_matrix]
+
+
+def _stack(top: Vectors, bottom: Vectors) -> Vectors:
+    return vstack([top, bottom]).tocsr() if issparse(top) else np.vstack([top, bottom])
+
+
+def _to_dense(vectors: Vectors) -> np.ndarray:
+    return vectors.toarray() if issparse(vectors) else np.array(vectors)
+
+
+def _to_float32(vectors: Vectors) -> Vectors:
+    return (
+        csr_matrix(vectors, dtype="float32")
+        if issparse(vectors)
+        else np.asarray(vectors, "float32")
+    )
+
+
+def get_closest_lists(vectors: Vectors, centroids: np.ndarray) -> np.ndarray:
+    """Closest centroid of each L2 normalised vector."""
+    return np.asarray(safe_sparse_dot(vectors, centroids.T, dense_output=True)).argmax(axis=1)
+
+
+class IVFIndex:
+    """Inverted file index of L2 normalised film vectors, searched by cosine similarity.
+
+    Args:
+        centroids (np.ndarray): num_lists x dimensions unit vectors of the lists.
+        vectors (Vectors): L2 normalised vector of each film.
+        ids (Iterable[int]): Film id of each row of vectors.
+        assignments (np.ndarray): List of each film.
+    """
+
+    def __init__(
+        self, centroids: np.ndarray, vectors: Vectors, ids: Iterable[int], assignments: np.ndarray
+    ):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = pd.Index(np.asarray(ids, dtype="int64"), name="id")
+        self.assignments = assignments
+        self._index_lists()
+
+    def _index_lists(self):
+        # Films ordered by list, with the films of list i at positions[offsets[i]:offsets[i + 1]].
+        self.positions = np.argsort(self.assignments, kind="stable")
+        self.offsets = np.searchsorted(
+            self.assignments[self.positions], np.arange(len(self.centroids) + 1)
+        )
+
+    def add(self, vectors: Vectors, ids: Iterable[int]):
+        """Adds films to the index, replacing the vectors of films already in it."""
+        ids = np.asarray(ids, dtype="int64")
+        vectors = normalize(_to_float32(vectors))
+        keep = ~self.ids.isin(ids)
+        self.vectors = _stack(self.vectors[keep], vectors)
+        self.ids = pd.Index(np.concatenate([self.ids.values[keep], ids]), name="id")
+        self.assignments = np.concatenate(
+            [self.assignments[keep], get_closest_lists(vectors, self.centroids)]
+        )
+        self._index_lists()
+
+    def remove(self, ids: Iterable[int]):
+        """Removes films from the index."""
+        keep = ~self.ids.isin(np.asarray(ids, dtype="int64"))
+        self.vectors = self.vectors[keep]
+        self.ids = self.ids[keep]
+        self.assignments = self.assignments[keep]
+        self._index_lists()
+
+    def get_vectors(self, ids: Iterable[int]) -> Vectors:
+        positions = self.ids.get_indexer(np.asarray(ids, dtype="int64"))
+        if (positions < 0).any():
+            raise KeyError(f"Films {np.asarray(ids)[positions < 0]} are missing from the index")
+        return self.vectors[positions]
+
+    def search(
+        self,
+        query: Vectors,
+        top_n: int,
+        num_probes: int = config.ANN_NUM_PROBES,
+        exclude_ids: Iterable[int] = (),
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the films most similar to a query among those in its closest lists.
+
+        Args:
+            query (Vectors): 1 x dimensions query vector, need not be normalised.
+            top_n (int): Number of films to return.
+            num_probes (int): Number of lists to search.
+            exclude_ids (Iterable[int]): Ids of films to leave out, e.g. those the query was made from.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Ids of the most similar films, most similar first, and their cosine
+                similarity to the query.
+        """
+        query = normalize(_to_float32(query).reshape(1, -1))
+        list_scores = np.asarray(safe_sparse_dot(query, self.centroids.T, dense_output=True))[0]
+        num_probes = min(num_probes, len(self.centroids))
+        probes = np.argpartition(-list_scores, num_probes - 1)[:num_probes]
+        candidates = np.concatenate(
+            [self.positions[self.offsets[probe] : self.offsets[probe + 1]] for probe in probes]
+        )
+        candidates = np.sort(candidates[~np.isin(self.ids.values[candidates], exclude_ids)])
+        scores = np.asarray(
+            safe_sparse_dot(self.vectors[candidates], query.T, dense_output=True)
+        ).ravel()
+        top_n = min(top_n, len(candidates))
+        if top_n <= 0:
+            return np.array([], dtype="int64"), np.array([], dtype="float32")
+        top = np.argpartition(-scores, top_n - 1)[:top_n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return self.ids.values[candidates[top]], scores[top]
+
+
+def build_ivf_index(
+    vectors: Vectors,
+    ids: Iterable[int],
+    num_lists: int = config.ANN_NUM_LISTS,
+    num_iterations: int = config.ANN_KMEANS_ITERATIONS,
+    seed: int = 0,
+) -> IVFIndex:
+    """Clusters the films' vectors with spherical k-means and indexes each film under its closest centroid.
+
+    Args:
+        vectors (Vectors): Vector of each film, dense or sparse.
+        ids (Iterable[int]): Film id of each row of vectors.
+        num_lists (int): Number of lists, at most the number of films.
+        num_iterations (int): Number of k-means iterations.
+        seed (int): Seed of the initial centroids, chosen among the films.
+
+    Returns:
+        IVFIndex: Index of the films.
+    """
+    vectors = normalize(_to_float32(vectors))
+    rng = np.random.default_rng(seed)
+    num_lists = min(num_lists, vectors.shape[0])
+    centroids = _to_dense(vectors[rng.choice(vectors.shape[0], num_lists, replace=False)])
+    for _ in range(num_iterations):
+        assignments = get_closest_lists(vectors, centroids)
+        members = csr_matrix(
+            (
+                np.ones(len(assignments), dtype="float32"),
+                (assignments, np.arange(len(assignments))),
+            ),
+            shape=(num_lists, vectors.shape[0]),
+        )
+        totals = _to_dense(members @ vectors)
+        # Lists left empty restart from a random film.
+        empty = np.flatnonzero(~totals.any(axis=1))
+        if len(empty):
+            totals[empty] = _to_dense(vectors[rng.choice(vectors.shape[0], len(empty))])
+        centroids = normalize(totals)
+    return IVFIndex(centroids, vectors, ids, get_closest_lists(vectors, centroids))
+
+
+def get_ann_path(name: str, path: str = config.BASE_ANN_PATH) -> str:
+    """File path of the index of a source."""
+    return os.path.join(path, f"{name}_ivf_index.npz")
+
+
+def save_ivf_index(name: str, index: IVFIndex, path: str = config.BASE_ANN_PATH):
+    """Saves an index, e.g. under its similarity source name, as one .npz holding every array.
+
+    The file is written under a temporary name and then replaces the previous index, so a crash or a concurrent
+    load_ivf_index never sees centroids, assignments, ids and vectors from different versions.
+    """
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        "centroids": index.centroids,
+        "assignments": index.assignments,
+        "ids": index.ids.values,
+    }
+    if issparse(index.vectors):
+        arrays.update(
+            vectors_data=index.vectors.data,
+            vectors_indices=index.vectors.indices,
+            vectors_indptr=index.vectors.indptr,
+            vectors_shape=np.array(index.vectors.shape),
+        )
+    else:
+        arrays["vectors"] = index.vectors
+    index_path = get_ann_path(name, path)
+    with open(index_path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def load_ivf_index(name: str, path: str = config.BASE_ANN_PATH) -> IVFIndex:
+    """Loads an index saved by save_ivf_index."""
+    with np.load(get_ann_path(name, path), allow_pickle=False) as arrays:
+        if "vectors" in arrays:
+            vectors = arrays["vectors"]
+        else:
+            vectors = csr_matrix(
+                (arrays["vectors_data"], arrays["vectors_indices"], arrays["vectors_indptr"]),
+                shape=tuple(arrays["vectors_shape"]),
+            )
+        return IVFIndex(arrays["centroids"], vectors, arrays["ids"], arrays["assignments"])
+
+
+def get_text_query(vectorizer: Union[CountVectorizer, TfidfVectorizer], text: str) -> csr_matrix:
+    """Vectorizes free text, e.g. an overview, with a source's fitted vocabulary to search its index."""
+    return vectorizer.transform([text.lower()]).astype("float32")
+
+
+def get_ann_recommendations(
+    films: pd.DataFrame,
+    titles: list,
+    index: IVFIndex,
+    top_n: int,
+    num_probes: Optional[int] = config.ANN_NUM_PROBES,
+    film_ids: Optional[list] = None,
+):
+    """Recommends the films closest to the centroid of the liked films' vectors in one source.
+
+    Args:
+        films (pd.DataFrame): Films dataframe.
+        titles (list): Titles of the films the user likes.
+        index (IVFIndex): Index of one similarity source.
+        top_n (int): Number of recommendations to return.
+        num_probes (Optional[int]): Number of lists to search.
+        film_ids (Optional[list]): Ids of the films the user likes, used instead of titles, see get_liked_ids.
+
+    Returns:
+        list: Ids of the recommended films, most similar first.
+    """
+    film_indices = get_liked_ids(films, titles, film_ids)
+    query = np.asarray(index.get_vectors(film_indices).mean(axis=0))
+    ids, _ = index.search(query, top_n, num_probes=num_probes, exclude_ids=film_indices)
+    return ids.tolist()
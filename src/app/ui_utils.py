@@ -1,15 +1,26 @@
 import sys
 import os
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from profiling import RerunProfile, profiled
+from thumbnail_store import get_thumbnail
+from title_index import TitleIndex, get_labels, search_titles
 import config
 
 
-def display_film_posters(streamlit, data: pd.DataFrame, num_rows: int, posters_per_row: int):
+@profiled
+def display_film_posters(
+    streamlit,
+    data: pd.DataFrame,
+    num_rows: int,
+    posters_per_row: int,
+    thumbnails: Tuple[Dict[str, Tuple[int, int]], Optional[np.memmap]] = ({}, None),
+):
     """Populates main page with film posters and expandable titles below showing the tile, directors, release date,
     cast, keywords and rating.
 
@@ -18,6 +29,8 @@ def display_film_posters(streamlit, data: pd.DataFrame, num_rows: int, posters_p
         data (pd.DataFrame): Films dataframe.
         num_rows (int): Number of rows of posters to layout.
         posters_per_row (int): Number of columns of posters to layout per row.
+        thumbnails (Tuple[Dict[str, Tuple[int, int]], Optional[np.memmap]]): Thumbnail cache, see
+            load_thumbnail_cache.
     """
     posters = data.poster_path.head(n=num_rows * posters_per_row).to_list()
     titles = data.title.head(n=num_rows * posters_per_row).to_list()
@@ -27,7 +40,13 @@ def display_film_posters(streamlit, data: pd.DataFrame, num_rows: int, posters_p
     keywords = data.keywords.head(n=num_rows * posters_per_row).to_list()
     rating = data.vote_average.head(n=num_rows * posters_per_row).to_list()
 
-    posters = [config.POSTER_BASE_URL + poster for poster in posters]
+    # Cached thumbnails are served from memory, other posters are loaded from TMDB at their original size.
+    thumbnail_locations, thumbnail_pack = thumbnails
+    posters = [
+        get_thumbnail(poster, thumbnail_locations, thumbnail_pack)
+        or config.POSTER_BASE_URL + poster
+        for poster in posters
+    ]
 
     for row in range(num_rows):
         cols = streamlit.columns(posters_per_row)
@@ -43,10 +62,8 @@ def display_film_posters(streamlit, data: pd.DataFrame, num_rows: int, posters_p
                 col.image(posters[index], use_column_width=True)
                 with col.expander(f"{titles[index]}: {rating[index]}"):
                     streamlit.markdown(f"**Director:** {directors[index]}")
-                    cast_string = cast[index].replace("[", "").replace("]", "").replace("'", "")
-                    keywords_string = (
-                        keywords[index].replace("[", "").replace("]", "").replace("'", "")
-                    )
+                    cast_string = ", ".join(cast[index])
+                    keywords_string = ", ".join(keywords[index])
                     streamlit.write(f"**Cast:** {cast_string}")
                     streamlit.write(f"**Date:** {release_date[index]}")
                     streamlit.write(f"**Keywords:** {keywords_string}")
@@ -68,6 +85,31 @@ def display_text(streamlit, text_list: List[str]):
     return streamlit
 
 
+def display_film_search(streamlit, title_index: TitleIndex) -> List[int]:
+    """Displays a search box and a multiselect of the films matching it, keeping the films liked so far selected.
+
+    Only the liked films and the suggestions for the current search are sent to the browser, rather than every title.
+
+    Args:
+        streamlit: Streamlit package for modifying layout.
+        title_index (TitleIndex): Index of the catalogue's titles.
+
+    Returns:
+        List[int]: Ids of the liked films.
+    """
+    if "liked_ids" not in streamlit.session_state:
+        streamlit.session_state.liked_ids = []
+    query = streamlit.sidebar.text_input("Search for films")
+    suggestions = search_titles(title_index, query).tolist()
+    liked_ids = streamlit.session_state.liked_ids
+    options = liked_ids + [idx for idx in suggestions if idx not in liked_ids]
+    labels = dict(zip(options, get_labels(title_index, options)))
+    # A fixed key keeps the widget, and its selection in session_state, the same as its options change.
+    return streamlit.sidebar.multiselect(
+        "", options=options, format_func=labels.get, key="liked_ids"
+    )
+
+
 def display_parameter_controls(
     streamlit, min_value: float, max_value: float, default_value: float
 ) -> Tuple[st.sidebar.slider, ...]:
@@ -100,3 +142,19 @@ def display_parameter_controls(
         value=default_value * 2,
     )
     return cast, director, keywords, overview, user
+
+
+def display_rerun_profile(streamlit, profile: RerunProfile):
+    """Shows the stage timings and allocations of a finished rerun in a sidebar expander.
+
+    Args:
+        streamlit: Streamlit package for modifying layout.
+        profile (RerunProfile): Profile from finish_rerun_profile.
+    """
+    with streamlit.sidebar.expander("Debug: rerun stages"):
+        streamlit.write(
+            f"Rerun took {profile.seconds * 1000:.0f} ms, peak RSS {profile.peak_rss_mb:.0f} MB"
+        )
+        stages = pd.DataFrame(profile.stages, columns=["stage", "seconds", "allocated_mb"])
+        stages["ms"] = stages.pop("seconds") * 1000
+        streamlit.table(stages.round(2))
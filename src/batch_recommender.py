@@ -0,0 +1,261 @@
+"""Scores the liked films of many users at once and streams their recommendations to a csv.
+
+Usage:
+    python src/batch_recommender.py liked_films.csv recommendations.csv --top-n 20 --weights 0.5 0.5 0.5 0.5 1
+
+Each batch of users becomes a sparse user x film indicator matrix, so one matrix product per similarity source scores
+the whole batch, reading only the liked films' rows. Batches are scored across a process pool and written out in input
+order as they finish, so memory use depends on the batch size rather than the number of users.
+"""
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.utils.extmath import safe_sparse_dot
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from profiling import log_stage
+from similarity_store import PackedSimilarityMatrix, uses_neighbour_graphs
+from utils import load_neighbour_graphs, load_similarity_matrices
+import config
+
+# Set once per worker process by _init_worker so the similarity sources are not sent with every batch.
+_sources = None
+
+
+def read_liked_films(
+    path: str, chunksize: int = config.RATINGS_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """Reads a csv of user_id and film_id columns in chunks, each holding every liked film of its users.
+
+    The rows of a user must be contiguous, as they are when the file is sorted by user_id.
+    """
+    remainder = None
+    for chunk in pd.read_csv(
+        path, usecols=["user_id", "film_id"], dtype="int64", chunksize=chunksize
+    ):
+        if remainder is not None:
+            chunk = pd.concat([remainder, chunk], ignore_index=True)
+        # The last user may continue into the next chunk.
+        is_last_user = chunk["user_id"].values == chunk["user_id"].values[-1]
+        remainder = chunk[is_last_user]
+        if not is_last_user.all():
+            yield chunk[~is_last_user]
+    if remainder is not None and len(remainder):
+        yield remainder
+
+
+def get_indicator_matrix(liked: pd.DataFrame, ids: pd.Index) -> Tuple[np.ndarray, csr_matrix]:
+    """Turns user_id and film_id rows into a user x film matrix with a 1 for each liked film.
+
+    Films missing from ids are dropped, as are users left without any liked films.
+
+    Returns:
+        Tuple[np.ndarray, csr_matrix]: User id of each row and the float32 indicator matrix.
+    """
+    positions = ids.get_indexer(liked["film_id"].values)
+    is_known = positions >= 0
+    user_ids, user_positions = np.unique(liked["user_id"].values[is_known], return_inverse=True)
+    indicator = csr_matrix(
+        (np.ones(is_known.sum(), dtype="float32"), (user_positions, positions[is_known])),
+        shape=(len(user_ids), len(ids)),
+    )
+    # Liking a film twice counts once.
+    indicator.sum_duplicates()
+    indicator.data[:] = 1
+    return user_ids, indicator
+
+
+def score_users(
+    indicator: csr_matrix, sources: list, weights: List[float], top_n: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds each user's top_n films by their weighted mean similarity to the user's liked films.
+
+    Gives the same scores as get_weighted_recommendations, or get_neighbour_recommendations for neighbour graphs.
+
+    Args:
+        indicator (csr_matrix): Users x films matrix with a 1 for each liked film.
+        sources (list): Dense or packed similarity matrices or sparse neighbour graphs, films x films.
+        weights (List[float]): Weighting of each source.
+        top_n (int): Number of films to recommend per user.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Users x top_n positions of the recommended films, most similar first, and
+            their scores. Users with fewer than top_n films left to recommend are padded with -inf scores.
+    """
+    scores = np.zeros(indicator.shape, dtype="float32")
+    liked = np.unique(indicator.indices)
+    for source, weight in zip(sources, weights):
+        if weight:
+            scores += weight * get_source_scores(indicator, source, liked)
+    counts = np.asarray(indicator.sum(axis=1), dtype="float32")
+    scores /= sum(weights) * np.maximum(counts, 1)
+    return get_top_films(scores, indicator, top_n)
+
+
+def get_source_scores(indicator: csr_matrix, source, liked: np.ndarray) -> np.ndarray:
+    """Sums each user's liked films' similarity to every film in one source, as a float32 users x films array.
+
+    Packed matrices are read through the rows of the films liked by anyone in the batch, given by liked.
+    """
+    if isinstance(source, PackedSimilarityMatrix):
+        product = safe_sparse_dot(indicator[:, liked], source.get_rows(liked))
+    else:
+        product = safe_sparse_dot(indicator, source, dense_output=True)
+    return np.asarray(product, dtype="float32")
+
+
+def get_top_films(
+    scores: np.ndarray, indicator: csr_matrix, top_n: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds each user's top_n films by score, leaving out the films they like. Overwrites their scores."""
+    scores[indicator.nonzero()] = -np.inf
+    top_n = min(top_n, indicator.shape[1])
+    top = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def load_sources(similarity_path: str) -> Tuple[list, pd.Index]:
+    if not uses_neighbour_graphs(similarity_path):
+        similarity_matrices = load_similarity_matrices(similarity_path)
+        ids = similarity_matrices[0].index
+        sources = [
+            similarity if isinstance(similarity, PackedSimilarityMatrix) else similarity.values
+            for similarity in similarity_matrices
+        ]
+        return sources, ids
+    return load_neighbour_graphs(similarity_path)
+
+
+def _init_worker(similarity_path: str):
+    global _sources
+    # The sources are memory mapped, so every worker shares the same pages.
+    _sources = load_sources(similarity_path)[0]
+
+
+def _score_batch(
+    user_ids: np.ndarray, indicator: csr_matrix, weights: List[float], top_n: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return (user_ids,) + score_users(indicator, _sources, weights, top_n)
+
+
+def _get_batches(
+    input_path: str, ids: pd.Index, batch_size: int
+) -> Iterator[Tuple[np.ndarray, csr_matrix]]:
+    for liked in read_liked_films(input_path):
+        user_ids, indicator = get_indicator_matrix(liked, ids)
+        for start in range(0, len(user_ids), batch_size):
+            yield user_ids[start : start + batch_size], indicator[start : start + batch_size]
+
+
+def _write_batch(
+    f, ids: pd.Index, user_ids: np.ndarray, top: np.ndarray, scores: np.ndarray
+) -> int:
+    is_recommended = np.isfinite(scores)
+    pd.DataFrame(
+        {
+            "user_id": np.repeat(user_ids, is_recommended.sum(axis=1)),
+            "rank": np.nonzero(is_recommended)[1] + 1,
+            "film_id": ids.values[top[is_recommended]],
+            "score": scores[is_recommended].round(6),
+        }
+    ).to_csv(f, header=f.tell() == 0, index=False)
+    return len(user_ids)
+
+
+def recommend_batch(
+    input_path: str,
+    output_path: str,
+    weights: List[float],
+    top_n: int,
+    batch_size: int = config.BATCH_RECOMMENDATION_USERS,
+    n_jobs: Optional[int] = config.BATCH_RECOMMENDATION_N_JOBS,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+) -> int:
+    """Recommends films for every user in a csv of liked films and writes them to a csv.
+
+    Args:
+        input_path (str): Csv with user_id and film_id columns, each user's rows contiguous.
+        output_path (str): Csv to write with user_id, rank, film_id and score columns.
+        weights (List[float]): Weighting of the cast, director, keywords, overview and collaborative sources.
+        top_n (int): Number of films to recommend per user.
+        batch_size (int): Number of users scored per task.
+        n_jobs (Optional[int]): Number of worker processes, None uses every core and 1 runs in this process.
+        similarity_path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        int: Number of users given recommendations.
+    """
+    if len(weights) != len(config.SIMILARITY_SOURCES):
+        raise ValueError(f"Expected a weight for each of {config.SIMILARITY_SOURCES}")
+    if sum(weights) <= 0:
+        raise ValueError("Weights must add up to more than 0")
+    ids = load_sources(similarity_path)[1]
+    batches = _get_batches(input_path, ids, batch_size)
+    num_users = 0
+
+    with open(output_path, "w", newline="") as f:
+        if n_jobs == 1:
+            _init_worker(similarity_path)
+            for user_ids, indicator in batches:
+                num_users += _write_batch(
+                    f, ids, *_score_batch(user_ids, indicator, weights, top_n)
+                )
+            return num_users
+
+        max_workers = n_jobs or os.cpu_count()
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker, initargs=(similarity_path,)
+        ) as executor:
+            # Keep a couple of batches per worker in flight and write them out in input order.
+            in_flight = deque()
+            for user_ids, indicator in batches:
+                in_flight.append(executor.submit(_score_batch, user_ids, indicator, weights, top_n))
+                if len(in_flight) >= 2 * max_workers:
+                    num_users += _write_batch(f, ids, *in_flight.popleft().result())
+            while in_flight:
+                num_users += _write_batch(f, ids, *in_flight.popleft().result())
+    return num_users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("input_path", help="csv of user_id and film_id, sorted by user_id")
+    parser.add_argument("output_path", help="csv to write user_id, rank, film_id and score to")
+    parser.add_argument(
+        "--top-n", type=int, default=config.POSTERS_PER_ROW * config.NUM_POSTER_ROWS
+    )
+    parser.add_argument(
+        "--weights",
+        type=float,
+        nargs=len(config.SIMILARITY_SOURCES),
+        default=[config.PARAMETER_CONTROL_DEFAULT] * len(config.SIMILARITY_SOURCES),
+        help="weights of the " + ", ".join(config.SIMILARITY_SOURCES) + " similarity",
+    )
+    parser.add_argument("--batch-size", type=int, default=config.BATCH_RECOMMENDATION_USERS)
+    parser.add_argument("--n-jobs", type=int, default=config.BATCH_RECOMMENDATION_N_JOBS)
+    args = parser.parse_args()
+
+    with log_stage("Recommend"):
+        num_users = recommend_batch(
+            args.input_path,
+            args.output_path,
+            weights=args.weights,
+            top_n=args.top_n,
+            batch_size=args.batch_size,
+            n_jobs=args.n_jobs,
+        )
+    print(f"Wrote recommendations for {num_users} users to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
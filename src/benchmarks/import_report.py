@@ -0,0 +1,82 @@
+"""Measures the cold start of the serving code: how long its modules take to import and the memory they start with.
+
+Usage:
+    python src/benchmarks/import_report.py
+    python src/benchmarks/import_report.py --repeats 10
+
+Each statement runs in a new interpreter, as in a new container, and is timed by its median over the repeats. The
+resident memory is the peak of that interpreter once the statement has run, and includes the interpreter itself,
+which the first row measures alone. Packages only training and preprocessing need are listed when the statement
+imported them. Loading the models needs the trained artifacts in data/.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+
+SRC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+STATEMENTS = [
+    "pass",
+    "import config",
+    "import utils",
+    "import model_registry",
+    "import recommendation_cache",
+    "import service",
+    "import app.ui_utils",
+    "import service, model_registry; model_registry.get_models()",
+]
+TRAINING_PACKAGES = ["sklearn", "streamlit", "PIL", "requests", "tqdm"]
+# Run in the child interpreter, so it imports nothing before timing the statement.
+MEASURE = """
+import json, os, resource, sys, time
+sys.path.insert(0, {src_path!r})
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+if os.path.exists("/proc/self/status"):
+    # ru_maxrss on Linux keeps the peak of the process that forked this interpreter, VmHWM does not.
+    with open("/proc/self/status") as f:
+        peak_rss_mb = next(int(line.split()[1]) for line in f if line.startswith("VmHWM")) / 1e3
+else:
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+print(json.dumps({{
+    "seconds": seconds,
+    "peak_rss_mb": peak_rss_mb,
+    "training_packages": [name for name in {packages!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(statement: str, repeats: int) -> dict:
+    """Median time and peak resident memory of running a statement in new interpreters."""
+    code = MEASURE.format(src_path=SRC_PATH, statement=statement, packages=TRAINING_PACKAGES)
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "statement": statement,
+        "seconds": float(np.median([run["seconds"] for run in runs])),
+        "peak_rss_mb": float(np.median([run["peak_rss_mb"] for run in runs])),
+        "training_packages": " ".join(runs[0]["training_packages"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    results = pd.DataFrame([measure(statement, args.repeats) for statement in STATEMENTS])
+    print(results.round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Times each stage of training and serving on synthetic catalogues and compares them against a stored baseline.
+
+Usage:
+    python src/benchmarks/run_benchmarks.py                    # compare against benchmarks/baseline.json
+    python src/benchmarks/run_benchmarks.py --update-baseline  # record a new baseline
+    python src/benchmarks/run_benchmarks.py --sizes 3500
+
+Every stage is timed by its median over config.BENCHMARK_REPEATS runs (training stages run once), then run once more under tracemalloc to
+record the peak memory it allocates. Memory mapped artifacts are not allocations, so they are not counted. Dense
+similarity matrices are only built up to config.BENCHMARK_MAX_DENSE_FILMS, larger catalogues use top-k neighbour
+graphs. Training calls the training scripts' build functions with paths in a temporary directory, in this process so
+its allocations are measured.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from catalogue_store import save_catalogue
+from title_index import build_title_index, search_titles
+from training.train_collaborative import build_collaborative_similarity
+from training.train_content_similarity import CONTENT_SOURCES, build_content_similarity
+from utils import (
+    apply_filters,
+    build_filter_index,
+    generate_weighted_similarity_matrix,
+    get_filter_values,
+    get_neighbour_recommendations,
+    get_recommendations,
+    get_weighted_recommendations,
+    load_data,
+    load_neighbour_graphs,
+    load_similarity_matrices,
+)
+import config
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+NUM_QUERIES = 20
+WEIGHTS = [1, 1, 1, 1, 5]
+
+
+def make_catalogue(num_films: int, seed: int = 0) -> pd.DataFrame:
+    """Random films with the columns and roughly the value counts of the real catalogue."""
+    rng = np.random.default_rng(seed)
+    words = np.array([f"word{i}" for i in range(max(1000, num_films))])
+    people = np.array([f"Person {i}" for i in range(num_films)])
+    genres = np.array([f"Genre {i}" for i in range(20)])
+
+    def sample_lists(values, max_length):
+        return [
+            list(rng.choice(values, size=rng.integers(0, max_length + 1))) for _ in range(num_films)
+        ]
+
+    directors = rng.choice(people[: max(1, num_films // 3)], size=num_films).astype(object)
+    directors[rng.random(num_films) < 0.01] = np.nan
+    return pd.DataFrame(
+        {
+            "id": rng.permutation(num_films * 10)[:num_films] + 1,
+            "title": [f"Film {i}" for i in range(num_films)],
+            "poster_path": [f"/{i}.jpg" for i in range(num_films)],
+            "release_date": "2000-01-01",
+            "vote_average": rng.uniform(1, 10, num_films).round(1),
+            "vote_count": rng.integers(0, 5000, num_films).astype(float),
+            "overview": [" ".join(rng.choice(words, size=40)) for _ in range(num_films)],
+            "keywords": sample_lists(words, 10),
+            "cast": sample_lists(people, 3),
+            "director": directors,
+            "genres": sample_lists(genres, 3),
+            "imdb_score": rng.uniform(4, 9, num_films),
+        }
+    )
+
+
+def make_ratings(film_ids: np.ndarray, path: str, ratings_per_film: int = 50, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    num_ratings = len(film_ids) * ratings_per_film
+    pd.DataFrame(
+        {
+            "userId": rng.integers(0, num_ratings // 20, num_ratings),
+            "movieId": rng.choice(film_ids, size=num_ratings),
+            "rating": rng.integers(1, 11, num_ratings) / 2,
+        }
+    ).to_csv(path, index=False)
+
+
+def measure(stage: Callable[[], object], repeats: int) -> Dict[str, float]:
+    """Median wall time of stage over repeats runs and the peak memory it allocates in one more run."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        stage()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": float(np.median(timings)), "peak_mb": peak / 1e6}
+
+
+def get_stages(num_films: int, path: str) -> Dict[str, Callable[[], object]]:
+    """Stages to benchmark in order, each reading the artifacts written by the stages before it."""
+    top_k = None if num_films <= config.BENCHMARK_MAX_DENSE_FILMS else config.BENCHMARK_TOP_K
+    data_path = os.path.join(path, "films.npz")
+    ratings_path = os.path.join(path, "ratings.csv")
+    similarity_path = os.path.join(path, "similarity")
+    films = make_catalogue(num_films)
+    save_catalogue(films, path=data_path)
+    make_ratings(films.id.values, ratings_path)
+    rng = np.random.default_rng(0)
+    queries = [list(rng.choice(films.title, size=rng.integers(1, 6))) for _ in range(NUM_QUERIES)]
+    filters = [
+        ([films.cast[i][0]] if films.cast[i] else [], [], films.genres[i][:1])
+        for i in rng.integers(0, num_films, NUM_QUERIES)
+    ]
+    # Partly typed titles, every other one with its second and third characters swapped.
+    searches = [
+        title[: rng.integers(3, len(title) + 1)] for title in rng.choice(films.title, NUM_QUERIES)
+    ]
+    searches = [
+        search[0] + search[2] + search[1] + search[3:] if i % 2 else search
+        for i, search in enumerate(searches)
+    ]
+    loaded = {}
+
+    paths = {
+        "data_path": data_path,
+        "features_path": os.path.join(path, "features"),
+        "ann_path": os.path.join(path, "ann_indexes"),
+        "similarity_path": similarity_path,
+    }
+
+    def train_content_similarity():
+        for name, column, tfidf_vectorizer in CONTENT_SOURCES:
+            build_content_similarity(
+                name, column, tfidf_vectorizer, config.BENCHMARK_N_JOBS, top_k, **paths
+            )
+
+    def train_collaborative():
+        build_collaborative_similarity(
+            config.BENCHMARK_N_JOBS, top_k, ratings_path=ratings_path, **paths
+        )
+
+    def load_similarity():
+        if top_k is None:
+            loaded["similarity_matrices"] = list(load_similarity_matrices(similarity_path))
+        else:
+            loaded["neighbour_graphs"] = load_neighbour_graphs(similarity_path)
+
+    def recommend():
+        for titles in queries:
+            if top_k is None:
+                get_weighted_recommendations(
+                    films, titles, loaded["similarity_matrices"], WEIGHTS, 120
+                )
+            else:
+                graphs, ids = loaded["neighbour_graphs"]
+                get_neighbour_recommendations(films, titles, graphs, ids, WEIGHTS, 120)
+
+    def build_filters():
+        loaded["filter_index"] = build_filter_index(films)
+
+    def filter_films():
+        get_filter_values(loaded["filter_index"])
+        for cast, director, genres in filters:
+            apply_filters(films, loaded["filter_index"], cast, director, genres)
+
+    def build_titles():
+        loaded["title_index"] = build_title_index(films)
+
+    def search_films():
+        for search in searches:
+            search_titles(loaded["title_index"], search)
+
+    stages = {
+        "train_content_similarity": train_content_similarity,
+        "train_collaborative": train_collaborative,
+        "load_data": lambda: load_data(data_path),
+        "load_similarity": load_similarity,
+        "recommend_x20": recommend,
+        "build_filter_index": build_filters,
+        "filter_x20": filter_films,
+        "build_title_index": build_titles,
+        "search_titles_x20": search_films,
+    }
+    if top_k is None and num_films <= config.BENCHMARK_MAX_BLENDED_FILMS:
+        # The full N x N blend the app used before recommending from the liked rows only.
+        def generate_weighted():
+            loaded["weighted"] = generate_weighted_similarity_matrix(
+                loaded["similarity_matrices"], WEIGHTS
+            )
+
+        stages["generate_weighted_similarity_matrix"] = generate_weighted
+        stages["get_recommendations_x20"] = lambda: [
+            get_recommendations(films, titles, loaded["weighted"], 120) for titles in queries
+        ]
+    return stages
+
+
+def run_benchmarks(
+    sizes: List[int] = config.BENCHMARK_SIZES, repeats: int = config.BENCHMARK_REPEATS
+) -> List[Dict]:
+    results = []
+    for num_films in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            for stage_name, stage in get_stages(num_films, path).items():
+                stage_repeats = 1 if stage_name.startswith("train_") else repeats
+                result = {"films": num_films, "stage": stage_name, **measure(stage, stage_repeats)}
+                print(
+                    f"{num_films} films, {stage_name}: {result['seconds']:.3f}s, {result['peak_mb']:.1f} MB"
+                )
+                results.append(result)
+    return results
+
+
+def compare_to_baseline(
+    results: List[Dict],
+    baseline: List[Dict],
+    threshold: float = config.BENCHMARK_REGRESSION_THRESHOLD,
+) -> pd.DataFrame:
+    """Ratios of each result to its baseline, marking stages slower or larger than threshold times the baseline.
+
+    Stages under config.BENCHMARK_MIN_SECONDS in both runs are not marked as slower, as their timings are noise.
+    """
+    comparison = pd.DataFrame(results).merge(
+        pd.DataFrame(baseline), on=["films", "stage"], how="left", suffixes=("", "_baseline")
+    )
+    comparison["time_ratio"] = comparison.seconds / comparison.seconds_baseline
+    comparison["memory_ratio"] = comparison.peak_mb / comparison.peak_mb_baseline
+    is_timed = (
+        np.maximum(comparison.seconds, comparison.seconds_baseline) >= config.BENCHMARK_MIN_SECONDS
+    )
+    comparison["regression"] = (is_timed & (comparison.time_ratio > threshold)) | (
+        (comparison.peak_mb >= config.BENCHMARK_MIN_MB) & (comparison.memory_ratio > threshold)
+    )
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=config.BENCHMARK_SIZES)
+    parser.add_argument("--repeats", type=int, default=config.BENCHMARK_REPEATS)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeats)
+    if args.update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(results, f, indent=1)
+            f.write("\n")
+        print(f"Saved baseline to {BASELINE_PATH}")
+        return
+
+    with open(BASELINE_PATH) as f:
+        comparison = compare_to_baseline(results, json.load(f))
+    print(comparison.round(3).to_string(index=False))
+    if comparison.regression.any():
+        regressions = comparison[comparison.regression]
+        print(
+            "Regressions: "
+            + ", ".join(f"{r.stage} at {r.films} films" for r in regressions.itertuples())
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Rebuilds only the artifacts whose inputs or parameters have changed, running independent builds in parallel.
+
+Each node declares the files it reads, the parameters it is built with and the nodes it depends on. Its key hashes
+the contents of those files, the parameters and the keys of its dependencies, so a node is rebuilt when anything
+upstream of it changes. A node reading only part of a file, e.g. some columns of the catalogue, hashes just that
+part instead, so changes to the rest of the file do not rebuild it. Keys of built nodes are recorded by the caller,
+for example alongside the artifacts.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import sys
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from profiling import log_stage
+from stage_cache import get_key, hash_file
+
+
+class BuildNode(NamedTuple):
+    name: str
+    # Builds the node's artifacts given the number of processes it may use. Must be picklable, e.g. a module level
+    # function or a functools.partial of one.
+    build: Callable[[int], None]
+    inputs: List[str] = []
+    # Hashes of the parts of files the node reads, each computed by a picklable function with no arguments.
+    input_hashes: List[Callable[[], str]] = []
+    params: Dict = {}
+    depends_on: List[str] = []
+
+
+def get_node_keys(nodes: List[BuildNode]) -> Dict[str, str]:
+    """Keys of each node from its inputs, parameters and dependencies, in dependency order."""
+    by_name = {node.name: node for node in nodes}
+    file_hashes = {}
+    keys = {}
+
+    def visit(node: BuildNode, visiting: tuple):
+        if node.name in keys:
+            return
+        if node.name in visiting:
+            raise ValueError(
+                f"Build nodes depend on each other in a cycle: {visiting + (node.name,)}"
+            )
+        for dependency in node.depends_on:
+            visit(by_name[dependency], visiting + (node.name,))
+        for path in node.inputs:
+            if path not in file_hashes:
+                file_hashes[path] = hash_file(path)
+        keys[node.name] = get_key(
+            node.name,
+            [file_hashes[path] for path in node.inputs]
+            + [get_input_hash() for get_input_hash in node.input_hashes],
+            node.params,
+            [keys[dependency] for dependency in node.depends_on],
+        )
+
+    for node in nodes:
+        visit(node, ())
+    return keys
+
+
+def _build_node(node: BuildNode, n_jobs: int):
+    with log_stage(f"Build {node.name}"):
+        node.build(n_jobs)
+
+
+def run_build(
+    nodes: List[BuildNode],
+    get_built_key: Callable[[str], Optional[str]],
+    record_built_key: Callable[[str, str], None],
+    n_jobs: Optional[int] = None,
+    force: bool = False,
+) -> Dict[str, str]:
+    """Builds the nodes whose key differs from the one recorded when they were last built.
+
+    Nodes run as soon as the nodes they depend on have finished, up to n_jobs at a time in separate processes. The
+    cores are shared between the nodes running together, so a lone node can still parallelise its own build.
+
+    Args:
+        nodes (List[BuildNode]): Nodes to build.
+        get_built_key (Callable[[str], Optional[str]]): Key recorded for a node's artifacts, None if unbuilt.
+        record_built_key (Callable[[str, str], None]): Records a node's key once it has been built.
+        n_jobs (Optional[int]): Number of processes, None uses every core and 1 builds in this process.
+        force (bool): Whether to rebuild every node.
+
+    Returns:
+        Dict[str, str]: "built" or "skipped" for each node.
+    """
+    keys = get_node_keys(nodes)
+    stale = {node.name for node in nodes if force or get_built_key(node.name) != keys[node.name]}
+    status = {node.name: "built" if node.name in stale else "skipped" for node in nodes}
+    for name in status:
+        if status[name] == "skipped":
+            print(f"{name}: up to date")
+    pending = [node for node in nodes if node.name in stale]
+    num_cpus = os.cpu_count() or 1
+    max_workers = min(n_jobs or num_cpus, len(pending))
+
+    if max_workers <= 1:
+        # get_node_keys visits dependencies first, so building in key order respects them.
+        for name in keys:
+            node = next((node for node in pending if node.name == name), None)
+            if node is not None:
+                _build_node(node, n_jobs or num_cpus)
+                record_built_key(name, keys[name])
+        return status
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            ready = [
+                node
+                for node in pending
+                if not any(dependency in stale for dependency in node.depends_on)
+            ]
+            for node in ready[: max_workers - len(running)]:
+                pending.remove(node)
+                node_jobs = max(1, num_cpus // min(max_workers, len(pending) + len(running) + 1))
+                running[executor.submit(_build_node, node, node_jobs)] = node.name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                future.result()
+                record_built_key(name, keys[name])
+                stale.discard(name)
+    return status
@@ -1,4 +1,4 @@
-import streamlit as st
+import os
 
 MIN_FILM_DATE = "01/01/1970"
 EXCLUDE_LANGUAGES = ["hi"]
@@ -25,14 +25,139 @@ USEFUL_COLUMNS = [
 GET_VALID_POSTER_PATHS = False
 NUM_FILMS_TO_KEEP = 3500
 
+# Keep only each film's top K neighbours per similarity source instead of the dense N x N matrices. This keeps
+# storage and scoring linear in the number of films, so NUM_FILMS_TO_KEEP can be raised. None stores dense matrices.
+# The training scripts' --top-k option overrides it, and serving loads whichever format the sources were trained in.
+SIMILARITY_TOP_K = None
+# Storage of dense similarity matrices: "float32", or "float16" or "uint8" to quantise the scores, and whether to keep
+# only the upper triangle of each symmetric matrix. Compare them with training/compare_similarity_storage.py.
+SIMILARITY_DTYPE = "float32"
+SIMILARITY_UPPER_TRIANGLE = False
+# Rows of each similarity matrix computed per task, and worker processes to use (None uses every core).
+SIMILARITY_BLOCK_SIZE = 500
+SIMILARITY_N_JOBS = None
+# Sources whose film vectors are also indexed for approximate nearest neighbour search, see ann_index.py. Searches
+# score the films of the ANN_NUM_PROBES closest of ANN_NUM_LISTS k-means clusters, so more probes give higher recall.
+ANN_SOURCES = ["overview", "collaborative"]
+ANN_NUM_LISTS = 64
+ANN_NUM_PROBES = 16
+ANN_KMEANS_ITERATIONS = 20
+# Retrain from scratch once films folded in by training/update_incremental.py, or the share of their text or
+# ratings the trained models cannot represent, exceeds this fraction.
+FOLD_IN_DRIFT_THRESHOLD = 0.1
+# How often the app checks whether training has published a new generation of artifacts to swap in.
+MODEL_REGISTRY_CHECK_SECONDS = 5
+# Recommendations are cached per process, keyed by the liked films and the weights rounded to the slider step.
+RECOMMENDATION_WEIGHT_STEP = 0.01
+RECOMMENDATION_CACHE_MAX_ENTRIES = 10_000
+RECOMMENDATION_CACHE_MAX_MB = 50
+RECOMMENDATION_CACHE_TTL_SECONDS = 3600
+# Users scored per task by batch_recommender.py, and worker processes to use (None uses every core).
+BATCH_RECOMMENDATION_USERS = 2000
+BATCH_RECOMMENDATION_N_JOBS = None
+# sharded_recommender.py splits the catalogue into NUM_SHARDS near equal blocks of films, each scored in its own
+# process.
+NUM_SHARDS = 4
+SHARD_PATH = "data/similarity_shards/"
+# Whether the app and the service recommend from the shards in SHARD_PATH instead of the similarity sources. The shards
+# must be rewritten after each training run, or the models fail to load. SHARD_TRANSPORT "local" scores each shard in
+# its own worker process, "in_process" scores them all in the serving process.
+SHARDED_RECOMMENDATIONS = False
+SHARD_TRANSPORT = "local"
+# evaluation.py holds out the latest EVALUATION_HOLDOUT_FRACTION of each user's ratings and measures how many of the
+# films they rated at least EVALUATION_LIKE_RATING are in the top EVALUATION_K recommendations from their earlier
+# likes, for each weighting in EVALUATION_WEIGHTS. Users are evaluated in batches of EVALUATION_USERS_PER_BATCH across
+# EVALUATION_N_JOBS processes (None uses every core).
+EVALUATION_HOLDOUT_FRACTION = 0.2
+EVALUATION_LIKE_RATING = 4.0
+EVALUATION_K = [10, 50]
+EVALUATION_WEIGHTS = [
+    [0.5, 0.5, 0.5, 0.5, 0.5],
+    [1.0, 0.0, 0.0, 0.0, 0.0],
+    [0.0, 1.0, 0.0, 0.0, 0.0],
+    [0.0, 0.0, 1.0, 0.0, 0.0],
+    [0.0, 0.0, 0.0, 1.0, 0.0],
+    [0.0, 0.0, 0.0, 0.0, 1.0],
+    [0.5, 0.5, 0.5, 0.5, 1.0],
+]
+EVALUATION_USERS_PER_BATCH = 1000
+EVALUATION_N_JOBS = None
+# Recommendation service, see service.py. Workers are forked processes sharing the memory mapped artifacts.
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8000
+SERVICE_WORKERS = 1
+# Latencies kept per endpoint for the percentiles reported by /metrics.
+SERVICE_LATENCY_WINDOW = 1000
+# Synthetic catalogue sizes benchmarked by benchmarks/run_benchmarks.py. Larger catalogues than
+# BENCHMARK_MAX_DENSE_FILMS use top-k neighbour graphs, and the full N x N blend of generate_weighted_similarity_matrix
+# is only benchmarked up to BENCHMARK_MAX_BLENDED_FILMS, as it holds every source in memory at once.
+BENCHMARK_SIZES = [3500, 10_000, 50_000]
+BENCHMARK_MAX_DENSE_FILMS = 10_000
+BENCHMARK_MAX_BLENDED_FILMS = 3500
+BENCHMARK_TOP_K = 100
+# Training runs in the benchmarking process so that tracemalloc sees its allocations.
+BENCHMARK_N_JOBS = 1
+# Timed runs per stage, of which the median is kept. Training stages run once.
+BENCHMARK_REPEATS = 3
+# Stages slower or larger than this many times their baseline are regressions. Stages faster than
+# BENCHMARK_MIN_SECONDS or allocating less than BENCHMARK_MIN_MB are too noisy to compare on that measure.
+BENCHMARK_REGRESSION_THRESHOLD = 1.25
+BENCHMARK_MIN_SECONDS = 0.05
+BENCHMARK_MIN_MB = 1
+# Set RECOMMENDER_INSTRUMENTATION=1 to time the stages of every app rerun, show them in a debug panel in the sidebar
+# and append them to INSTRUMENTATION_LOG_PATH as JSON lines. See profiling.py.
+INSTRUMENTATION_ENABLED = os.environ.get("RECOMMENDER_INSTRUMENTATION") == "1"
+INSTRUMENTATION_LOG_PATH = "logs/reruns.jsonl"
+
 # Main
 C = 5.6  # Mean vote score.
 m = 156  # 90th percentile of number of votes
 
 POSTER_BASE_URL = "https://image.tmdb.org/t/p/original/"
-TMDB_API_KEY = st.secrets["TMDB_API_KEY"]
-DATA_PATH = "data/film_features.csv"
+TMDB_API_URL = "https://api.themoviedb.org/3"
+RAW_METADATA_PATH = "data/movies_metadata.csv"
+RAW_CREDITS_PATH = "data/credits.csv"
+RAW_KEYWORDS_PATH = "data/keywords.csv"
+# preprocessing/preprocessing.py parses the raw lists in chunks of PREPROCESSING_CHUNK_SIZE films across
+# PREPROCESSING_N_JOBS processes (None uses every core), and caches each stage's output in STAGE_CACHE_PATH.
+PREPROCESSING_N_JOBS = None
+PREPROCESSING_CHUNK_SIZE = 2000
+STAGE_CACHE_PATH = "data/stage_cache/"
+POSTER_PATHS_PATH = "data/updated_poster_paths.csv"
+# Poster validation in preprocessing/update_poster_paths.py. Requests are shared between the workers and the
+# results are checkpointed to POSTER_PATHS_PATH every POSTER_CHECKPOINT_EVERY films so interrupted runs resume.
+POSTER_VALIDATION_WORKERS = 16
+POSTER_REQUESTS_PER_SECOND = 20
+POSTER_REQUEST_TIMEOUT = 10
+# Times a request is retried after a connection error, rate limiting or a server error.
+POSTER_REQUEST_RETRIES = 3
+POSTER_CHECKPOINT_EVERY = 250
+# Thumbnails of the posters, resized to IMAGE_WIDTH by preprocessing/cache_thumbnails.py and shown instead of the
+# original size posters when cached.
+BASE_THUMBNAILS_PATH = "data/thumbnails/"
+THUMBNAIL_PACK = "thumbnails.bin"  # Named by width, e.g. thumbnails_300.bin.
+THUMBNAIL_INDEX = "thumbnails.json"
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_QUALITY = 80
+# Name of the Streamlit secret, or else environment variable, holding the TMDB API key. Only preprocessing looks
+# films up on TMDB, and reads the key when it first does, so nothing else needs it.
+TMDB_API_KEY_NAME = "TMDB_API_KEY"
+DATA_PATH = "data/film_catalogue.npz"
+LIST_COLUMNS = ["keywords", "cast", "genres"]
+CATEGORICAL_COLUMNS = ["director", "original_language"]
+RATINGS_PATH = "data/ratings.csv"
+RATINGS_CHUNK_SIZE = 1_000_000
+# Users with fewer ratings of the catalogue's films are left out of collaborative training, as one rating says nothing
+# about how a user's tastes relate films to each other. 1 keeps every user.
+MIN_RATINGS_PER_USER = 2
 BASE_SIMILARITY_PATH = "data/similarity_matrices/"
+SIMILARITY_MANIFEST = "manifest.json"
+BASE_FEATURES_PATH = "data/features/"
+BASE_ANN_PATH = "data/ann_indexes/"
+SIMILARITY_SOURCES = ["cast", "director", "keywords", "overview", "collaborative"]
+# Rewritten last by the training scripts once the catalogue, similarity sources and thumbnails on disk are a
+# consistent set. The app and the service only load new models when it changes.
+MODEL_GENERATION_PATH = "data/model_generation.json"
 
 # UI config
 IMAGE_WIDTH = 175
@@ -41,6 +166,10 @@ POSTERS_PER_ROW = 8
 PARAMETER_CONTROL_MIN = 0.0
 PARAMETER_CONTROL_MAX = 1.0
 PARAMETER_CONTROL_DEFAULT = 0.5
+# Films suggested by the sidebar search, and the share of a query's trigrams a title must contain to match it despite
+# typos. See title_index.py.
+TITLE_SEARCH_SUGGESTIONS = 20
+TITLE_SEARCH_MIN_SIMILARITY = 0.5
 
 APP_EXPLANATION = """
 This is a hybrid content / collaborative based recommender system. It uses text based metadata from the films (content
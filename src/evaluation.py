@@ -0,0 +1,361 @@
+"""Evaluates the recommendations of each weighting of the similarity sources on held out ratings.
+
+Usage:
+    python src/evaluation.py                            # the weightings in config.EVALUATION_WEIGHTS
+    python src/evaluation.py --grid 0 0.5 1 --output evaluation.csv   # every weighting of the values given
+
+Each user's latest ratings are held out. The films they liked before those are recommended from, as the film_ids of
+get_weighted_recommendations, and the held out films they liked are the relevant ones. Users are scored in batches as
+sparse user x film matrices, as in batch_recommender.py. Each source is multiplied once per batch and blended for
+every weighting, and batches are evaluated across a process pool.
+
+The trained collaborative similarity has seen every rating in config.RATINGS_PATH, held out ones included, so its
+scores are optimistic. With --fit-collaborative the SVD is fitted again on the ratings before the split only, and
+that similarity is evaluated in its place:
+
+    python src/evaluation.py --fit-collaborative
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import os
+import sys
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from batch_recommender import get_indicator_matrix, get_source_scores, get_top_films, load_sources
+from profiling import log_stage
+from ratings_store import get_ratings_matrix
+from similarity_builder import build_similarity
+from similarity_store import (
+    get_similarity_entry,
+    load_neighbour_graph,
+    load_packed_similarity_matrix,
+    load_similarity_matrix,
+    uses_neighbour_graphs,
+)
+from training.train_collaborative import fit_svd
+import config
+
+METRICS = ["precision", "recall", "ndcg"]
+
+# Set once per worker process by _init_worker so the similarity sources are not sent with every batch.
+_sources = None
+
+
+def read_ratings(
+    path: str, ids: pd.Index, holdout_fraction: float = config.EVALUATION_HOLDOUT_FRACTION
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    """Ratings of the films in ids sorted by user and time, and whether each is held out."""
+    ratings = pd.read_csv(
+        path,
+        usecols=["userId", "movieId", "rating", "timestamp"],
+        dtype={"userId": "int64", "movieId": "int64", "rating": "float32", "timestamp": "int64"},
+    )
+    ratings = ratings[ids.get_indexer(ratings["movieId"].values) >= 0]
+    ratings = ratings.sort_values(["userId", "timestamp"], kind="stable")
+    users = ratings.groupby("userId", sort=False)["userId"]
+    counts = users.transform("size").values
+    num_held_out = np.maximum(1, np.round(counts * holdout_fraction)).astype("int64")
+    return ratings, users.cumcount().values >= counts - num_held_out
+
+
+def split_ratings(
+    path: str,
+    ids: pd.Index,
+    holdout_fraction: float = config.EVALUATION_HOLDOUT_FRACTION,
+    like_rating: float = config.EVALUATION_LIKE_RATING,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Splits each user's ratings of the films in ids by time into liked films and held out relevant films.
+
+    The latest holdout_fraction of a user's ratings, and at least one, are held out. Ratings of at least like_rating
+    are likes, and held out likes of films already liked are dropped. Users without a like on both sides of the
+    split are dropped.
+
+    Args:
+        path (str): Ratings csv with userId, movieId, rating and timestamp columns.
+        ids (pd.Index): Film ids that can be recommended.
+        holdout_fraction (float): Share of each user's ratings to hold out.
+        like_rating (float): Lowest rating counted as liking a film.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: user_id and film_id of the earlier likes and of the held out likes.
+    """
+    ratings, is_held_out = read_ratings(path, ids, holdout_fraction)
+    likes = ratings[["userId", "movieId"]].rename(
+        columns={"userId": "user_id", "movieId": "film_id"}
+    )
+    is_like = ratings["rating"].values >= like_rating
+    liked, relevant = likes[is_like & ~is_held_out], likes[is_like & is_held_out]
+    # Liked films are never recommended, so liking one again is not relevant.
+    relevant = relevant.merge(liked.drop_duplicates(), how="left", indicator=True)
+    relevant = relevant.loc[relevant["_merge"] == "left_only", ["user_id", "film_id"]]
+    users = np.intersect1d(liked["user_id"].unique(), relevant["user_id"].unique())
+    return liked[liked["user_id"].isin(users)], relevant[relevant["user_id"].isin(users)]
+
+
+def fit_collaborative_similarity(
+    ratings_path: str,
+    ids: pd.Index,
+    output_path: str,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+    holdout_fraction: float = config.EVALUATION_HOLDOUT_FRACTION,
+    n_jobs: Optional[int] = config.EVALUATION_N_JOBS,
+):
+    """Trains the collaborative similarity as train_collaborative.py does, on the ratings split_ratings does not hold
+    out, and saves it to output_path in the format of the trained one.
+
+    Args:
+        ratings_path (str): Ratings csv with userId, movieId, rating and timestamp columns.
+        ids (pd.Index): Film ids of the similarity sources.
+        output_path (str): Directory to write the similarity to.
+        similarity_path (str): Directory containing the trained similarity artifacts.
+        holdout_fraction (float): Share of each user's ratings to hold out.
+        n_jobs (Optional[int]): Number of worker processes, None uses every core and 1 runs in this process.
+    """
+    ratings, is_held_out = read_ratings(ratings_path, ids, holdout_fraction)
+    ratings = ratings[~is_held_out]
+    user_film_matrix, _ = get_ratings_matrix(
+        ratings["userId"].values,
+        ids.get_indexer(ratings["movieId"].values).astype("int32"),
+        ratings["rating"].values,
+        num_films=len(ids),
+    )
+    X, _ = fit_svd(user_film_matrix)
+    top_k = None
+    if uses_neighbour_graphs(similarity_path):
+        graph = load_neighbour_graph("collaborative", similarity_path)[0]
+        top_k = int(np.diff(graph.indptr).max())
+    build_similarity(
+        "collaborative", features=X, ids=ids, top_k=top_k, n_jobs=n_jobs, path=output_path
+    )
+
+
+def load_source(name: str, path: str):
+    """Loads one similarity source as load_sources does, in the format it was saved in."""
+    storage = get_similarity_entry(name, path).get("format", "dense")
+    if storage == "neighbours":
+        return load_neighbour_graph(name, path)[0]
+    if storage == "packed":
+        return load_packed_similarity_matrix(name, path)[0]
+    return load_similarity_matrix(name, path)[0]
+
+
+def get_weight_grid(values: List[float]) -> List[List[float]]:
+    """Every weighting of the sources taking the given values, leaving out those adding up to 0."""
+    return [
+        list(weights)
+        for weights in itertools.product(values, repeat=len(config.SIMILARITY_SOURCES))
+        if sum(weights) > 0
+    ]
+
+
+def get_hits(top: np.ndarray, scores: np.ndarray, relevant: csr_matrix) -> np.ndarray:
+    """Whether each recommended film is one of the user's relevant films, as a users x top_n boolean array."""
+    num_films = relevant.shape[1]
+    relevant = relevant.tocoo()
+    relevant_keys = relevant.row.astype("int64") * num_films + relevant.col
+    top_keys = np.arange(len(top), dtype="int64")[:, None] * num_films + top
+    # Padding with -inf scores is not a recommendation.
+    return np.isin(top_keys, relevant_keys) & np.isfinite(scores)
+
+
+def get_metric_totals(hits: np.ndarray, num_relevant: np.ndarray, ks: List[int]) -> np.ndarray:
+    """Sums of each user's precision, recall and NDCG at each k.
+
+    Args:
+        hits (np.ndarray): Users x max(ks) boolean array of relevant recommendations, best first.
+        num_relevant (np.ndarray): Number of relevant films of each user.
+        ks (List[int]): Numbers of recommendations to evaluate.
+
+    Returns:
+        np.ndarray: len(ks) x len(METRICS) totals over the users.
+    """
+    discounts = 1 / np.log2(np.arange(hits.shape[1]) + 2)
+    ideal = np.cumsum(discounts)
+    totals = np.zeros((len(ks), len(METRICS)))
+    for i, k in enumerate(ks):
+        num_hits = hits[:, :k].sum(axis=1)
+        dcg = hits[:, :k] @ discounts[:k]
+        idcg = ideal[np.minimum(num_relevant, k) - 1]
+        totals[i] = [(num_hits / k).sum(), (num_hits / num_relevant).sum(), (dcg / idcg).sum()]
+    return totals
+
+
+def evaluate_users(
+    indicator: csr_matrix,
+    relevant: csr_matrix,
+    sources: list,
+    weight_configs: List[List[float]],
+    ks: List[int],
+) -> np.ndarray:
+    """Sums the precision, recall and NDCG of a batch of users under each weighting of the sources.
+
+    Scores are the same as score_users gives for each weighting, but every source is multiplied once.
+
+    Args:
+        indicator (csr_matrix): Users x films matrix with a 1 for each liked film.
+        relevant (csr_matrix): Users x films matrix with a 1 for each held out liked film.
+        sources (list): Dense or packed similarity matrices or sparse neighbour graphs, films x films.
+        weight_configs (List[List[float]]): Weightings of the sources to evaluate.
+        ks (List[int]): Numbers of recommendations to evaluate.
+
+    Returns:
+        np.ndarray: len(weight_configs) x len(ks) x len(METRICS) totals over the users.
+    """
+    liked = np.unique(indicator.indices)
+    used = [any(weights[i] for weights in weight_configs) for i in range(len(sources))]
+    source_scores = [
+        get_source_scores(indicator, source, liked) if is_used else None
+        for source, is_used in zip(sources, used)
+    ]
+    counts = np.asarray(indicator.sum(axis=1), dtype="float32")
+    num_relevant = np.diff(relevant.indptr)
+    totals = np.zeros((len(weight_configs), len(ks), len(METRICS)))
+    for i, weights in enumerate(weight_configs):
+        scores = np.zeros(indicator.shape, dtype="float32")
+        for product, weight in zip(source_scores, weights):
+            if weight:
+                scores += weight * product
+        scores /= sum(weights) * np.maximum(counts, 1)
+        top, top_scores = get_top_films(scores, indicator, max(ks))
+        totals[i] = get_metric_totals(get_hits(top, top_scores, relevant), num_relevant, ks)
+    return totals
+
+
+def _init_worker(similarity_path: str, collaborative_path: Optional[str] = None):
+    global _sources
+    _sources = load_sources(similarity_path)[0]
+    if collaborative_path is not None:
+        _sources[config.SIMILARITY_SOURCES.index("collaborative")] = load_source(
+            "collaborative", collaborative_path
+        )
+
+
+def _evaluate_batch(
+    indicator: csr_matrix, relevant: csr_matrix, weight_configs: List[List[float]], ks: List[int]
+) -> np.ndarray:
+    return evaluate_users(indicator, relevant, _sources, weight_configs, ks)
+
+
+def _get_batches(
+    liked: pd.DataFrame, relevant: pd.DataFrame, ids: pd.Index, batch_size: int
+) -> Iterator[Tuple[csr_matrix, csr_matrix]]:
+    # Both have the same users, so their rows line up.
+    _, indicator = get_indicator_matrix(liked, ids)
+    _, relevant = get_indicator_matrix(relevant, ids)
+    for start in range(0, indicator.shape[0], batch_size):
+        yield indicator[start : start + batch_size], relevant[start : start + batch_size]
+
+
+def evaluate(
+    weight_configs: List[List[float]],
+    ks: List[int] = config.EVALUATION_K,
+    ratings_path: str = config.RATINGS_PATH,
+    batch_size: int = config.EVALUATION_USERS_PER_BATCH,
+    n_jobs: Optional[int] = config.EVALUATION_N_JOBS,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+    fit_collaborative: bool = False,
+) -> pd.DataFrame:
+    """Evaluates the recommendations of each weighting of the sources on the held out ratings.
+
+    Args:
+        weight_configs (List[List[float]]): Weightings of the cast, director, keywords, overview and collaborative
+            sources.
+        ks (List[int]): Numbers of recommendations to evaluate.
+        ratings_path (str): Ratings csv with userId, movieId, rating and timestamp columns.
+        batch_size (int): Number of users evaluated per task.
+        n_jobs (Optional[int]): Number of worker processes, None uses every core and 1 runs in this process.
+        similarity_path (str): Directory containing the similarity artifacts.
+        fit_collaborative (bool): Whether to evaluate a collaborative similarity fitted on the ratings before the
+            split, see fit_collaborative_similarity, rather than the trained one.
+
+    Returns:
+        pd.DataFrame: The weight of each source and the mean precision, recall and NDCG at each k over the users, a
+            row per weighting.
+    """
+    for weights in weight_configs:
+        if len(weights) != len(config.SIMILARITY_SOURCES) or sum(weights) <= 0:
+            raise ValueError(
+                f"Expected weights of {config.SIMILARITY_SOURCES} adding up to more than 0, got {weights}"
+            )
+    ids = load_sources(similarity_path)[1]
+    liked, relevant = split_ratings(ratings_path, ids)
+    batches = list(_get_batches(liked, relevant, ids, batch_size))
+    num_users = sum(indicator.shape[0] for indicator, _ in batches)
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        collaborative_path = None
+        if fit_collaborative:
+            collaborative_path = temp_path
+            with log_stage("Fit collaborative on the ratings before the split"):
+                fit_collaborative_similarity(
+                    ratings_path, ids, collaborative_path, similarity_path, n_jobs=n_jobs
+                )
+        if n_jobs == 1:
+            _init_worker(similarity_path, collaborative_path)
+            totals = [_evaluate_batch(*batch, weight_configs, ks) for batch in batches]
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_jobs or os.cpu_count(),
+                initializer=_init_worker,
+                initargs=(similarity_path, collaborative_path),
+            ) as executor:
+                futures = [
+                    executor.submit(_evaluate_batch, *batch, weight_configs, ks)
+                    for batch in batches
+                ]
+                totals = [future.result() for future in futures]
+    means = np.sum(totals, axis=0) / max(num_users, 1)
+
+    results = pd.DataFrame(weight_configs, columns=config.SIMILARITY_SOURCES)
+    for i, k in enumerate(ks):
+        for j, metric in enumerate(METRICS):
+            results[f"{metric}@{k}"] = means[:, i, j]
+    results.attrs["num_users"] = num_users
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--grid",
+        type=float,
+        nargs="+",
+        help="evaluate every weighting of the sources taking these values instead of config.EVALUATION_WEIGHTS",
+    )
+    parser.add_argument("--k", type=int, nargs="+", default=config.EVALUATION_K)
+    parser.add_argument("--batch-size", type=int, default=config.EVALUATION_USERS_PER_BATCH)
+    parser.add_argument("--n-jobs", type=int, default=config.EVALUATION_N_JOBS)
+    parser.add_argument("--output", help="csv to write the results to")
+    parser.add_argument(
+        "--fit-collaborative",
+        action="store_true",
+        help="evaluate a collaborative similarity fitted on the ratings before the split only",
+    )
+    args = parser.parse_args()
+
+    weight_configs = get_weight_grid(args.grid) if args.grid else config.EVALUATION_WEIGHTS
+    with log_stage(f"Evaluate {len(weight_configs)} weightings"):
+        results = evaluate(
+            weight_configs,
+            args.k,
+            batch_size=args.batch_size,
+            n_jobs=args.n_jobs,
+            fit_collaborative=args.fit_collaborative,
+        )
+    results = results.sort_values(f"ndcg@{max(args.k)}", ascending=False)
+    print(f"{results.attrs['num_users']} users")
+    print(results.round(4).to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import pickle
+import sys
+from typing import Iterable, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix, load_npz, save_npz
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import config
+
+
+def get_feature_paths(name: str, path: str = config.BASE_FEATURES_PATH) -> Tuple[str, str, str]:
+    """File paths of the vectorizer, feature matrix and film ids saved for a content source."""
+    return (
+        os.path.join(path, f"{name}_vectorizer.pkl"),
+        os.path.join(path, f"{name}_features.npz"),
+        os.path.join(path, f"{name}_ids.npy"),
+    )
+
+
+def save_text_features(
+    name: str,
+    vectorizer: Union[CountVectorizer, TfidfVectorizer],
+    features: csr_matrix,
+    ids: Iterable[int],
+    path: str = config.BASE_FEATURES_PATH,
+):
+    """Saves a fitted vectorizer and the sparse feature vectors it produced for each film.
+
+    Args:
+        name (str): Content source name, e.g. "overview".
+        vectorizer (Union[CountVectorizer, TfidfVectorizer]): Fitted vectorizer.
+        features (csr_matrix): Feature vector of each film.
+        ids (Iterable[int]): Film id of each row of features.
+        path (str): Directory to write the artifacts to.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    if features.shape[0] != len(ids):
+        raise ValueError(
+            f"{name} has {features.shape[0]} feature rows but {len(ids)} ids were given"
+        )
+
+    os.makedirs(path, exist_ok=True)
+    vectorizer_path, features_path, ids_path = get_feature_paths(name, path)
+    with open(vectorizer_path, "wb") as f:
+        pickle.dump(vectorizer, f)
+    save_npz(features_path, csr_matrix(features))
+    np.save(ids_path, ids)
+
+
+def load_text_features(
+    name: str, path: str = config.BASE_FEATURES_PATH
+) -> Tuple[Union[CountVectorizer, TfidfVectorizer], csr_matrix, np.ndarray]:
+    """Loads the vectorizer and feature vectors saved for a content source.
+
+    Args:
+        name (str): Content source name, e.g. "overview".
+        path (str): Directory containing the artifacts.
+
+    Returns:
+        Tuple[Union[CountVectorizer, TfidfVectorizer], csr_matrix, np.ndarray]: Fitted vectorizer, feature vector of
+            each film and the film id of each row.
+    """
+    vectorizer_path, features_path, ids_path = get_feature_paths(name, path)
+    with open(vectorizer_path, "rb") as f:
+        vectorizer = pickle.load(f)
+    return vectorizer, load_npz(features_path).tocsr(), np.load(ids_path)
+
+
+def save_svd_features(
+    embeddings: np.ndarray,
+    components: np.ndarray,
+    user_ids: Iterable[int],
+    ids: Iterable[int],
+    path: str = config.BASE_FEATURES_PATH,
+):
+    """Saves the collaborative film embeddings with the SVD components needed to fold in new ratings.
+
+    A film's embedding is its vector of user ratings multiplied by components.T, so films can be projected into the
+    same latent space later without refitting the SVD.
+
+    Args:
+        embeddings (np.ndarray): Latent vector of each film.
+        components (np.ndarray): SVD components, one column per user the SVD was fitted on.
+        user_ids (Iterable[int]): User id of each column of components.
+        ids (Iterable[int]): Film id of each row of embeddings.
+        path (str): Directory to write the artifacts to.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    user_ids = np.asarray(user_ids, dtype="int64")
+    if embeddings.shape[0] != len(ids):
+        raise ValueError(f"{embeddings.shape[0]} embeddings but {len(ids)} ids were given")
+    if components.shape[1] != len(user_ids):
+        raise ValueError(f"{components.shape[1]} component columns but {len(user_ids)} user ids")
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "collaborative_embeddings.npy"), embeddings.astype("float32"))
+    np.save(os.path.join(path, "collaborative_components.npy"), components.astype("float32"))
+    np.save(os.path.join(path, "collaborative_user_ids.npy"), user_ids)
+    np.save(os.path.join(path, "collaborative_ids.npy"), ids)
+
+
+def load_svd_features(
+    path: str = config.BASE_FEATURES_PATH,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Loads the artifacts written by save_svd_features.
+
+    Args:
+        path (str): Directory containing the artifacts.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Film embeddings, SVD components, the user id of each
+            component column and the film id of each embedding.
+    """
+    return tuple(
+        np.load(os.path.join(path, f"collaborative_{name}.npy"))
+        for name in ["embeddings", "components", "user_ids", "ids"]
+    )
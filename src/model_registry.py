@@ -0,0 +1,212 @@
+"""Loads the film catalogue and trained artifacts once per process and shares them between every app session.
+
+Similarity artifacts and thumbnails are read-only memory maps, so loading them copies nothing and their pages are
+shared with any other process mapping the same files. Unlike st.cache, nothing is hashed when the models are fetched.
+
+Training rewrites the artifacts one file at a time, so they are only served once the script that wrote them calls
+publish_generation, which replaces a single marker file after everything else is on disk. get_models checks the
+marker at most every config.MODEL_REGISTRY_CHECK_SECONDS, loads a new generation only when it changes, and swaps it in
+with a single assignment, so sessions already holding the previous generation keep a consistent set of models until
+they next call get_models.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from profiling import get_peak_rss_mb
+from sharded_recommender import ShardTransport, load_shards
+from similarity_store import PackedSimilarityMatrix, uses_neighbour_graphs
+from thumbnail_store import load_thumbnail_cache
+from title_index import TitleIndex, build_title_index
+from utils import build_filter_index, load_data, load_neighbour_graphs, load_similarity_matrices
+import config
+
+
+class Models(NamedTuple):
+    version: Optional[str]
+    data: pd.DataFrame
+    filter_index: Dict
+    title_index: TitleIndex
+    similarity_matrices: Optional[List[Union[pd.DataFrame, PackedSimilarityMatrix]]]
+    neighbour_graphs: Optional[List[csr_matrix]]
+    neighbour_ids: Optional[pd.Index]
+    thumbnails: Tuple[Dict[str, Tuple[int, int]], Optional[np.memmap]]
+    shards: Optional[ShardTransport] = None
+
+
+_lock = threading.Lock()
+_models = None
+_paths = None
+_last_checked = 0.0
+
+
+def publish_generation(path: str = config.MODEL_GENERATION_PATH) -> str:
+    """Marks the artifacts on disk as a consistent set to serve. Called last by every script that rewrites them.
+
+    Returns:
+        str: The new generation.
+    """
+    generation = uuid.uuid4().hex
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"generation": generation, "published_at": time.time()}, f)
+    os.replace(f"{path}.tmp", path)
+    return generation
+
+
+def get_generation(path: str = config.MODEL_GENERATION_PATH) -> Optional[str]:
+    """Returns the last published generation, or None if training has not published one."""
+    try:
+        with open(path) as f:
+            return json.load(f)["generation"]
+    except FileNotFoundError:
+        return None
+
+
+def load_models(
+    data_path: str = config.DATA_PATH,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+    thumbnails_path: str = config.BASE_THUMBNAILS_PATH,
+    generation_path: str = config.MODEL_GENERATION_PATH,
+    shard_path: Optional[str] = config.SHARD_PATH if config.SHARDED_RECOMMENDATIONS else None,
+) -> Models:
+    """Loads the published artifacts, raising a ValueError if the catalogue and the similarity sources have
+    different films, or the shards in shard_path were not written from the similarity sources.
+    """
+    version = get_generation(generation_path)
+    data = load_data(data_path)
+    similarity_matrices, neighbour_graphs, neighbour_ids = None, None, None
+    if uses_neighbour_graphs(similarity_path):
+        neighbour_graphs, neighbour_ids = load_neighbour_graphs(similarity_path)
+        similarity_ids = neighbour_ids
+    else:
+        similarity_matrices = list(load_similarity_matrices(similarity_path))
+        similarity_ids = similarity_matrices[0].index
+    if len(similarity_ids) != len(data) or not np.array_equal(
+        np.sort(similarity_ids), np.sort(data["id"].values)
+    ):
+        raise ValueError(
+            "The catalogue and the similarity sources have different films, retrain them"
+        )
+    shards = None
+    if shard_path is not None:
+        shards = load_shards(similarity_ids, shard_path, similarity_path)
+    return Models(
+        version=version,
+        data=data,
+        filter_index=build_filter_index(data),
+        title_index=build_title_index(data),
+        similarity_matrices=similarity_matrices,
+        neighbour_graphs=neighbour_graphs,
+        neighbour_ids=neighbour_ids,
+        thumbnails=load_thumbnail_cache(width=config.IMAGE_WIDTH, path=thumbnails_path),
+        shards=shards,
+    )
+
+
+def get_models(
+    data_path: str = config.DATA_PATH,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+    thumbnails_path: str = config.BASE_THUMBNAILS_PATH,
+    generation_path: str = config.MODEL_GENERATION_PATH,
+    shard_path: Optional[str] = config.SHARD_PATH if config.SHARDED_RECOMMENDATIONS else None,
+    check_seconds: float = config.MODEL_REGISTRY_CHECK_SECONDS,
+) -> Models:
+    """Returns the models shared by every session, loading them on first use or when a new generation is published.
+
+    The returned models are shared and must not be modified. If a new generation fails to load, for example because
+    its catalogue and similarity sources have different films, the current one is kept and loading is retried at the
+    next check. Once a new generation is loaded, the shard transport of the previous one is closed.
+
+    Args:
+        data_path (str): Film catalogue file.
+        similarity_path (str): Directory containing the similarity artifacts.
+        thumbnails_path (str): Directory of the thumbnail cache.
+        generation_path (str): Marker file written by publish_generation.
+        shard_path (Optional[str]): Directory of the shards to recommend from, see sharded_recommender.py, or None
+            to recommend from the similarity sources. Set by config.SHARDED_RECOMMENDATIONS.
+        check_seconds (float): Minimum time between checks for a new generation.
+
+    Returns:
+        Models: The current generation of the models.
+    """
+    global _models, _paths, _last_checked
+    paths = (data_path, similarity_path, thumbnails_path, generation_path, shard_path)
+    models = _models
+    if paths == _paths and time.monotonic() - _last_checked < check_seconds:
+        return models
+
+    with _lock:
+        if paths == _paths and time.monotonic() - _last_checked < check_seconds:
+            return _models
+        previous = _models
+        if paths != _paths:
+            _models = None
+        _last_checked = time.monotonic()
+        version = get_generation(generation_path)
+        if _models is None or version != _models.version:
+            try:
+                _models = load_models(*paths)
+                _paths = paths
+                if previous is not None and previous.shards is not None:
+                    # Stops the previous generation's shard workers. Sessions still holding it fetch the new one.
+                    previous.shards.close()
+                footprint = get_memory_footprint(_models)
+                print("Loaded models: " + ", ".join(f"{k} {v:.1f}" for k, v in footprint.items()))
+            except (OSError, ValueError) as e:
+                if _models is None:
+                    raise
+                print(f"Keeping the loaded models, the new generation failed to load: {e}")
+        return _models
+
+
+def get_memory_footprint(models: Models) -> Dict[str, float]:
+    """Reports the memory used by the models in MB.
+
+    "heap_mb" is memory private to this process. "mapped_mb" is the size of the memory mapped files, which are only
+    resident as far as they have been read and are shared with other processes mapping them. "peak_rss_mb" is the
+    peak resident memory of the whole process.
+    """
+    heap_bytes = models.data.memory_usage(deep=True).sum()
+    heap_bytes += models.filter_index["order"].nbytes
+    for column in models.filter_index["postings"]:
+        heap_bytes += sum(
+            ranks.nbytes for ranks in models.filter_index["postings"][column].values()
+        )
+        heap_bytes += models.filter_index["has_value"][column].nbytes
+    for array in models.title_index:
+        heap_bytes += array.nbytes
+        if array.dtype == object:
+            heap_bytes += sum(sys.getsizeof(value) for value in array)
+
+    mapped_bytes = 0 if models.shards is None else models.shards.get_mapped_bytes()
+    mapped_arrays = []
+    if models.similarity_matrices is not None:
+        mapped_arrays += [
+            (
+                similarity.packed
+                if isinstance(similarity, PackedSimilarityMatrix)
+                else similarity.values
+            )
+            for similarity in models.similarity_matrices
+        ]
+    if models.neighbour_graphs is not None:
+        for graph in models.neighbour_graphs:
+            mapped_arrays += [graph.data, graph.indices, graph.indptr]
+    if models.thumbnails[1] is not None:
+        mapped_arrays.append(models.thumbnails[1])
+    return {
+        "heap_mb": heap_bytes / 1e6,
+        "mapped_mb": (mapped_bytes + sum(array.nbytes for array in mapped_arrays)) / 1e6,
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
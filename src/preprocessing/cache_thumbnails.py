@@ -0,0 +1,14 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from catalogue_store import load_catalogue
+from model_registry import publish_generation
+from preprocessing.utils import cache_thumbnails
+import config
+
+# Only posters missing from the cache are fetched, so rerunning resumes an interrupted run.
+films = load_catalogue(config.DATA_PATH)
+num_cached = cache_thumbnails(films.poster_path)
+print(f"Cached {num_cached} thumbnails in {config.BASE_THUMBNAILS_PATH}")
+publish_generation()
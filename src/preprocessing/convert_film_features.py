@@ -0,0 +1,15 @@
+"""Converts a film_features.csv written by earlier versions of preprocessing.py into the typed film catalogue."""
+
+import sys
+import os
+from ast import literal_eval
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from catalogue_store import save_catalogue
+import config
+
+film_features = pd.read_csv("data/film_features.csv")
+film_features[config.LIST_COLUMNS] = film_features[config.LIST_COLUMNS].applymap(literal_eval)
+save_catalogue(film_features, path=config.DATA_PATH)
@@ -5,9 +5,10 @@ import pandas as pd
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 from preprocessing.utils import update_poster_paths
+import config
 
 try:
-    dataframe = pd.read_csv("data/updated_poster_paths.csv")
+    dataframe = pd.read_csv(config.POSTER_PATHS_PATH)
 except:
     dataframe = pd.read_csv("data/movies_metadata.csv")
     # Remove rows with bad IDs.
@@ -16,5 +17,7 @@ except:
     dataframe = dataframe[["id", "poster_path"]]
     dataframe["poster_path_updated"] = False
 
-updated_poster_paths = update_poster_paths(dataframe=dataframe, runtime_seconds=500)
-updated_poster_paths.to_csv("data/updated_poster_paths.csv", index=False)
+# Progress is saved to config.POSTER_PATHS_PATH as films are validated, so rerunning resumes an interrupted run.
+update_poster_paths(
+    dataframe=dataframe, runtime_seconds=500, checkpoint_path=config.POSTER_PATHS_PATH
+)
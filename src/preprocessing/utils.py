@@ -1,20 +1,28 @@
+from ast import literal_eval
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
 from io import BytesIO
-from typing import Tuple
+from typing import Callable, Iterable, List, Optional, Tuple
 from PIL import Image
+import threading
 import time
 import requests
+import requests.adapters
+from urllib3.util.retry import Retry
 import sys
 import os
 
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-import tmdbsimple as tmdb
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from stage_cache import Stage, get_input_key, run_stages
+from thumbnail_store import add_thumbnails, load_thumbnail_index
 import config
 
-tmdb.API_KEY = config.TMDB_API_KEY
+# Enough of an image to read its header when a server does not answer HEAD requests.
+POSTER_HEADER_BYTES = 64 * 1024
 
 
 def get_director(x):
@@ -37,37 +45,536 @@ def get_list(x):
     return []
 
 
-def assign_poster_path(row: pd.Series) -> Tuple[str, bool]:
-    poster_path = row.poster_path
-    poster_path_updated = True
+# Columns of the raw TMDB files holding Python literals of lists of dicts.
+LITERAL_COLUMNS = ["cast", "crew", "keywords", "genres"]
+
+
+def parse_literal(x) -> list:
+    return literal_eval(x) if isinstance(x, str) else []
+
+
+def parse_film_lists(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Parses a chunk of the raw cast, crew, keywords and genres columns into each film's director and first three
+    cast members, keywords and genres, in one pass over the cells."""
+    return pd.DataFrame(
+        {
+            "cast": [get_list(parse_literal(x)) for x in chunk["cast"].values],
+            "director": [get_director(parse_literal(x)) for x in chunk["crew"].values],
+            "keywords": [get_list(parse_literal(x)) for x in chunk["keywords"].values],
+            "genres": [get_list(parse_literal(x)) for x in chunk["genres"].values],
+        },
+        index=chunk.index,
+    )
+
+
+# Versions of the stages of preprocess_films. Bump one when its code changes, so that its cached output, and those
+# of the stages after it, are rebuilt.
+MERGE_METADATA_VERSION = 1
+PARSE_METADATA_VERSION = 1
+
+
+def load_raw_metadata(credits_path: str, keywords_path: str, metadata_path: str) -> pd.DataFrame:
+    """Merges the raw TMDB metadata, credits and keywords."""
+    credits = pd.read_csv(credits_path)
+    keywords = pd.read_csv(keywords_path)
+    metadata = pd.read_csv(metadata_path, low_memory=False)
+
+    # Remove rows with bad IDs, a few of which hold dates.
+    metadata = metadata[pd.to_numeric(metadata["id"], errors="coerce").notna()]
+
+    # Convert IDs to int. Required for merging
+    keywords["id"] = keywords["id"].astype("int")
+    credits["id"] = credits["id"].astype("int")
+    metadata["id"] = metadata["id"].astype("int")
+
+    metadata = metadata.merge(credits, on="id")
+    return metadata.merge(keywords, on="id")
+
+
+def merge_poster_paths(metadata: pd.DataFrame, poster_paths_path: str) -> pd.DataFrame:
+    """Replaces the raw poster paths with the validated ones, see update_poster_paths."""
+    updated_poster_paths = pd.read_csv(poster_paths_path)
+    metadata = metadata.drop(["poster_path"], axis=1)
+    return metadata.merge(updated_poster_paths, on="id")
+
+
+def parse_metadata(
+    metadata: pd.DataFrame,
+    n_jobs: Optional[int] = config.PREPROCESSING_N_JOBS,
+    chunk_size: int = config.PREPROCESSING_CHUNK_SIZE,
+) -> pd.DataFrame:
+    """Replaces the raw cast, crew, keywords and genres columns with the director and lists of names.
+
+    Args:
+        metadata (pd.DataFrame): Merged raw metadata, see load_raw_metadata.
+        n_jobs (Optional[int]): Number of worker processes, None uses every core and 1 runs in this process.
+        chunk_size (int): Number of films parsed per task.
+
+    Returns:
+        pd.DataFrame: metadata with cast, keywords and genres as lists of up to three names and a director column.
+    """
+    chunks = [
+        metadata[LITERAL_COLUMNS].iloc[start : start + chunk_size]
+        for start in range(0, len(metadata), chunk_size)
+    ]
+    if n_jobs == 1:
+        parsed = list(map(parse_film_lists, chunks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parsed = list(executor.map(parse_film_lists, chunks))
+    parsed = pd.concat(parsed) if parsed else parse_film_lists(metadata[LITERAL_COLUMNS])
+    metadata = metadata.drop(LITERAL_COLUMNS, axis=1)
+    for column in parsed:
+        metadata[column] = parsed[column].values
+    return metadata
+
+
+def weighted_rating(vote_count, vote_average, m: int, C: float):
+    """Rates films accounting for the the number of votes and the scores of the votes.
+
+    Args:
+        vote_count: Number of votes of each film.
+        vote_average: Mean vote of each film.
+        m (int): 90th percentile of number of votes
+        C (float): Mean vote score
+
+    Returns:
+        Weighted rating of each film.
+    """
+    return (vote_count / (vote_count + m) * vote_average) + (m / (m + vote_count) * C)
+
+
+def select_films(
+    metadata: pd.DataFrame,
+    m: int = config.m,
+    C: float = config.C,
+    exclude_languages: List[str] = config.EXCLUDE_LANGUAGES,
+    min_film_date: str = config.MIN_FILM_DATE,
+    num_films: int = config.NUM_FILMS_TO_KEEP,
+) -> pd.DataFrame:
+    """Keeps the num_films films with the highest sum of standardised weighted rating and popularity.
+
+    Args:
+        metadata (pd.DataFrame): Parsed metadata, see parse_metadata.
+        m (int): 90th percentile of number of votes
+        C (float): Mean vote score
+        exclude_languages (List[str]): Original languages of films to drop.
+        min_film_date (str): Films released on or before this date are dropped.
+        num_films (int): Number of films to keep.
+
+    Returns:
+        pd.DataFrame: Films with config.USEFUL_COLUMNS and imdb_score, best first.
+    """
+    film_features = metadata[config.USEFUL_COLUMNS]
+    film_features = film_features.drop_duplicates(subset="id", keep="first")
+    imdb_score = weighted_rating(
+        film_features["vote_count"].values, film_features["vote_average"].values, m, C
+    )
+    film_features = film_features.assign(
+        imdb_score=imdb_score, popularity=film_features["popularity"].astype("float32")
+    )
+
+    # Scores are standardised over every film before any are filtered out.
+    popularity = film_features["popularity"]
+    overall_score = (imdb_score - imdb_score.mean()) / imdb_score.std(ddof=1) + (
+        popularity - popularity.mean()
+    ) / popularity.std()
+    keep = (
+        ~film_features["original_language"].isin(exclude_languages)
+        & film_features["poster_path_updated"].fillna(False).astype(bool)
+        & (film_features["release_date"] > min_film_date)
+    )
+    order = np.argsort(-overall_score[keep].values, kind="stable")[:num_films]
+    film_features = film_features[keep].iloc[order]
+
+    assert len(film_features) == film_features.id.nunique(), "Contains duplicate film"
+    return film_features
+
+
+def preprocess_films(
+    credits_path: str = config.RAW_CREDITS_PATH,
+    keywords_path: str = config.RAW_KEYWORDS_PATH,
+    metadata_path: str = config.RAW_METADATA_PATH,
+    poster_paths_path: str = config.POSTER_PATHS_PATH,
+    n_jobs: Optional[int] = config.PREPROCESSING_N_JOBS,
+    cache_path: str = config.STAGE_CACHE_PATH,
+) -> pd.DataFrame:
+    """Builds the film catalogue from the raw TMDB files, reusing each stage's cached output if its inputs and
+    parameters are unchanged.
+
+    The raw files are merged and parsed before the poster paths are merged in, so updating the poster paths reuses
+    the parsed metadata.
+
+    Args:
+        credits_path (str): Raw credits csv.
+        keywords_path (str): Raw keywords csv.
+        metadata_path (str): Raw movies metadata csv.
+        poster_paths_path (str): Validated poster paths csv, see update_poster_paths.
+        n_jobs (Optional[int]): Number of processes parsing the raw lists, None uses every core.
+        cache_path (str): Directory of the cached stage outputs.
+
+    Returns:
+        pd.DataFrame: The film catalogue, best films first.
+    """
+    paths = [credits_path, keywords_path, metadata_path]
+    selection = {
+        "m": config.m,
+        "C": config.C,
+        "exclude_languages": config.EXCLUDE_LANGUAGES,
+        "min_film_date": config.MIN_FILM_DATE,
+        "num_films": config.NUM_FILMS_TO_KEEP,
+    }
+    stages = [
+        Stage(
+            "merge_metadata",
+            lambda _: load_raw_metadata(*paths),
+            params={"version": MERGE_METADATA_VERSION},
+        ),
+        Stage(
+            "parse_metadata",
+            lambda metadata: parse_metadata(metadata, n_jobs=n_jobs),
+            params={"version": PARSE_METADATA_VERSION},
+        ),
+        Stage(
+            "merge_poster_paths",
+            lambda metadata: merge_poster_paths(metadata, poster_paths_path),
+            inputs=[poster_paths_path],
+        ),
+        Stage(
+            "select_films",
+            lambda metadata: select_films(metadata, **selection),
+            params={**selection, "columns": config.USEFUL_COLUMNS},
+        ),
+    ]
+    return run_stages(stages, get_input_key(paths), path=cache_path)
+
+
+class RateLimiter:
+    """Spaces out calls to wait() across threads so they happen at most requests_per_second times a second."""
+
+    def __init__(self, requests_per_second: Optional[float]):
+        self.interval = 1 / requests_per_second if requests_per_second else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_seconds = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+def get_session(max_connections: int) -> requests.Session:
+    """Session that keeps up to max_connections connections per host open for reuse and retries failed requests."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=max_connections,
+        pool_maxsize=max_connections,
+        # Rate limiting and server errors are retried with backoff, other responses are returned as they are.
+        max_retries=Retry(
+            total=config.POSTER_REQUEST_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def is_poster_available(
+    session: requests.Session, url: str, rate_limiter: RateLimiter, timeout: float
+) -> bool:
+    """Checks that a URL serves an image, downloading as little of it as possible.
+
+    A HEAD request settles most posters. If the server does not answer it with an image, only the first
+    POSTER_HEADER_BYTES are requested and decoded. Servers that ignore the range send the whole image instead.
+    """
+    rate_limiter.wait()
+    response = session.head(url, timeout=timeout, allow_redirects=True)
+    if response.status_code in (404, 410):
+        return False
+    if response.ok and response.headers.get("Content-Type", "").startswith("image/"):
+        return True
+
+    rate_limiter.wait()
+    response = session.get(
+        url, headers={"Range": f"bytes=0-{POSTER_HEADER_BYTES - 1}"}, timeout=timeout
+    )
+    if not response.ok:
+        return False
     try:
-        response = requests.get(config.POSTER_BASE_URL + poster_path)
         Image.open(BytesIO(response.content))
-    except:
-        try:
-            movie = tmdb.Movies(int(row.id))
-            response = movie.info()
-            poster_path = movie.poster_path
-        except Exception as e:
-            print(e)
-            poster_path_updated = False
-    return poster_path, poster_path_updated
+    except OSError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def get_tmdb_api_key() -> str:
+    """Reads the TMDB API key on the first lookup, so that nothing else needs it.
+
+    The key is read from the Streamlit secrets if they have it, else from the environment.
+    """
+    import streamlit as st
+
+    try:
+        api_key = st.secrets[config.TMDB_API_KEY_NAME]
+    except (FileNotFoundError, KeyError):
+        api_key = os.environ.get(config.TMDB_API_KEY_NAME)
+    if api_key is None:
+        raise KeyError(
+            f"Set {config.TMDB_API_KEY_NAME} in .streamlit/secrets.toml or the environment to look films up "
+            "on TMDB"
+        )
+    return api_key
+
+
+def get_tmdb_poster_path(
+    film_id: int,
+    session: requests.Session,
+    api_url: str = config.TMDB_API_URL,
+    timeout: float = config.POSTER_REQUEST_TIMEOUT,
+) -> Optional[str]:
+    """Looks a film up on TMDB through the shared session, so lookups reuse its connections and retries."""
+    response = session.get(
+        f"{api_url}/movie/{film_id}", params={"api_key": get_tmdb_api_key()}, timeout=timeout
+    )
+    response.raise_for_status()
+    return response.json().get("poster_path")
+
+
+def assign_poster_path(
+    film_id: int,
+    poster_path: Optional[str],
+    session: requests.Session,
+    rate_limiter: RateLimiter,
+    base_url: str,
+    timeout: float,
+    find_poster_path: Callable[[int], Optional[str]],
+) -> Tuple[Optional[str], bool]:
+    """Keeps the film's poster path if the poster exists, otherwise looks up a new one.
+
+    Returns:
+        Tuple[Optional[str], bool]: Poster path and whether it has been validated.
+    """
+    try:
+        if isinstance(poster_path, str) and is_poster_available(
+            session, base_url + poster_path, rate_limiter, timeout
+        ):
+            return poster_path, True
+    except requests.RequestException as e:
+        print(e)
+    try:
+        rate_limiter.wait()
+        new_poster_path = find_poster_path(film_id)
+    except Exception as e:
+        print(e)
+        return poster_path, False
+    if new_poster_path is None:
+        return poster_path, False
+    return new_poster_path, True
 
 
-def update_poster_paths(dataframe: pd.DataFrame, runtime_seconds: int) -> pd.DataFrame:
-    films_updated = dataframe[dataframe["poster_path_updated"]]
+def save_poster_paths(dataframe: pd.DataFrame, path: str):
+    tmp_path = path + ".tmp"
+    dataframe.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def update_poster_paths(
+    dataframe: pd.DataFrame,
+    runtime_seconds: int,
+    checkpoint_path: Optional[str] = None,
+    n_workers: int = config.POSTER_VALIDATION_WORKERS,
+    requests_per_second: Optional[float] = config.POSTER_REQUESTS_PER_SECOND,
+    checkpoint_every: int = config.POSTER_CHECKPOINT_EVERY,
+    base_url: str = config.POSTER_BASE_URL,
+    timeout: float = config.POSTER_REQUEST_TIMEOUT,
+    find_poster_path: Optional[Callable[[int], Optional[str]]] = None,
+) -> pd.DataFrame:
+    """Validates the poster path of every film not yet marked as updated, across a pool of threads.
+
+    The threads share one connection pool and one rate limit, which also covers TMDB lookups. No new films are
+    started after runtime_seconds. Results are written to checkpoint_path every checkpoint_every films and when
+    the run ends or is interrupted, so passing the checkpoint back in resumes where the run stopped.
+
+    Args:
+        dataframe (pd.DataFrame): Films with id, poster_path and poster_path_updated columns.
+        runtime_seconds (int): Time after which no more films are validated.
+        checkpoint_path (Optional[str]): CSV file to save progress to, or None to not checkpoint.
+        n_workers (int): Number of threads making requests.
+        requests_per_second (Optional[float]): Limit on requests across all threads, None for no limit.
+        checkpoint_every (int): Number of films validated between checkpoints.
+        base_url (str): URL that poster paths are relative to.
+        timeout (float): Seconds to wait for each response.
+        find_poster_path (Optional[Callable[[int], Optional[str]]]): Looks up a new poster path from a film id, by
+            default on TMDB through the shared session.
+
+    Returns:
+        pd.DataFrame: Copy of dataframe with validated poster paths.
+    """
+    dataframe = dataframe.copy()
     films_not_updated = dataframe[~dataframe["poster_path_updated"]]
+    rows = films_not_updated.itertuples()
+    session = get_session(n_workers)
+    if find_poster_path is None:
+        find_poster_path = partial(get_tmdb_poster_path, session=session, timeout=timeout)
+    rate_limiter = RateLimiter(requests_per_second)
+    deadline = time.time() + runtime_seconds
+    num_validated = 0
 
-    with tqdm(total=films_not_updated.shape[0]) as pbar:
-        start = time.time()
-        for row in films_not_updated.itertuples():
-            if time.time() <= start + runtime_seconds:
-                pbar.update(1)
-                (
-                    films_not_updated.at[row.Index, "poster_path"],
-                    films_not_updated.at[row.Index, "poster_path_updated"],
-                ) = assign_poster_path(row)
-            else:
-                break
-    dataframe = pd.concat([films_updated, films_not_updated])
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, tqdm(
+        total=films_not_updated.shape[0]
+    ) as pbar:
+        in_flight = {}
+        try:
+            while True:
+                # Submit a few films ahead of the workers rather than all of them, so the deadline is respected.
+                while len(in_flight) < 2 * n_workers and time.time() <= deadline:
+                    row = next(rows, None)
+                    if row is None:
+                        break
+                    future = executor.submit(
+                        assign_poster_path,
+                        int(row.id),
+                        row.poster_path,
+                        session,
+                        rate_limiter,
+                        base_url,
+                        timeout,
+                        find_poster_path,
+                    )
+                    in_flight[future] = row.Index
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = in_flight.pop(future)
+                    (
+                        dataframe.at[index, "poster_path"],
+                        dataframe.at[index, "poster_path_updated"],
+                    ) = future.result()
+                    num_validated += 1
+                    if checkpoint_path is not None and num_validated % checkpoint_every == 0:
+                        save_poster_paths(dataframe, checkpoint_path)
+                pbar.update(len(done))
+        finally:
+            if checkpoint_path is not None:
+                save_poster_paths(dataframe, checkpoint_path)
     return dataframe
+
+
+def make_thumbnail(image: bytes, width: int) -> bytes:
+    """Resizes an encoded image to width, keeping its aspect ratio, and encodes it as config.THUMBNAIL_FORMAT."""
+    image = Image.open(BytesIO(image))
+    # Lets JPEGs be decoded at a reduced scale that is still at least the thumbnail size.
+    image.draft("RGB", (width, width * image.height // image.width))
+    image = image.convert("RGB")
+    height = max(1, round(image.height * width / image.width))
+    thumbnail = BytesIO()
+    image.resize((width, height), Image.LANCZOS).save(
+        thumbnail, format=config.THUMBNAIL_FORMAT, quality=config.THUMBNAIL_QUALITY
+    )
+    return thumbnail.getvalue()
+
+
+def fetch_thumbnail(
+    poster_path: str,
+    session: requests.Session,
+    rate_limiter: RateLimiter,
+    base_url: str,
+    width: int,
+    timeout: float,
+) -> Optional[bytes]:
+    rate_limiter.wait()
+    try:
+        response = session.get(base_url + poster_path, timeout=timeout)
+        response.raise_for_status()
+        return make_thumbnail(response.content, width)
+    except (requests.RequestException, OSError) as e:
+        print(e)
+        return None
+
+
+def cache_thumbnails(
+    poster_paths: Iterable[str],
+    path: str = config.BASE_THUMBNAILS_PATH,
+    width: int = config.IMAGE_WIDTH,
+    n_workers: int = config.POSTER_VALIDATION_WORKERS,
+    requests_per_second: Optional[float] = config.POSTER_REQUESTS_PER_SECOND,
+    batch_size: int = config.POSTER_CHECKPOINT_EVERY,
+    base_url: str = config.POSTER_BASE_URL,
+    timeout: float = config.POSTER_REQUEST_TIMEOUT,
+) -> int:
+    """Fetches each poster not already in the thumbnail cache once and caches a thumbnail of it.
+
+    Posters are fetched and resized on a pool of threads sharing one connection pool and rate limit. Thumbnails are
+    added to the cache every batch_size posters and when the run ends or is interrupted.
+
+    Args:
+        poster_paths (Iterable[str]): Poster paths, missing values and duplicates are skipped.
+        path (str): Directory of the cache.
+        width (int): Width of the thumbnails in pixels.
+        n_workers (int): Number of threads fetching and resizing posters.
+        requests_per_second (Optional[float]): Limit on requests across all threads, None for no limit.
+        batch_size (int): Number of thumbnails written to the cache at a time.
+        base_url (str): URL that poster paths are relative to.
+        timeout (float): Seconds to wait for each response.
+
+    Returns:
+        int: Number of thumbnails added to the cache.
+    """
+    index = load_thumbnail_index(path)
+    cached = index["posters"] if index["width"] == width else {}
+    to_fetch = [
+        poster_path
+        for poster_path in dict.fromkeys(poster_paths)
+        if isinstance(poster_path, str) and poster_path not in cached
+    ]
+    session = get_session(n_workers)
+    rate_limiter = RateLimiter(requests_per_second)
+    thumbnails, num_cached = {}, 0
+
+    poster_paths = iter(to_fetch)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, tqdm(total=len(to_fetch)) as pbar:
+        in_flight = {}
+        try:
+            while True:
+                # Submit a few posters ahead of the workers rather than all of them, so an interrupted run stops
+                # fetching once the posters in flight are done.
+                while len(in_flight) < 2 * n_workers:
+                    poster_path = next(poster_paths, None)
+                    if poster_path is None:
+                        break
+                    future = executor.submit(
+                        fetch_thumbnail,
+                        poster_path,
+                        session,
+                        rate_limiter,
+                        base_url,
+                        width,
+                        timeout,
+                    )
+                    in_flight[future] = poster_path
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    poster_path = in_flight.pop(future)
+                    thumbnail = future.result()
+                    if thumbnail is not None:
+                        thumbnails[poster_path] = thumbnail
+                pbar.update(len(done))
+                if len(thumbnails) >= batch_size:
+                    add_thumbnails(thumbnails, width=width, path=path)
+                    num_cached += len(thumbnails)
+                    thumbnails = {}
+        finally:
+            if thumbnails:
+                add_thumbnails(thumbnails, width=width, path=path)
+                num_cached += len(thumbnails)
+    return num_cached
@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import config
+
+# Profile of the app rerun running in each thread, set by start_rerun_profile.
+_active = threading.local()
+
+
+def get_peak_rss_mb() -> float:
+    """Peak resident memory of this process so far, in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux.
+    return peak_rss / 1e6 if sys.platform == "darwin" else peak_rss / 1e3
+
+
+@contextmanager
+def log_stage(name: str):
+    """Prints the wall time of a block of code and the process's peak RSS once it finishes.
+
+    Args:
+        name (str): Stage name to print.
+    """
+    start = time.perf_counter()
+    yield
+    print(f"{name}: {time.perf_counter() - start:.2f}s, peak RSS {get_peak_rss_mb():.0f} MB")
+
+
+class RerunProfile:
+    """Wall time and net allocations of each stage of one app rerun.
+
+    Stages run inside other stages are named by their path, e.g. "recommend/get_weighted_recommendations".
+    Allocations are traced across the whole process, so they include those of other sessions rerunning at the same
+    time.
+    """
+
+    def __init__(self, session: str):
+        self.session = session
+        self.started_at = time.time()
+        self.stages: List[Dict] = []
+        self.seconds = None
+        self.peak_rss_mb = None
+        self._start = time.perf_counter()
+        self._path: List[str] = []
+
+    def to_record(self) -> Dict:
+        return {
+            "session": self.session,
+            "started_at": self.started_at,
+            "seconds": self.seconds,
+            "peak_rss_mb": self.peak_rss_mb,
+            "stages": self.stages,
+        }
+
+
+def start_rerun_profile(session: str) -> Optional[RerunProfile]:
+    """Starts profiling the stages run by this thread, if config.INSTRUMENTATION_ENABLED.
+
+    Args:
+        session (str): Identifies the app session in the log.
+
+    Returns:
+        Optional[RerunProfile]: The profile to pass to finish_rerun_profile, or None when instrumentation is off.
+    """
+    if not config.INSTRUMENTATION_ENABLED:
+        return None
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _active.profile = RerunProfile(session)
+    return _active.profile
+
+
+def finish_rerun_profile(
+    profile: Optional[RerunProfile], log_path: str = config.INSTRUMENTATION_LOG_PATH
+):
+    """Stops profiling this thread and appends the profile to log_path as a line of JSON."""
+    if profile is None:
+        return
+    _active.profile = None
+    profile.seconds = time.perf_counter() - profile._start
+    profile.peak_rss_mb = get_peak_rss_mb()
+    if os.path.dirname(log_path):
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "a") as f:
+        f.write(json.dumps(profile.to_record()) + "\n")
+
+
+@contextmanager
+def profile_stage(name: str):
+    """Records the wall time and net allocations of a block of code in the rerun profile of this thread, if any."""
+    profile = getattr(_active, "profile", None)
+    if profile is None:
+        yield
+        return
+    profile._path.append(name)
+    stage = {"stage": "/".join(profile._path)}
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage["seconds"] = time.perf_counter() - start
+        stage["allocated_mb"] = (tracemalloc.get_traced_memory()[0] - start_bytes) / 1e6
+        profile._path.pop()
+        profile.stages.append(stage)
+
+
+def profiled(func: Callable) -> Callable:
+    """Records each call of func as a stage named after it. Returns func itself when instrumentation is off."""
+    if not config.INSTRUMENTATION_ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def summarise_rerun_log(log_path: str = config.INSTRUMENTATION_LOG_PATH) -> pd.DataFrame:
+    """Aggregates the stages of every logged rerun into call counts and time and allocation percentiles per stage."""
+    with open(log_path) as f:
+        stages = [stage for line in f for stage in json.loads(line)["stages"]]
+    return (
+        pd.DataFrame(stages)
+        .groupby("stage")
+        .agg(
+            calls=("seconds", "size"),
+            median_seconds=("seconds", "median"),
+            p95_seconds=("seconds", lambda seconds: seconds.quantile(0.95)),
+            total_seconds=("seconds", "sum"),
+            median_allocated_mb=("allocated_mb", "median"),
+        )
+        .sort_values("total_seconds", ascending=False)
+    )
@@ -0,0 +1,89 @@
+import os
+import sys
+from typing import Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix, csr_matrix
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import config
+
+
+def load_ratings_matrix(
+    path: str,
+    film_ids: Iterable[int],
+    chunksize: int = config.RATINGS_CHUNK_SIZE,
+    min_ratings_per_user: int = config.MIN_RATINGS_PER_USER,
+) -> Tuple[csr_matrix, np.ndarray]:
+    """Reads a ratings csv in chunks into a sparse user x film matrix.
+
+    Only the coordinates of ratings for films in film_ids are kept, so memory scales with the number of ratings
+    rather than users x films. A user rating the same film more than once gets their mean rating.
+
+    Args:
+        path (str): Ratings csv with userId, movieId and rating columns.
+        film_ids (Iterable[int]): Film id of each column, ratings for other films are dropped.
+        chunksize (int): Number of csv rows to parse at a time.
+        min_ratings_per_user (int): Users with fewer ratings of the films are dropped.
+
+    Returns:
+        Tuple[csr_matrix, np.ndarray]: float32 ratings matrix and the user id of each row.
+    """
+    film_index = pd.Index(film_ids)
+    users, films, ratings = [], [], []
+    for chunk in pd.read_csv(
+        path,
+        usecols=["userId", "movieId", "rating"],
+        dtype={"userId": "int32", "movieId": "int32", "rating": "float32"},
+        chunksize=chunksize,
+    ):
+        positions = film_index.get_indexer(chunk["movieId"].values)
+        in_films = positions >= 0
+        users.append(chunk["userId"].values[in_films])
+        films.append(positions[in_films].astype("int32"))
+        ratings.append(chunk["rating"].values[in_films])
+    return get_ratings_matrix(
+        np.concatenate(users),
+        np.concatenate(films),
+        np.concatenate(ratings),
+        num_films=len(film_index),
+        min_ratings_per_user=min_ratings_per_user,
+    )
+
+
+def get_ratings_matrix(
+    users: np.ndarray,
+    films: np.ndarray,
+    ratings: np.ndarray,
+    num_films: int,
+    min_ratings_per_user: int = config.MIN_RATINGS_PER_USER,
+) -> Tuple[csr_matrix, np.ndarray]:
+    """Builds the sparse user x film matrix of load_ratings_matrix from one array per column of the ratings.
+
+    Args:
+        users (np.ndarray): User id of each rating.
+        films (np.ndarray): Column of the film of each rating.
+        ratings (np.ndarray): Each rating.
+        num_films (int): Number of columns.
+        min_ratings_per_user (int): Users with fewer ratings are dropped.
+
+    Returns:
+        Tuple[csr_matrix, np.ndarray]: float32 ratings matrix and the user id of each row.
+    """
+    user_ids, user_counts = np.unique(users, return_counts=True)
+    valid_users = user_counts >= min_ratings_per_user
+    user_positions = np.full(len(user_ids), -1, dtype="int32")
+    user_positions[valid_users] = np.arange(valid_users.sum(), dtype="int32")
+    user_positions = user_positions[np.searchsorted(user_ids, users)]
+    is_valid = user_positions >= 0
+    coordinates = (user_positions[is_valid], films[is_valid])
+    shape = (int(valid_users.sum()), num_films)
+
+    # Summing duplicate coordinates then dividing by their count gives the mean rating.
+    totals = coo_matrix((ratings[is_valid], coordinates), shape=shape, dtype="float32").tocsr()
+    counts = coo_matrix(
+        (np.ones(is_valid.sum(), dtype="float32"), coordinates), shape=shape, dtype="float32"
+    ).tocsr()
+    totals.data /= counts.data
+    return totals, user_ids[valid_users]
@@ -0,0 +1,182 @@
+"""Bounded LRU cache of recommendations shared by every session in the process.
+
+The app reruns its script on every widget interaction, so the same liked films and weights are asked for again and
+again. Results are keyed by the model version, the sorted ids of the liked films, the weights quantised to
+config.RECOMMENDATION_WEIGHT_STEP and the number of recommendations, and expire after
+config.RECOMMENDATION_CACHE_TTL_SECONDS.
+"""
+
+from collections import OrderedDict
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from model_registry import Models
+from sharded_recommender import get_sharded_recommendations
+from utils import get_liked_ids, get_neighbour_recommendations, get_weighted_recommendations
+import config
+
+
+class ResultCache:
+    """Least recently used cache bounded by number of entries and their approximate size, with a time to live.
+
+    Args:
+        max_entries (int): Number of entries kept.
+        max_bytes (int): Total size of the entries kept, as estimated by the caller.
+        ttl_seconds (float): Time after which an entry is no longer returned.
+        clock (Callable[[], float]): Source of the current time in seconds.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_bytes: int,
+        ttl_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, value = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                self.num_bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: tuple, size: int):
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (self.clock() + self.ttl_seconds, size, value)
+            self.num_bytes += size
+            while len(self._entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                self.num_bytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self.num_bytes,
+            }
+
+
+recommendation_cache = ResultCache(
+    max_entries=config.RECOMMENDATION_CACHE_MAX_ENTRIES,
+    max_bytes=config.RECOMMENDATION_CACHE_MAX_MB * 10**6,
+    ttl_seconds=config.RECOMMENDATION_CACHE_TTL_SECONDS,
+)
+
+
+def quantise_weights(
+    weights: List[float], step: float = config.RECOMMENDATION_WEIGHT_STEP
+) -> Tuple[int, ...]:
+    return tuple(int(round(weight / step)) for weight in weights)
+
+
+def get_recommendation_key(
+    models: Models,
+    titles: Optional[List[str]],
+    weights: List[float],
+    top_n: int,
+    film_ids: Optional[List[int]] = None,
+) -> Tuple:
+    """Canonical cache key for a request, the same whatever the order of titles or small differences in weights."""
+    liked_ids = np.unique(get_liked_ids(models.data, titles, film_ids))
+    return (models.version, tuple(liked_ids.tolist()), quantise_weights(weights), top_n)
+
+
+def get_cached_recommendations(
+    models: Models,
+    titles: List[str],
+    weights: List[float],
+    top_n: int,
+    cache: ResultCache = recommendation_cache,
+    film_ids: Optional[List[int]] = None,
+) -> List[int]:
+    """Recommends films from the shards, dense similarity matrices or neighbour graphs of models, reusing cached
+    results.
+
+    Recommendations are computed from the liked ids and quantised weights of the key, so a cached result is exactly
+    what would be computed. A film liked more than once counts once.
+
+    Args:
+        models (Models): Models to recommend from, see model_registry.get_models.
+        titles (List[str]): Titles of the films the user likes.
+        weights (List[float]): Weighting of each similarity source.
+        top_n (int): Number of films to recommend.
+        cache (ResultCache): Cache to look up and store results in.
+        film_ids (Optional[List[int]]): Ids of the films the user likes, used instead of titles.
+
+    Returns:
+        List[int]: Ids of the recommended films, most similar first.
+    """
+    key = get_recommendation_key(models, titles, weights, top_n, film_ids)
+    recommendations = cache.get(key)
+    if recommendations is not None:
+        return list(recommendations)
+
+    liked_ids = list(key[1])
+    weights = [step * config.RECOMMENDATION_WEIGHT_STEP for step in key[2]]
+    if models.shards is not None:
+        recommendations = get_sharded_recommendations(
+            films=models.data,
+            titles=None,
+            transport=models.shards,
+            weights=weights,
+            top_n=top_n,
+            film_ids=liked_ids,
+        )
+    elif models.similarity_matrices is not None:
+        recommendations = get_weighted_recommendations(
+            films=models.data,
+            titles=None,
+            similarity_matrices=models.similarity_matrices,
+            weights=weights,
+            top_n=top_n,
+            film_ids=liked_ids,
+        )
+    else:
+        recommendations = get_neighbour_recommendations(
+            films=models.data,
+            titles=None,
+            neighbour_graphs=models.neighbour_graphs,
+            ids=models.neighbour_ids,
+            weights=weights,
+            top_n=top_n,
+            film_ids=liked_ids,
+        )
+    size = sys.getsizeof(recommendations) + sum(
+        sys.getsizeof(film_id) for film_id in recommendations
+    )
+    cache.put(key, tuple(recommendations), size)
+    return recommendations
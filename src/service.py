@@ -0,0 +1,247 @@
+"""Recommendation service over HTTP, independent of the Streamlit app.
+
+Usage:
+    python src/service.py --port 8000 --workers 4
+
+Endpoints, all GET and answering JSON:
+    /recommend?id=14160&id=949&weights=0.5,0.5,0.5,0.5,1&top_n=20
+    /recommend?title=Up&title=Heat     # a title liked this way likes every film with that title
+    /top-films?cast=Tom Hanks&director=...&genres=Drama&limit=20
+    /filters
+    /metrics
+    /health
+
+Each worker is a forked process that loads the models once through model_registry. The similarity artifacts are
+memory mapped, so every worker shares the same pages of them. /metrics reports the latency of each endpoint as seen
+by the worker that answers it. Invalid requests are answered with 400 and unexpected failures with 500, and both
+count as errors.
+"""
+
+import argparse
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from model_registry import Models, get_models
+from recommendation_cache import get_cached_recommendations, recommendation_cache
+from utils import apply_filters, get_films_by_id, get_filter_values, get_liked_ids
+import config
+
+FILM_FIELDS = [
+    "id",
+    "title",
+    "release_date",
+    "vote_average",
+    "director",
+    "cast",
+    "genres",
+    "poster_path",
+]
+
+
+class LatencyMetrics:
+    """Counts requests and errors per endpoint and keeps their most recent latencies for percentiles."""
+
+    def __init__(self, window: int = config.SERVICE_LATENCY_WINDOW):
+        self.window = window
+        self._latencies = {}
+        self._counts = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float, error: bool):
+        with self._lock:
+            if endpoint not in self._latencies:
+                self._latencies[endpoint] = deque(maxlen=self.window)
+                self._counts[endpoint] = 0
+                self._errors[endpoint] = 0
+            self._latencies[endpoint].append(seconds)
+            self._counts[endpoint] += 1
+            self._errors[endpoint] += error
+
+    def get_summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            summary = {}
+            for endpoint, latencies in self._latencies.items():
+                latencies_ms = np.array(latencies) * 1000
+                p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+                summary[endpoint] = {
+                    "count": self._counts[endpoint],
+                    "errors": self._errors[endpoint],
+                    "mean_ms": float(latencies_ms.mean()),
+                    "p50_ms": float(p50),
+                    "p95_ms": float(p95),
+                    "p99_ms": float(p99),
+                    "max_ms": float(latencies_ms.max()),
+                }
+            return summary
+
+
+metrics = LatencyMetrics()
+
+
+def get_film_records(films: pd.DataFrame) -> List[Dict]:
+    """Films as JSON serialisable dicts, with None for missing values."""
+    fields = films[FILM_FIELDS].astype(object)
+    fields = fields.where(fields.notna(), None)
+    return [
+        dict(zip(FILM_FIELDS, values)) for values in zip(*(fields[f].tolist() for f in FILM_FIELDS))
+    ]
+
+
+def recommend(models: Models, params: Dict[str, List[str]]) -> Dict:
+    film_ids = [int(film_id) for film_id in params.get("id", [])]
+    titles = params.get("title", [])
+    if not film_ids and not titles:
+        raise ValueError("Give at least one liked film as id=... or title=...")
+    unknown_ids = set(film_ids) - set(models.data.id[models.data.id.isin(film_ids)])
+    if unknown_ids:
+        raise ValueError(f"Unknown ids: {sorted(unknown_ids)}")
+    unknown_titles = set(titles) - set(models.data.title[models.data.title.isin(titles)])
+    if unknown_titles:
+        raise ValueError(f"Unknown titles: {sorted(unknown_titles)}")
+    default_weights = [config.PARAMETER_CONTROL_DEFAULT] * len(config.SIMILARITY_SOURCES)
+    weights = (
+        [float(w) for w in params["weights"][0].split(",")]
+        if "weights" in params
+        else default_weights
+    )
+    if len(weights) != len(config.SIMILARITY_SOURCES) or sum(weights) <= 0:
+        raise ValueError(
+            f"weights must be {len(config.SIMILARITY_SOURCES)} numbers adding up to more than 0"
+        )
+    top_n = int(params.get("top_n", [config.POSTERS_PER_ROW * config.NUM_POSTER_ROWS])[0])
+
+    liked_ids = film_ids + get_liked_ids(models.data, titles).tolist()
+    recommendations = get_cached_recommendations(
+        models, titles=None, weights=weights, top_n=top_n, film_ids=liked_ids
+    )
+    return {"films": get_film_records(get_films_by_id(models.data, recommendations))}
+
+
+def top_films(models: Models, params: Dict[str, List[str]]) -> Dict:
+    films = apply_filters(
+        data=models.data,
+        filter_index=models.filter_index,
+        cast=params.get("cast", []),
+        director=params.get("director", []),
+        genres=params.get("genres", []),
+    )
+    films = films.loc[films["vote_count"] >= config.m]
+    limit = int(params.get("limit", [config.POSTERS_PER_ROW * config.NUM_POSTER_ROWS])[0])
+    return {"films": get_film_records(films.head(limit))}
+
+
+def filters(models: Models, params: Dict[str, List[str]]) -> Dict:
+    cast, director, genres = get_filter_values(models.filter_index)
+    return {"cast": cast, "director": director, "genres": genres}
+
+
+def get_metrics(models: Models, params: Dict[str, List[str]]) -> Dict:
+    return {
+        "pid": os.getpid(),
+        "endpoints": metrics.get_summary(),
+        "recommendation_cache": recommendation_cache.get_stats(),
+    }
+
+
+def health(models: Models, params: Dict[str, List[str]]) -> Dict:
+    return {"status": "ok", "films": len(models.data)}
+
+
+ENDPOINTS: Dict[str, Callable[[Models, Dict[str, List[str]]], Dict]] = {
+    "/recommend": recommend,
+    "/top-films": top_films,
+    "/filters": filters,
+    "/metrics": get_metrics,
+    "/health": health,
+}
+
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        endpoint = ENDPOINTS.get(url.path)
+        if endpoint is None:
+            self.send_json(404, {"error": f"Unknown endpoint {url.path}"})
+            return
+        try:
+            status, body = 200, endpoint(get_models(), parse_qs(url.query))
+        except ValueError as e:
+            status, body = 400, {"error": str(e)}
+        except Exception:
+            traceback.print_exc()
+            status, body = 500, {"error": "Internal error, see the service log"}
+        self.send_json(status, body)
+        metrics.record(url.path, time.perf_counter() - start, error=status != 200)
+
+    def send_json(self, status: int, body: Dict):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(host: str = config.SERVICE_HOST, port: int = config.SERVICE_PORT, workers: int = 1):
+    """Serves the endpoints on host and port until interrupted.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        workers (int): Number of processes accepting connections on the shared socket. Each is forked from this
+            process after the socket is bound and loads its own models.
+    """
+    server = ThreadingHTTPServer((host, port), RecommendationHandler)
+    print(f"Serving on http://{host}:{server.server_port} with {workers} workers")
+    if workers == 1:
+        get_models()
+        server.serve_forever()
+        return
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                get_models()
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default=config.SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=config.SERVICE_WORKERS)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""Recommends films by scoring the catalogue in shards, each owned by its own worker.
+
+Usage:
+    python src/sharded_recommender.py --num-shards 4   # split the trained similarity sources into shards
+
+Shard s owns a contiguous block J of films and stores, for every similarity source, the columns J of the matrix as
+an N x |J| array. As the matrices are symmetric, a liked film's similarity to every film in J is then one contiguous
+row. For a query each shard averages the liked films' rows with the source weights, exactly as
+get_weighted_recommendations does, and returns its local top N. The coordinator merges these into the global top N,
+in the same order as get_weighted_recommendations and get_recommended_ids.
+
+Shards are reached through a ShardTransport, whose query(liked_positions, weights, top_n) method returns each shard's
+positions and scores. LocalShardTransport runs every shard in its own process on this machine and
+InProcessShardTransport scores them in the calling process.
+
+The shards record the similarity files they were written from, so load_shards refuses shards left over from an
+earlier training run. With config.SHARDED_RECOMMENDATIONS, model_registry loads them to recommend from over the
+transport set by config.SHARD_TRANSPORT.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from similarity_store import load_manifest
+from utils import (
+    get_liked_ids,
+    get_similarity_rows,
+    get_top_n_indices,
+    load_similarity_matrices,
+)
+import config
+
+SHARD_MANIFEST = "shards.json"
+
+
+def get_shard_bounds(num_films: int, num_shards: int) -> List[Tuple[int, int]]:
+    """Splits num_films positions into num_shards contiguous blocks of near equal size."""
+    edges = np.linspace(0, num_films, num_shards + 1).round().astype(int)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def write_shards(
+    num_shards: int = config.NUM_SHARDS,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+    shard_path: str = config.SHARD_PATH,
+    block_size: int = config.SIMILARITY_BLOCK_SIZE,
+):
+    """Splits the dense or packed similarity matrices into the column blocks owned by each shard.
+
+    The matrices are read once, block_size rows at a time.
+
+    Args:
+        num_shards (int): Number of shards.
+        similarity_path (str): Directory containing the similarity artifacts.
+        shard_path (str): Directory to write the shards to.
+        block_size (int): Number of rows copied at a time.
+    """
+    similarity_matrices = list(load_similarity_matrices(similarity_path))
+    ids = similarity_matrices[0].index
+    bounds = get_shard_bounds(len(ids), num_shards)
+    os.makedirs(shard_path, exist_ok=True)
+    outputs = {}
+    for shard, (start, end) in enumerate(bounds):
+        for name in config.SIMILARITY_SOURCES:
+            outputs[shard, name] = np.lib.format.open_memmap(
+                get_shard_file(shard, name, shard_path) + ".tmp",
+                mode="w+",
+                dtype="float32",
+                shape=(len(ids), end - start),
+            )
+    for row in range(0, len(ids), block_size):
+        positions = np.arange(row, min(row + block_size, len(ids)))
+        for name, similarity in zip(config.SIMILARITY_SOURCES, similarity_matrices):
+            rows = get_similarity_rows(similarity, similarity.index.get_indexer(ids[positions]))
+            if not similarity.columns.equals(ids):
+                rows = rows[:, similarity.columns.get_indexer(ids)]
+            for shard, (start, end) in enumerate(bounds):
+                outputs[shard, name][positions[0] : positions[-1] + 1] = rows[:, start:end]
+    for (shard, name), output in outputs.items():
+        output.flush()
+        del output
+        os.replace(
+            get_shard_file(shard, name, shard_path) + ".tmp",
+            get_shard_file(shard, name, shard_path),
+        )
+    del outputs
+
+    np.save(os.path.join(shard_path, "ids.npy"), np.asarray(ids, dtype="int64"))
+    manifest_path = os.path.join(shard_path, SHARD_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(
+            {
+                "bounds": bounds,
+                "sources": config.SIMILARITY_SOURCES,
+                "similarity_files": get_similarity_files(similarity_path),
+            },
+            f,
+            indent=2,
+        )
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def get_similarity_files(similarity_path: str = config.BASE_SIMILARITY_PATH) -> dict:
+    """Matrix file of each similarity source, which is renamed whenever the source is rewritten."""
+    sources = load_manifest(similarity_path)["sources"]
+    return {name: sources.get(name, {}).get("matrix") for name in config.SIMILARITY_SOURCES}
+
+
+def get_shard_file(shard: int, name: str, shard_path: str = config.SHARD_PATH) -> str:
+    return os.path.join(shard_path, f"shard_{shard}_{name}.npy")
+
+
+def load_shard_manifest(
+    shard_path: str = config.SHARD_PATH,
+) -> Tuple[List[Tuple[int, int]], pd.Index]:
+    """Reads the film positions owned by each shard and the film ids of every position."""
+    with open(os.path.join(shard_path, SHARD_MANIFEST)) as f:
+        bounds = [tuple(bound) for bound in json.load(f)["bounds"]]
+    return bounds, pd.Index(np.load(os.path.join(shard_path, "ids.npy")), name="id")
+
+
+class Shard:
+    """Memory maps one shard's columns of every similarity source and scores its films."""
+
+    def __init__(self, shard: int, shard_path: str = config.SHARD_PATH):
+        bounds, _ = load_shard_manifest(shard_path)
+        self.start, self.end = bounds[shard]
+        self.columns = [
+            np.load(get_shard_file(shard, name, shard_path), mmap_mode="r")
+            for name in config.SIMILARITY_SOURCES
+        ]
+
+    def score(
+        self, liked_positions: np.ndarray, weights: List[float], top_n: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds the top_n films of the shard by their weighted mean similarity to the liked films.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Positions in the whole catalogue of the shard's top films, most similar
+                first, and their scores.
+        """
+        rows = [np.asarray(columns[liked_positions], dtype="float32") for columns in self.columns]
+        scores = np.average(np.array(rows), axis=0, weights=weights).mean(axis=0)
+        candidates = np.flatnonzero(
+            ~np.isin(
+                np.arange(self.start, self.end), np.unique(liked_positions), assume_unique=True
+            )
+        )
+        top = candidates[get_top_n_indices(scores[candidates], top_n)]
+        return top + self.start, scores[top]
+
+
+def merge_shard_results(
+    results: List[Tuple[np.ndarray, np.ndarray]], top_n: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merges the top films of each shard into the overall top_n, ordered by score and then position."""
+    positions = np.concatenate([positions for positions, _ in results])
+    scores = np.concatenate([scores for _, scores in results])
+    order = np.lexsort((positions, -scores))[:top_n]
+    return positions[order], scores[order]
+
+
+class ShardTransport:
+    """Reaches the shards written to shard_path. ids holds the film id of every position in the catalogue."""
+
+    def __init__(self, shard_path: str = config.SHARD_PATH):
+        self.shard_path = shard_path
+        self.bounds, self.ids = load_shard_manifest(shard_path)
+
+    def query(
+        self, liked_positions: np.ndarray, weights: List[float], top_n: int
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Scores the liked films in every shard, returning each shard's top positions and scores."""
+        raise NotImplementedError
+
+    def get_mapped_bytes(self) -> int:
+        """Size of the shard files memory mapped to answer queries, in this process or its workers."""
+        return sum(
+            os.path.getsize(get_shard_file(shard, name, self.shard_path))
+            for shard in range(len(self.bounds))
+            for name in config.SIMILARITY_SOURCES
+        )
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class InProcessShardTransport(ShardTransport):
+    """Scores every shard in the calling process, one after another."""
+
+    def __init__(self, shard_path: str = config.SHARD_PATH):
+        super().__init__(shard_path)
+        self.shards = [Shard(shard, shard_path) for shard in range(len(self.bounds))]
+
+    def query(
+        self, liked_positions: np.ndarray, weights: List[float], top_n: int
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        return [shard.score(liked_positions, weights, top_n) for shard in self.shards]
+
+
+def _serve_shard(shard: int, shard_path: str, connection):
+    shard = Shard(shard, shard_path)
+    while True:
+        request = connection.recv()
+        if request is None:
+            return
+        try:
+            connection.send(shard.score(*request))
+        except Exception as e:
+            connection.send(e)
+
+
+class LocalShardTransport(ShardTransport):
+    """Runs every shard in its own process, which memory maps only that shard, and queries them over pipes.
+
+    Every shard scores a query at the same time and the calling process only merges their results. Queries from
+    different threads take turns, as they share the pipes.
+    """
+
+    def __init__(self, shard_path: str = config.SHARD_PATH):
+        super().__init__(shard_path)
+        self._lock = threading.Lock()
+        self.connections = []
+        self.processes = []
+        for shard in range(len(self.bounds)):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_serve_shard, args=(shard, shard_path, worker_connection), daemon=True
+            )
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def query(
+        self, liked_positions: np.ndarray, weights: List[float], top_n: int
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        with self._lock:
+            if not self.connections:
+                raise RuntimeError("The shard transport is closed")
+            for connection in self.connections:
+                connection.send((liked_positions, weights, top_n))
+            results = [connection.recv() for connection in self.connections]
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def close(self):
+        with self._lock:
+            for connection in self.connections:
+                connection.send(None)
+            for process in self.processes:
+                process.join()
+            self.connections, self.processes = [], []
+
+
+SHARD_TRANSPORTS = {"local": LocalShardTransport, "in_process": InProcessShardTransport}
+
+
+def load_shards(
+    similarity_ids: pd.Index,
+    shard_path: str = config.SHARD_PATH,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+    transport: str = config.SHARD_TRANSPORT,
+) -> ShardTransport:
+    """Opens a transport to the shards, checking they were written from the current sources.
+
+    Args:
+        similarity_ids (pd.Index): Film ids of the similarity sources being served.
+        shard_path (str): Directory of the shards.
+        similarity_path (str): Directory containing the similarity artifacts.
+        transport (str): "local" to score each shard in its own process, or "in_process" to score them all in this
+            one, see SHARD_TRANSPORTS.
+
+    Returns:
+        ShardTransport: Transport to the shards, to be closed once no longer used.
+
+    Raises:
+        ValueError: If the shards were written from other similarity artifacts or films.
+    """
+    if transport not in SHARD_TRANSPORTS:
+        raise ValueError(f"Expected a shard transport in {list(SHARD_TRANSPORTS)}, got {transport}")
+    with open(os.path.join(shard_path, SHARD_MANIFEST)) as f:
+        similarity_files = json.load(f).get("similarity_files")
+    _, ids = load_shard_manifest(shard_path)
+    if similarity_files != get_similarity_files(similarity_path) or not ids.equals(
+        pd.Index(similarity_ids)
+    ):
+        raise ValueError(
+            f"The shards in {shard_path} are out of date, rerun sharded_recommender.py"
+        )
+    return SHARD_TRANSPORTS[transport](shard_path)
+
+
+def get_sharded_recommendations(
+    films: pd.DataFrame,
+    titles: list,
+    transport: ShardTransport,
+    weights: list,
+    top_n: int,
+    film_ids: Optional[list] = None,
+):
+    """Recommends films by merging the top films of every shard.
+
+    Gives the same recommendations as get_weighted_recommendations over the sources the shards were written from.
+
+    Args:
+        films (pd.DataFrame): Films dataframe.
+        titles (list): Titles of the films the user likes.
+        transport (ShardTransport): Transport to the shards, e.g. LocalShardTransport.
+        weights (list): Weighting of each similarity source.
+        top_n (int): Number of recommendations to return.
+        film_ids (Optional[list]): Ids of the films the user likes, used instead of titles, see get_liked_ids.
+
+    Returns:
+        list: Ids of the recommended films, most similar first.
+    """
+    film_indices = get_liked_ids(films, titles, film_ids)
+    liked_positions = transport.ids.get_indexer(film_indices)
+    if (liked_positions < 0).any():
+        raise KeyError(f"Films {film_indices[liked_positions < 0]} are missing from the shards")
+    positions, _ = merge_shard_results(
+        transport.query(liked_positions, list(weights), top_n), top_n
+    )
+    return transport.ids.values[positions].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--num-shards", type=int, default=config.NUM_SHARDS)
+    args = parser.parse_args()
+    write_shards(num_shards=args.num_shards)
+    print(f"Wrote {args.num_shards} shards to {config.SHARD_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import os
+import sys
+from typing import Iterable, Optional, Tuple, Union
+
+import numpy as np
+from scipy.sparse import spmatrix
+from sklearn.preprocessing import normalize
+from sklearn.utils.extmath import safe_sparse_dot
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from similarity_store import (
+    concatenate_top_k_blocks,
+    get_block_top_k,
+    get_similarity_matrix_path,
+    load_manifest,
+    load_neighbour_graph,
+    load_similarity_ids,
+    load_packed_similarity_matrix,
+    load_similarity_matrix,
+    pack_similarity_matrix,
+    register_similarity_matrix,
+    save_neighbour_graph,
+)
+import config
+
+# Set once per worker process by _init_worker so the features are not sent with every block.
+_features = None
+_output_path = None
+
+
+def _init_worker(features: Union[np.ndarray, spmatrix], output_path: Optional[str]):
+    global _features, _output_path
+    _features = features
+    _output_path = output_path
+
+
+def _build_block(start: int, end: int, top_k: Optional[int]) -> Optional[Tuple[np.ndarray, ...]]:
+    """Computes the cosine similarity of rows start:end to every film, writing it to the output matrix or
+    returning its top_k neighbours."""
+    block = safe_sparse_dot(_features[start:end], _features.T, dense_output=True)
+    block = np.asarray(block, dtype="float32")
+    if top_k is not None:
+        return get_block_top_k(block, top_k, self_columns=np.arange(start, end))
+    # Mapping the output per block stops written pages accumulating in the worker's resident memory.
+    output = np.load(_output_path, mmap_mode="r+")
+    output[start:end] = block
+    output.flush()
+    del output
+    return None
+
+
+def build_similarity(
+    name: str,
+    features: Union[np.ndarray, spmatrix],
+    ids: Iterable[int],
+    top_k: Optional[int] = config.SIMILARITY_TOP_K,
+    block_size: int = config.SIMILARITY_BLOCK_SIZE,
+    n_jobs: Optional[int] = config.SIMILARITY_N_JOBS,
+    path: str = config.BASE_SIMILARITY_PATH,
+    dtype: str = config.SIMILARITY_DTYPE,
+    upper_triangle: bool = config.SIMILARITY_UPPER_TRIANGLE,
+):
+    """Computes the cosine similarity between every pair of films in row blocks and saves it.
+
+    Each block of rows is scored against every film in a worker process. Dense blocks are written straight into a
+    preallocated .npy file and top-k blocks are reduced to their neighbours before being returned, so memory use
+    depends on block_size rather than the number of films.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        features (Union[np.ndarray, spmatrix]): Feature vector of each film, dense or sparse.
+        ids (Iterable[int]): Film id of each row of features.
+        top_k (Optional[int]): Number of neighbours to keep per film, or None to save the dense matrix.
+        block_size (int): Number of rows scored per task.
+        n_jobs (Optional[int]): Number of worker processes, None uses every core and 1 runs in this process.
+        path (str): Directory to write the artifacts to.
+        dtype (str): Storage of dense matrices, "float32", "float16" or "uint8", see pack_similarity_matrix.
+        upper_triangle (bool): Whether dense matrices keep only their upper triangle.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    features = normalize(features).astype("float32")
+    num_films = features.shape[0]
+    if num_films != len(ids):
+        raise ValueError(f"{name} has {num_films} feature rows but {len(ids)} ids were given")
+
+    os.makedirs(path, exist_ok=True)
+    output_path = None
+    if top_k is None:
+        output_path = get_similarity_matrix_path(name, path)
+        output = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype="float32", shape=(num_films, num_films)
+        )
+        del output
+
+    starts = range(0, num_films, block_size)
+    ends = [min(start + block_size, num_films) for start in starts]
+    if n_jobs == 1:
+        _init_worker(features, output_path)
+        blocks = list(map(_build_block, starts, ends, repeat(top_k)))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker, initargs=(features, output_path)
+        ) as executor:
+            blocks = list(executor.map(_build_block, starts, ends, repeat(top_k)))
+
+    if top_k is None:
+        _save_dense_similarity(name, output_path, ids, dtype, upper_triangle, path)
+    else:
+        indptr, indices, data = concatenate_top_k_blocks(*zip(*blocks))
+        save_neighbour_graph(name, indptr=indptr, indices=indices, data=data, ids=ids, path=path)
+
+
+def _save_dense_similarity(
+    name: str, output_path: str, ids: np.ndarray, dtype: str, upper_triangle: bool, path: str
+):
+    """Registers the float32 matrix written to output_path, packing it first if a smaller storage is asked for."""
+    if dtype == "float32" and not upper_triangle:
+        register_similarity_matrix(name, ids=ids, path=path)
+        return
+    matrix = np.load(output_path, mmap_mode="r")
+    pack_similarity_matrix(name, matrix, ids, dtype, upper_triangle, path=path)
+    del matrix
+    os.remove(output_path)
+
+
+def update_similarity(
+    name: str,
+    features: Union[np.ndarray, spmatrix],
+    ids: Iterable[int],
+    changed: Iterable[int] = (),
+    block_size: int = config.SIMILARITY_BLOCK_SIZE,
+    path: str = config.BASE_SIMILARITY_PATH,
+):
+    """Recomputes the similarity of new or changed films in an existing artifact without rebuilding it.
+
+    Films in ids beyond those already stored are appended. Only the rows and columns of the new and changed films
+    are recomputed. For a neighbour graph, other films' lists are merged with their similarity to the changed
+    films, keeping the same number of neighbours per film as the stored graph.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        features (Union[np.ndarray, spmatrix]): Feature vector of every film, in the order of ids.
+        ids (Iterable[int]): The stored film ids followed by any new film ids.
+        changed (Iterable[int]): Positions in ids of stored films whose features have changed.
+        block_size (int): Number of rows copied or merged at a time.
+        path (str): Directory containing the similarity artifacts.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    features = normalize(features).astype("float32")
+    entry = load_manifest(path)["sources"][name]
+    stored_ids = load_similarity_ids(name, path)
+    if not np.array_equal(ids[: len(stored_ids)], stored_ids):
+        raise ValueError(
+            f"New films must be appended after the {len(stored_ids)} stored {name} films"
+        )
+
+    changed = np.union1d(np.asarray(changed, dtype="int64"), np.arange(len(stored_ids), len(ids)))
+    changed_similarity = np.asarray(
+        safe_sparse_dot(features[changed], features.T, dense_output=True), dtype="float32"
+    )
+    if entry.get("format", "dense") in ("dense", "packed"):
+        _update_dense_similarity(name, ids, changed, changed_similarity, block_size, path)
+    else:
+        _update_neighbour_graph(name, ids, changed, changed_similarity, block_size, path)
+
+
+def _update_dense_similarity(
+    name: str,
+    ids: np.ndarray,
+    changed: np.ndarray,
+    changed_similarity: np.ndarray,
+    block_size: int,
+    path: str,
+):
+    entry = load_manifest(path)["sources"][name]
+    if entry.get("format", "dense") == "packed":
+        stored, stored_ids = load_packed_similarity_matrix(name, path)
+        get_rows = stored.get_rows
+    else:
+        stored, stored_ids = load_similarity_matrix(name, path)
+
+        def get_rows(positions: np.ndarray) -> np.ndarray:
+            return stored[positions]
+
+    output_path = get_similarity_matrix_path(name, path)
+    output = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype="float32", shape=(len(ids), len(ids))
+    )
+    for start in range(0, len(stored_ids), block_size):
+        end = min(start + block_size, len(stored_ids))
+        output[start:end, : len(stored_ids)] = get_rows(np.arange(start, end))
+    output[changed] = changed_similarity
+    output[:, changed] = changed_similarity.T
+    output.flush()
+    del output, stored, get_rows
+    # Keep the storage the source was trained with.
+    _save_dense_similarity(
+        name,
+        output_path,
+        ids,
+        dtype=entry.get("dtype", "float32"),
+        upper_triangle=entry.get("upper_triangle", False),
+        path=path,
+    )
+
+
+def _update_neighbour_graph(
+    name: str,
+    ids: np.ndarray,
+    changed: np.ndarray,
+    changed_similarity: np.ndarray,
+    block_size: int,
+    path: str,
+):
+    graph, stored_ids = load_neighbour_graph(name, path)
+    top_k = int(np.diff(graph.indptr).max())
+    is_changed = np.zeros(len(ids), dtype=bool)
+    is_changed[changed] = True
+
+    # Changed films get fresh neighbour lists.
+    changed_indices, changed_data, changed_lengths = get_block_top_k(
+        changed_similarity, top_k, self_columns=changed
+    )
+    rows = [np.repeat(changed, changed_lengths)]
+    indices, data = [changed_indices], [changed_data]
+
+    # Other films choose from their stored neighbours, minus the changed films, plus every changed film.
+    for start in range(0, len(stored_ids), block_size):
+        end = min(start + block_size, len(stored_ids))
+        row_lengths = np.diff(graph.indptr[start : end + 1])
+        row_positions = np.repeat(np.arange(end - start), row_lengths)
+        offsets = np.arange(row_lengths.sum()) - np.repeat(
+            graph.indptr[start:end] - graph.indptr[start], row_lengths
+        )
+        stored_slice = slice(graph.indptr[start], graph.indptr[end])
+        candidate_indices = np.zeros((end - start, top_k + len(changed)), dtype="int32")
+        candidate_scores = np.zeros(candidate_indices.shape, dtype="float32")
+        candidate_indices[row_positions, offsets] = graph.indices[stored_slice]
+        candidate_scores[row_positions, offsets] = graph.data[stored_slice]
+        candidate_scores[is_changed[candidate_indices]] = 0
+        candidate_indices[:, top_k:] = changed
+        candidate_scores[:, top_k:] = changed_similarity[:, start:end].T
+        candidate_scores[is_changed[start:end]] = 0
+
+        order = np.argpartition(-candidate_scores, top_k - 1, axis=1)[:, :top_k]
+        block_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        block_indices = np.take_along_axis(candidate_indices, order, axis=1)
+        keep = block_scores != 0
+        rows.append(np.repeat(np.arange(start, end), keep.sum(axis=1)))
+        indices.append(block_indices[keep])
+        data.append(block_scores[keep])
+
+    rows, indices, data = np.concatenate(rows), np.concatenate(indices), np.concatenate(data)
+    order = np.lexsort((-data, rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(ids)))])
+    save_neighbour_graph(
+        name, indptr=indptr, indices=indices[order], data=data[order], ids=ids, path=path
+    )
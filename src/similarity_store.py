@@ -0,0 +1,532 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import sys
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import config
+
+# Manifest entry fields naming the files of a source.
+ENTRY_FILE_KEYS = ["matrix", "ids", "indptr", "indices", "data"]
+
+
+def get_new_file_name(name: str, kind: str) -> str:
+    """Name of a new artifact file of a source, e.g. "cast_ids_1f3a9c2e7b4d.npy".
+
+    Every write uses a new name, so a file is never rewritten once the manifest refers to it. Readers always open
+    the files of the entry they read, and their memory maps stay valid after the files are superseded.
+    """
+    return f"{name}_{kind}_{uuid.uuid4().hex[:12]}.npy"
+
+
+def _save_new_array(name: str, kind: str, array: np.ndarray, path: str) -> str:
+    """Saves an array under a new file name, see get_new_file_name, and returns the name."""
+    file_name = get_new_file_name(name, kind)
+    with open(os.path.join(path, file_name), "wb") as f:
+        np.save(f, array)
+    return file_name
+
+
+def _replace_entry(name: str, entry: Dict, path: str):
+    """Points the manifest at a source's newly written files, then removes the files of its previous entry."""
+    previous = update_manifest(name, entry, path=path) or {}
+    in_use = {entry[key] for key in ENTRY_FILE_KEYS if key in entry}
+    for key in ENTRY_FILE_KEYS:
+        if key in previous and previous[key] not in in_use:
+            try:
+                os.remove(os.path.join(path, previous[key]))
+            except FileNotFoundError:
+                pass
+
+
+def load_manifest(path: str = config.BASE_SIMILARITY_PATH) -> Dict:
+    """Reads the similarity manifest describing which artifact files exist for each source.
+
+    Args:
+        path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        Dict: Manifest with a "sources" mapping, empty if no manifest has been written yet.
+    """
+    manifest_path = os.path.join(path, config.SIMILARITY_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {"sources": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def update_manifest(
+    name: str, entry: Dict, path: str = config.BASE_SIMILARITY_PATH
+) -> Optional[Dict]:
+    """Adds or replaces the manifest entry for one similarity source.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        entry (Dict): File names and metadata describing the source's artifacts.
+        path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        Optional[Dict]: The entry replaced, None if the source had none.
+    """
+    with _lock_manifest(path):
+        manifest = load_manifest(path)
+        previous = manifest["sources"].get(name)
+        manifest["sources"][name] = entry
+        manifest_path = os.path.join(path, config.SIMILARITY_MANIFEST)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+    return previous
+
+
+@contextmanager
+def _lock_manifest(path: str):
+    """Serialises manifest updates from sources trained in parallel processes."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, config.SIMILARITY_MANIFEST + ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def record_fold_in(name: str, fold_in: Dict, path: str = config.BASE_SIMILARITY_PATH):
+    """Stores statistics about films folded in since a source was last fully trained.
+
+    Training a source from scratch replaces its manifest entry, which resets these statistics.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        fold_in (Dict): Fold-in statistics, see training/update_incremental.py.
+        path (str): Directory containing the similarity artifacts.
+    """
+    entry = load_manifest(path)["sources"][name]
+    update_manifest(name, {**entry, "fold_in": fold_in}, path=path)
+
+
+def record_build_key(name: str, key: str, path: str = config.BASE_SIMILARITY_PATH):
+    """Stores the key of the inputs and parameters a source was trained from, see build_graph.
+
+    Any other rewrite of the source's artifacts replaces its manifest entry, which clears the key so that the next
+    build retrains it.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        key (str): Build key of the source.
+        path (str): Directory containing the similarity artifacts.
+    """
+    entry = load_manifest(path)["sources"][name]
+    update_manifest(name, {**entry, "build_key": key}, path=path)
+
+
+def get_build_key(name: str, path: str = config.BASE_SIMILARITY_PATH) -> Optional[str]:
+    """Key recorded by record_build_key for a source, None if it has not been built by build_graph."""
+    return load_manifest(path)["sources"].get(name, {}).get("build_key")
+
+
+def save_similarity_matrix(
+    name: str,
+    matrix: np.ndarray,
+    ids: Iterable[int],
+    path: str = config.BASE_SIMILARITY_PATH,
+    dtype: str = config.SIMILARITY_DTYPE,
+    upper_triangle: bool = config.SIMILARITY_UPPER_TRIANGLE,
+):
+    """Saves a dense similarity matrix as .npy along with the film id order of its rows and columns.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        matrix (np.ndarray): Square similarity matrix.
+        ids (Iterable[int]): Film ids labelling both the rows and columns of the matrix.
+        path (str): Directory to write the artifacts to.
+        dtype (str): "float32" to store scores as they are, or "float16" or "uint8" to quantise them, see
+            pack_similarity_matrix.
+        upper_triangle (bool): Whether to store only the upper triangle of the symmetric matrix.
+    """
+    matrix = np.asarray(matrix, dtype="float32")
+    ids = np.asarray(ids, dtype="int64")
+    if matrix.shape != (len(ids), len(ids)):
+        raise ValueError(
+            f"{name} similarity has shape {matrix.shape} but {len(ids)} ids were given"
+        )
+
+    os.makedirs(path, exist_ok=True)
+    if dtype != "float32" or upper_triangle:
+        pack_similarity_matrix(name, matrix, ids, dtype, upper_triangle, path=path)
+        return
+    with open(get_similarity_matrix_path(name, path), "wb") as f:
+        np.save(f, matrix)
+    register_similarity_matrix(name, ids=ids, path=path)
+
+
+def get_similarity_matrix_path(name: str, path: str = config.BASE_SIMILARITY_PATH) -> str:
+    """File path a dense similarity matrix is written to before register_similarity_matrix stores it."""
+    return os.path.join(path, f"{name}_similarity.npy.tmp")
+
+
+def register_similarity_matrix(
+    name: str, ids: Iterable[int], path: str = config.BASE_SIMILARITY_PATH
+):
+    """Stores a dense similarity matrix written to get_similarity_matrix_path and records it in the manifest.
+
+    The matrix and ids are moved to new file names before the manifest refers to them, and the source's previous
+    files are removed once it does.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        ids (Iterable[int]): Film ids labelling both the rows and columns of the matrix.
+        path (str): Directory containing the similarity artifacts.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    matrix_file = get_new_file_name(name, "similarity")
+    os.replace(get_similarity_matrix_path(name, path), os.path.join(path, matrix_file))
+    entry = {
+        "format": "dense",
+        "matrix": matrix_file,
+        "ids": _save_new_array(name, "ids", ids, path),
+        "dtype": "float32",
+        "shape": [len(ids), len(ids)],
+    }
+    _replace_entry(name, entry, path)
+
+
+def get_similarity_entry(name: str, path: str = config.BASE_SIMILARITY_PATH) -> Dict:
+    """Manifest entry of a similarity source, raising FileNotFoundError if it has not been trained."""
+    manifest = load_manifest(path)
+    if name not in manifest["sources"]:
+        raise FileNotFoundError(
+            f"No {name} similarity found in {path}, run the training scripts first"
+        )
+    return manifest["sources"][name]
+
+
+def uses_neighbour_graphs(path: str = config.BASE_SIMILARITY_PATH) -> bool:
+    """Whether the similarity sources were trained as top-k neighbour graphs rather than dense matrices."""
+    entry = get_similarity_entry(config.SIMILARITY_SOURCES[0], path)
+    return entry.get("format", "dense") == "neighbours"
+
+
+def load_similarity_ids(name: str, path: str = config.BASE_SIMILARITY_PATH) -> np.ndarray:
+    """Loads the film ids labelling the rows and columns of a similarity source, in either format.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        np.ndarray: Film ids.
+    """
+    return np.load(os.path.join(path, get_similarity_entry(name, path)["ids"]))
+
+
+def load_similarity_matrix(
+    name: str, path: str = config.BASE_SIMILARITY_PATH
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Memory-maps a similarity matrix read-only so that processes share its pages.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Read-only memory-mapped matrix and the film ids of its rows/columns.
+    """
+    entry = get_similarity_entry(name, path)
+    if entry.get("format", "dense") != "dense":
+        raise ValueError(f"{name} similarity is stored as {entry['format']}, not a dense matrix")
+    matrix = np.load(os.path.join(path, entry["matrix"]), mmap_mode="r")
+    ids = np.load(os.path.join(path, entry["ids"]))
+    return matrix, ids
+
+
+def get_row_offsets(num_films: int) -> np.ndarray:
+    """Position in the packed upper triangle of each row's diagonal entry, plus the total size at the end."""
+    rows = np.arange(num_films + 1, dtype="int64")
+    return rows * num_films - rows * (rows - 1) // 2
+
+
+class PackedSimilarityMatrix:
+    """Symmetric similarity matrix stored as its upper triangle and/or quantised scores, read a few rows at a time.
+
+    Rows are gathered straight from the packed array and dequantised to float32, so the full matrix is never
+    rebuilt. index and columns label the rows and columns with film ids, as for the dense DataFrames.
+
+    Args:
+        packed (np.ndarray): Row-major upper triangle including the diagonal, or the full N x N matrix.
+        ids (np.ndarray): Film ids labelling the rows and columns.
+        scale (float): Score represented by one step of a quantised value.
+        offset (float): Score represented by a quantised 0.
+        upper_triangle (bool): Whether packed holds only the upper triangle.
+    """
+
+    def __init__(
+        self,
+        packed: np.ndarray,
+        ids: np.ndarray,
+        scale: float = 1.0,
+        offset: float = 0.0,
+        upper_triangle: bool = False,
+    ):
+        self.packed = packed
+        self.index = self.columns = pd.Index(ids, name="id")
+        self.shape = (len(ids), len(ids))
+        self.scale = np.float32(scale)
+        self.offset = np.float32(offset)
+        self.upper_triangle = upper_triangle
+        self._offsets = get_row_offsets(len(ids)) if upper_triangle else None
+
+    def get_rows(self, positions: Iterable[int]) -> np.ndarray:
+        """Rows of the matrix at positions as a float32 array of len(positions) x N."""
+        positions = np.asarray(positions, dtype="int64")
+        if not self.upper_triangle:
+            rows = self.packed[positions]
+        else:
+            # Entry (i, j) of the full matrix is entry (min(i, j), max(i, j)) of the upper triangle.
+            columns = np.arange(self.shape[0], dtype="int64")
+            low = np.minimum(positions[:, None], columns)
+            high = np.maximum(positions[:, None], columns)
+            rows = self.packed[self._offsets[low] + high - low]
+        if rows.dtype == np.uint8:
+            return rows.astype("float32") * self.scale + self.offset
+        return rows.astype("float32", copy=False)
+
+
+def pack_similarity_matrix(
+    name: str,
+    matrix: np.ndarray,
+    ids: Iterable[int],
+    dtype: str = config.SIMILARITY_DTYPE,
+    upper_triangle: bool = config.SIMILARITY_UPPER_TRIANGLE,
+    block_size: int = config.SIMILARITY_BLOCK_SIZE,
+    path: str = config.BASE_SIMILARITY_PATH,
+):
+    """Saves a symmetric similarity matrix with reduced precision and/or only its upper triangle.
+
+    uint8 scores are quantised linearly between the lowest and highest score, which are stored in the manifest
+    as a scale and offset, so the error is at most half a step of (max - min) / 255. matrix is read in blocks of
+    rows and may be a memory map. The packed matrix and ids are written to new files, the manifest is pointed at
+    them, and then the source's previous files, dense or packed, are removed.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        matrix (np.ndarray): Square symmetric similarity matrix.
+        ids (Iterable[int]): Film ids labelling both the rows and columns of the matrix.
+        dtype (str): "float32", "float16" or "uint8".
+        upper_triangle (bool): Whether to store only the upper triangle, including the diagonal.
+        block_size (int): Number of rows packed at a time.
+        path (str): Directory to write the artifacts to.
+    """
+    if dtype not in ("float32", "float16", "uint8"):
+        raise ValueError(f"Unsupported similarity dtype {dtype}, use float32, float16 or uint8")
+    ids = np.asarray(ids, dtype="int64")
+    num_films = len(ids)
+    starts = range(0, num_films, block_size)
+
+    scale, offset = 1.0, 0.0
+    if dtype == "uint8":
+        low = min(float(np.min(matrix[start : start + block_size])) for start in starts)
+        high = max(float(np.max(matrix[start : start + block_size])) for start in starts)
+        scale, offset = (high - low) / 255 or 1.0, low
+
+    os.makedirs(path, exist_ok=True)
+    offsets = get_row_offsets(num_films)
+    matrix_file = get_new_file_name(name, "similarity_packed")
+    shape = (int(offsets[-1]),) if upper_triangle else (num_films, num_films)
+    output = np.lib.format.open_memmap(
+        os.path.join(path, matrix_file), mode="w+", dtype=dtype, shape=shape
+    )
+    for start in starts:
+        end = min(start + block_size, num_films)
+        block = np.asarray(matrix[start:end], dtype="float32")
+        if dtype == "uint8":
+            block = np.rint((block - offset) / scale).clip(0, 255)
+        if upper_triangle:
+            # Row-major masking of the columns at or right of the diagonal lays the rows out contiguously.
+            in_triangle = np.arange(num_films) >= np.arange(start, end)[:, None]
+            output[offsets[start] : offsets[end]] = block[in_triangle]
+        else:
+            output[start:end] = block
+    output.flush()
+    del output
+    entry = {
+        "format": "packed",
+        "matrix": matrix_file,
+        "ids": _save_new_array(name, "ids", ids, path),
+        "dtype": dtype,
+        "scale": scale,
+        "offset": offset,
+        "upper_triangle": upper_triangle,
+        "shape": [num_films, num_films],
+    }
+    _replace_entry(name, entry, path)
+
+
+def load_packed_similarity_matrix(
+    name: str, path: str = config.BASE_SIMILARITY_PATH
+) -> Tuple[PackedSimilarityMatrix, np.ndarray]:
+    """Memory-maps a packed similarity matrix read-only.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        Tuple[PackedSimilarityMatrix, np.ndarray]: Packed matrix and the film ids of its rows/columns.
+    """
+    entry = get_similarity_entry(name, path)
+    if entry.get("format", "dense") != "packed":
+        raise ValueError(f"{name} similarity is not stored as a packed matrix")
+    packed = np.load(os.path.join(path, entry["matrix"]), mmap_mode="r")
+    ids = np.load(os.path.join(path, entry["ids"]))
+    matrix = PackedSimilarityMatrix(
+        packed,
+        ids,
+        scale=entry["scale"],
+        offset=entry["offset"],
+        upper_triangle=entry["upper_triangle"],
+    )
+    return matrix, ids
+
+
+def get_top_k_neighbours(
+    matrix: np.ndarray, k: int, block_size: int = 1000
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Keeps each film's k most similar other films from a dense similarity matrix, in CSR form.
+
+    Rows are processed in blocks so only block_size x N scores are held in memory at once. Neighbours with a
+    similarity of 0 are dropped, so a row can have fewer than k entries. A film is never its own neighbour.
+
+    Args:
+        matrix (np.ndarray): Square similarity matrix.
+        k (int): Number of neighbours to keep per film.
+        block_size (int): Number of rows to process at a time.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: CSR indptr, column indices and similarity scores.
+    """
+    num_films = matrix.shape[0]
+    indices, data, row_lengths = [], [], []
+    for start in range(0, num_films, block_size):
+        block = np.asarray(matrix[start : start + block_size], dtype="float32")
+        block_indices, block_data, block_lengths = get_block_top_k(
+            block, k, self_columns=np.arange(start, start + len(block))
+        )
+        indices.append(block_indices)
+        data.append(block_data)
+        row_lengths.append(block_lengths)
+    return concatenate_top_k_blocks(indices, data, row_lengths)
+
+
+def get_block_top_k(
+    block: np.ndarray, k: int, self_columns: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Finds the k highest non-zero scores in each row of a block of a similarity matrix.
+
+    Args:
+        block (np.ndarray): Rows of a similarity matrix.
+        k (int): Number of neighbours to keep per row.
+        self_columns (Optional[np.ndarray]): Column of each row's own film, which is not kept as its neighbour.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Column indices and scores of the kept neighbours, most similar
+            first and flattened across rows, and the number kept for each row.
+    """
+    k = min(k, block.shape[1])
+    # One extra candidate per row makes up for the film itself being among them.
+    num_candidates = k if self_columns is None else min(k + 1, block.shape[1])
+    block_indices = np.argpartition(-block, num_candidates - 1, axis=1)[:, :num_candidates]
+    block_data = np.take_along_axis(block, block_indices, axis=1)
+    order = np.argsort(-block_data, axis=1, kind="stable")
+    block_indices = np.take_along_axis(block_indices, order, axis=1)
+    block_data = np.take_along_axis(block_data, order, axis=1)
+    keep = block_data != 0
+    if self_columns is not None:
+        keep &= block_indices != np.asarray(self_columns)[:, None]
+        keep &= np.cumsum(keep, axis=1) <= k
+    return block_indices[keep], block_data[keep], keep.sum(axis=1)
+
+
+def concatenate_top_k_blocks(
+    indices: List[np.ndarray], data: List[np.ndarray], row_lengths: List[np.ndarray]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Joins the output of get_block_top_k for consecutive row blocks into CSR arrays.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: CSR indptr, column indices and similarity scores.
+    """
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(row_lengths))])
+    return (
+        indptr.astype("int64"),
+        np.concatenate(indices).astype("int32"),
+        np.concatenate(data).astype("float32"),
+    )
+
+
+def save_neighbour_graph(
+    name: str,
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    data: np.ndarray,
+    ids: Iterable[int],
+    path: str = config.BASE_SIMILARITY_PATH,
+):
+    """Saves a top-k neighbour graph as CSR arrays along with the film id order of its rows and columns.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        indptr (np.ndarray): CSR row pointers, one more than the number of films.
+        indices (np.ndarray): Positions of each film's neighbours.
+        data (np.ndarray): Similarity of each film to its neighbours.
+        ids (Iterable[int]): Film ids labelling both the rows and columns of the graph.
+        path (str): Directory to write the artifacts to.
+    """
+    ids = np.asarray(ids, dtype="int64")
+    if len(indptr) != len(ids) + 1:
+        raise ValueError(
+            f"{name} neighbours have {len(indptr) - 1} rows but {len(ids)} ids were given"
+        )
+
+    os.makedirs(path, exist_ok=True)
+    entry = {
+        "format": "neighbours",
+        "shape": [len(ids), len(ids)],
+        "indptr": _save_new_array(name, "neighbours_indptr", np.asarray(indptr, "int64"), path),
+        "indices": _save_new_array(name, "neighbours_indices", np.asarray(indices, "int32"), path),
+        "data": _save_new_array(name, "neighbours_data", np.asarray(data, "float32"), path),
+        "ids": _save_new_array(name, "ids", ids, path),
+    }
+    _replace_entry(name, entry, path)
+
+
+def load_neighbour_graph(
+    name: str, path: str = config.BASE_SIMILARITY_PATH
+) -> Tuple[csr_matrix, np.ndarray]:
+    """Memory-maps a top-k neighbour graph read-only.
+
+    Args:
+        name (str): Similarity source name, e.g. "cast".
+        path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        Tuple[csr_matrix, np.ndarray]: Sparse similarity matrix holding each film's neighbours and the film ids of
+            its rows/columns.
+    """
+    entry = get_similarity_entry(name, path)
+    if entry.get("format", "dense") != "neighbours":
+        raise ValueError(f"{name} similarity is not stored as a neighbour graph")
+    arrays = [
+        np.load(os.path.join(path, entry[key]), mmap_mode="r")
+        for key in ["data", "indices", "indptr"]
+    ]
+    ids = np.load(os.path.join(path, entry["ids"]))
+    graph = csr_matrix(tuple(arrays), shape=tuple(entry["shape"]), copy=False)
+    return graph, ids
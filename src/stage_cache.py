@@ -0,0 +1,103 @@
+"""Caches the output of each stage of a pipeline under a hash of everything it depends on.
+
+A stage's key hashes the key of the stage before it with the stage's name and parameters, and the first stage's key
+hashes the contents of the input files. A stage that reads files of its own, rather than only the output of the
+stage before it, also hashes their contents, so changing them only reruns it and the stages after it. Rerunning a
+pipeline loads the output of the last stage whose key is cached and only runs the stages after it.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import sys
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from profiling import log_stage
+import config
+
+
+class Stage(NamedTuple):
+    name: str
+    run: Callable[[Any], Any]
+    params: Dict = {}
+    inputs: List[str] = []
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_key(*parts) -> str:
+    """SHA-256 of JSON serialisable parts, e.g. file hashes, stage names and parameters."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_input_key(paths: Iterable[str]) -> str:
+    """Key of the contents of the files a pipeline reads."""
+    return get_key(*[hash_file(path) for path in paths])
+
+
+def get_stage_path(name: str, key: str, path: str = config.STAGE_CACHE_PATH) -> str:
+    return os.path.join(path, f"{name}-{key[:16]}.pkl")
+
+
+def save_stage(name: str, key: str, output: Any, path: str = config.STAGE_CACHE_PATH):
+    """Saves a stage's output and removes the outputs it cached for other keys."""
+    os.makedirs(path, exist_ok=True)
+    stage_path = get_stage_path(name, key, path)
+    pd.to_pickle(output, stage_path + ".tmp")
+    os.replace(stage_path + ".tmp", stage_path)
+    for old_path in glob.glob(os.path.join(path, f"{name}-*.pkl")):
+        if old_path != stage_path:
+            os.remove(old_path)
+
+
+def run_stages(
+    stages: List[Stage], input_key: str, path: str = config.STAGE_CACHE_PATH, cache: bool = True
+) -> Any:
+    """Runs stages in order, each taking the output of the one before, skipping those already cached.
+
+    Args:
+        stages (List[Stage]): Stages to run. The first is passed None.
+        input_key (str): Key of the pipeline's inputs, see get_input_key.
+        path (str): Directory of the cached stage outputs.
+        cache (bool): Whether to load and save cached outputs.
+
+    Returns:
+        Any: Output of the last stage.
+    """
+    keys = []
+    for stage in stages:
+        keys.append(
+            get_key(
+                keys[-1] if keys else input_key,
+                stage.name,
+                stage.params,
+                *[hash_file(input_path) for input_path in stage.inputs],
+            )
+        )
+
+    output, first = None, 0
+    if cache:
+        for i in reversed(range(len(stages))):
+            stage_path = get_stage_path(stages[i].name, keys[i], path)
+            if os.path.exists(stage_path):
+                print(f"{stages[i].name}: cached")
+                output, first = pd.read_pickle(stage_path), i + 1
+                break
+
+    for stage, key in zip(stages[first:], keys[first:]):
+        with log_stage(stage.name):
+            output = stage.run(output)
+        if cache:
+            save_stage(stage.name, key, output, path)
+    return output
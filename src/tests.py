@@ -1,6 +1,88 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from functools import partial
+import json
+import os
+import threading
+
+import requests
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+from scipy.sparse import csr_matrix, issparse
+
+from ann_index import build_ivf_index, get_text_query, load_ivf_index, save_ivf_index
+from benchmarks.import_report import measure
+from benchmarks.run_benchmarks import compare_to_baseline, run_benchmarks
+from build_graph import BuildNode, run_build
+from batch_recommender import read_liked_films, recommend_batch
+from catalogue_store import hash_catalogue_columns, load_catalogue, save_catalogue
+from evaluation import (
+    evaluate,
+    fit_collaborative_similarity,
+    load_source,
+    read_ratings,
+    split_ratings,
+)
+from feature_store import load_text_features, save_text_features
+from model_registry import get_memory_footprint, get_models, load_models, publish_generation
+from profiling import (
+    finish_rerun_profile,
+    profile_stage,
+    profiled,
+    start_rerun_profile,
+    summarise_rerun_log,
+)
+from preprocessing.utils import (
+    cache_thumbnails,
+    get_session,
+    get_tmdb_poster_path,
+    preprocess_films,
+    update_poster_paths,
+)
+from recommendation_cache import ResultCache, get_cached_recommendations
+from ratings_store import load_ratings_matrix
+from service import ENDPOINTS, RecommendationHandler
+from sharded_recommender import (
+    InProcessShardTransport,
+    LocalShardTransport,
+    get_sharded_recommendations,
+    load_shards,
+    write_shards,
+)
+from similarity_builder import build_similarity, update_similarity
+
+from similarity_store import (
+    PackedSimilarityMatrix,
+    get_top_k_neighbours,
+    load_manifest,
+    load_neighbour_graph,
+    load_packed_similarity_matrix,
+    load_similarity_matrix,
+    save_neighbour_graph,
+    save_similarity_matrix,
+)
+from text_features import get_similarity_matrix, get_text_similarity, get_vectorized_text_array
+from title_index import build_title_index, get_labels, search_titles
+from thumbnail_store import (
+    add_thumbnails,
+    get_thumbnail,
+    load_thumbnail_cache,
+    load_thumbnail_index,
+)
 from utils import (
+    apply_filters,
+    build_filter_index,
+    get_films_by_id,
+    get_filter_values,
     generate_weighted_similarity_matrix,
+    get_neighbour_recommendations,
     get_recommendations,
+    get_recommended_ids,
+    get_weighted_recommendations,
     load_data,
     load_similarity_matrices,
 )
@@ -42,3 +124,1151 @@ def test_similarity_matrices():
         "The Wind Rises",
         "Castle in the Sky",
     ]
+
+
+def test_similarity_store_round_trip(tmp_path):
+    ids = [11, 22, 33]
+    matrix = np.array([[1.0, 0.5, 0.1], [0.5, 1.0, 0.2], [0.1, 0.2, 1.0]])
+    save_similarity_matrix("cast", matrix=matrix, ids=ids, path=str(tmp_path))
+
+    loaded, loaded_ids = load_similarity_matrix("cast", path=str(tmp_path))
+    assert isinstance(loaded, np.memmap)
+    assert not loaded.flags.writeable
+    assert loaded.dtype == np.float32
+    np.testing.assert_allclose(loaded, matrix)
+    assert loaded_ids.tolist() == ids
+
+    # Repacking writes new files and removes the dense ones, which stay readable through existing memory maps.
+    save_similarity_matrix("cast", matrix=matrix, ids=ids, path=str(tmp_path), dtype="float16")
+    np.testing.assert_allclose(loaded, matrix)
+    packed, _ = load_packed_similarity_matrix("cast", path=str(tmp_path))
+    np.testing.assert_allclose(packed.get_rows([0, 1, 2]), matrix, atol=1e-3)
+    entry = load_manifest(str(tmp_path))["sources"]["cast"]
+    assert sorted(f for f in os.listdir(tmp_path) if f.endswith(".npy")) == sorted(
+        [entry["matrix"], entry["ids"]]
+    )
+
+
+def test_weighted_recommendations_match_full_matrix():
+    sim_matrices = list(load_similarity_matrices())
+    data = load_data(config.DATA_PATH)
+    sim_weights = [0.2, 0.9, 0.5, 0.7, 1.3]
+    titles = ["Spirited Away", "Howl's Moving Castle", "Toy Story"]
+
+    similarity_matrix = generate_weighted_similarity_matrix(
+        arrays=sim_matrices, weights=sim_weights
+    )
+    expected = get_recommended_ids(
+        films=data, titles=titles, similarity_matrix=similarity_matrix, top_n=50
+    )
+    recommendations = get_weighted_recommendations(
+        films=data, titles=titles, similarity_matrices=sim_matrices, weights=sim_weights, top_n=50
+    )
+    assert recommendations == expected
+
+
+def test_top_k_neighbours_keep_most_similar_films(tmp_path):
+    matrix = np.array(
+        [[1.0, 0.2, 0.7, 0.0], [0.2, 1.0, 0.1, 0.4], [0.7, 0.1, 1.0, 0.0], [0.0, 0.4, 0.0, 1.0]]
+    )
+    indptr, indices, data = get_top_k_neighbours(matrix, k=3, block_size=3)
+    save_neighbour_graph(
+        "cast", indptr=indptr, indices=indices, data=data, ids=[1, 2, 3, 4], path=str(tmp_path)
+    )
+
+    graph, ids = load_neighbour_graph("cast", path=str(tmp_path))
+    assert ids.tolist() == [1, 2, 3, 4]
+    # A film is not its own neighbour, and zero similarities are not stored.
+    assert graph.indices[graph.indptr[0] : graph.indptr[1]].tolist() == [2, 1]
+    assert graph.indices[graph.indptr[1] : graph.indptr[2]].tolist() == [3, 0, 2]
+    assert graph.indices[graph.indptr[3] : graph.indptr[4]].tolist() == [1]
+
+
+def test_neighbour_recommendations_match_dense_when_all_neighbours_kept():
+    rng = np.random.default_rng(0)
+    ids = pd.Index(np.arange(100, 130), name="id")
+    films = pd.DataFrame({"id": ids, "title": [f"Film {i}" for i in ids]})
+    similarity_matrices, neighbour_graphs = [], []
+    for _ in range(3):
+        embeddings = rng.normal(size=(len(ids), 4))
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        similarity = embeddings @ embeddings.T
+        similarity_matrices.append(pd.DataFrame(similarity, index=ids, columns=ids))
+        indptr, indices, data = get_top_k_neighbours(similarity, k=len(ids))
+        neighbour_graphs.append(csr_matrix((data, indices, indptr), shape=similarity.shape))
+
+    titles = ["Film 103", "Film 117"]
+    weights = [0.3, 1.0, 0.6]
+    expected = get_weighted_recommendations(
+        films=films,
+        titles=titles,
+        similarity_matrices=similarity_matrices,
+        weights=weights,
+        top_n=10,
+    )
+    recommendations = get_neighbour_recommendations(
+        films=films,
+        titles=titles,
+        neighbour_graphs=neighbour_graphs,
+        ids=ids,
+        weights=weights,
+        top_n=10,
+    )
+    assert recommendations == expected
+
+
+def test_text_similarity_uses_saved_vocabulary(tmp_path):
+    films = pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "overview": [
+                "a wizard boy goes to a school of magic",
+                "a young wizard fights a dark lord",
+                "two detectives hunt a serial killer",
+            ],
+        }
+    )
+    vectorizer, X = get_vectorized_text_array(films, column="overview", tfidf_vectorizer=True)
+    assert issparse(X)
+    save_text_features(
+        "overview", vectorizer=vectorizer, features=X, ids=films.id, path=str(tmp_path)
+    )
+
+    vectorizer, features, ids = load_text_features("overview", path=str(tmp_path))
+    similarity = get_text_similarity(vectorizer, features, texts=[films.overview[1]])
+    expected = get_similarity_matrix(X, index=films.id).loc[2].values
+    assert ids.tolist() == [1, 2, 3]
+    np.testing.assert_allclose(similarity[0], expected, rtol=1e-6)
+    assert similarity[0].argmax() == 1
+
+
+def test_build_similarity_matches_full_matrix(tmp_path):
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(57, 6))
+    features[3] = 0
+    ids = np.arange(57) + 1000
+    expected = get_similarity_matrix(features, index=ids).values
+
+    build_similarity(
+        "collaborative", features, ids=ids, top_k=None, block_size=10, n_jobs=2, path=str(tmp_path)
+    )
+    matrix, matrix_ids = load_similarity_matrix("collaborative", path=str(tmp_path))
+    assert matrix_ids.tolist() == ids.tolist()
+    np.testing.assert_allclose(matrix, expected, atol=1e-6)
+
+    build_similarity(
+        "cast", features, ids=ids, top_k=5, block_size=10, n_jobs=1, path=str(tmp_path)
+    )
+    graph, _ = load_neighbour_graph("cast", path=str(tmp_path))
+    indptr, indices, data = get_top_k_neighbours(expected, k=5)
+    assert graph.indptr.tolist() == indptr.tolist()
+    np.testing.assert_allclose(graph.data, data, atol=1e-6)
+    assert not (graph.indices == np.repeat(np.arange(len(ids)), np.diff(graph.indptr))).any()
+
+
+def test_packed_similarity_rows_match_dense(tmp_path):
+    rng = np.random.default_rng(2)
+    features = rng.normal(size=(23, 4))
+    ids = np.arange(23) + 100
+    expected = get_similarity_matrix(features, index=ids).values.astype("float32")
+    positions = [22, 0, 7, 7]
+
+    for dtype, upper_triangle, atol in [
+        ("float32", True, 1e-6),
+        ("float16", False, 1e-3),
+        ("uint8", True, 1 / 255),
+    ]:
+        path = str(tmp_path / f"{dtype}_{upper_triangle}")
+        build_similarity(
+            "cast",
+            features,
+            ids=ids,
+            top_k=None,
+            block_size=5,
+            n_jobs=1,
+            path=path,
+            dtype=dtype,
+            upper_triangle=upper_triangle,
+        )
+        matrix, matrix_ids = load_packed_similarity_matrix("cast", path=path)
+        assert matrix_ids.tolist() == ids.tolist()
+        assert matrix.packed.dtype == dtype and not matrix.packed.flags.writeable
+        assert matrix.packed.size == (23 * 24 // 2 if upper_triangle else 23 * 23)
+        rows = matrix.get_rows(positions)
+        assert rows.dtype == np.float32
+        np.testing.assert_allclose(rows, expected[positions], atol=atol)
+
+    # Updating keeps the packed storage.
+    update_similarity("cast", features[::-1], ids=ids, changed=[3], path=path)
+    matrix, _ = load_packed_similarity_matrix("cast", path=path)
+    assert matrix.upper_triangle and matrix.packed.dtype == np.uint8
+    np.testing.assert_allclose(matrix.get_rows([3]), expected[[19]][:, ::-1], atol=1 / 255)
+
+
+def test_weighted_recommendations_from_packed_matrices(tmp_path):
+    sim_matrices = list(load_similarity_matrices())
+    data = load_data(config.DATA_PATH)
+    sim_weights = [0.2, 0.9, 0.5, 0.7, 1.3]
+    titles = ["Spirited Away", "Howl's Moving Castle", "Toy Story"]
+    for name, similarity in zip(config.SIMILARITY_SOURCES, sim_matrices):
+        save_similarity_matrix(
+            name,
+            matrix=similarity.values,
+            ids=similarity.index,
+            path=str(tmp_path),
+            dtype="float16",
+            upper_triangle=True,
+        )
+    packed_matrices = list(load_similarity_matrices(str(tmp_path)))
+    assert all(isinstance(packed, PackedSimilarityMatrix) for packed in packed_matrices)
+
+    expected = get_weighted_recommendations(
+        films=data, titles=titles, similarity_matrices=sim_matrices, weights=sim_weights, top_n=50
+    )
+    recommendations = get_weighted_recommendations(
+        films=data,
+        titles=titles,
+        similarity_matrices=packed_matrices,
+        weights=sim_weights,
+        top_n=50,
+    )
+    assert len(set(recommendations[:10]) & set(expected[:10])) >= 9
+    assert len(set(recommendations) & set(expected)) >= 48
+
+
+def test_sharded_recommendations_match_weighted(tmp_path):
+    sim_matrices = list(load_similarity_matrices())
+    data = load_data(config.DATA_PATH)
+    sim_weights = [0.2, 0.9, 0.5, 0.7, 1.3]
+    write_shards(num_shards=3, shard_path=str(tmp_path))
+
+    with LocalShardTransport(str(tmp_path)) as local, InProcessShardTransport(
+        str(tmp_path)
+    ) as in_process:
+        for titles in [["Toy Story"], ["Spirited Away", "Howl's Moving Castle", "Toy Story"]]:
+            expected = get_weighted_recommendations(
+                films=data,
+                titles=titles,
+                similarity_matrices=sim_matrices,
+                weights=sim_weights,
+                top_n=100,
+            )
+            for transport in [local, in_process]:
+                recommendations = get_sharded_recommendations(
+                    films=data, titles=titles, transport=transport, weights=sim_weights, top_n=100
+                )
+                assert recommendations == expected
+        # Films liked twice are still never recommended.
+        film_ids = data.id[:40].tolist() * 2
+        expected = get_weighted_recommendations(
+            data, None, sim_matrices, sim_weights, top_n=100, film_ids=film_ids
+        )
+        for transport in [local, in_process]:
+            assert (
+                get_sharded_recommendations(
+                    data, None, transport, sim_weights, top_n=100, film_ids=film_ids
+                )
+                == expected
+            )
+
+    # The models recommend from shard workers when given shards, and close them once a new generation is loaded.
+    generation_path = str(tmp_path / "generation.json")
+    publish_generation(generation_path)
+    models = get_models(shard_path=str(tmp_path), generation_path=generation_path, check_seconds=0)
+    assert isinstance(models.shards, LocalShardTransport)
+    assert get_memory_footprint(models)["mapped_mb"] >= data.shape[0] ** 2 * 4 * 5 / 1e6
+    titles = ["Spirited Away", "Howl's Moving Castle"]
+    assert get_cached_recommendations(
+        models,
+        titles,
+        sim_weights,
+        top_n=50,
+        cache=ResultCache(max_entries=10, max_bytes=10**6, ttl_seconds=60),
+    ) == get_weighted_recommendations(data, titles, sim_matrices, sim_weights, top_n=50)
+    publish_generation(generation_path)
+    new_models = get_models(
+        shard_path=str(tmp_path), generation_path=generation_path, check_seconds=0
+    )
+    assert new_models is not models and not models.shards.processes
+    new_models.shards.close()
+
+
+def test_shards_written_from_other_sources_are_refused(tmp_path):
+    similarity_path, shard_path = str(tmp_path / "similarity"), str(tmp_path / "shards")
+    for name in config.SIMILARITY_SOURCES:
+        save_similarity_matrix(name, matrix=np.eye(3), ids=[1, 2, 3], path=similarity_path)
+    write_shards(num_shards=2, similarity_path=similarity_path, shard_path=shard_path)
+    for transport in ["local", "in_process"]:
+        with load_shards(pd.Index([1, 2, 3]), shard_path, similarity_path, transport) as shards:
+            assert shards.ids.tolist() == [1, 2, 3]
+
+    with pytest.raises(ValueError):
+        load_shards(pd.Index([1, 2, 4]), shard_path, similarity_path)
+    save_similarity_matrix("cast", matrix=np.ones((3, 3)), ids=[1, 2, 3], path=similarity_path)
+    with pytest.raises(ValueError):
+        load_shards(pd.Index([1, 2, 3]), shard_path, similarity_path)
+
+
+def test_ivf_index_matches_exact_search(tmp_path):
+    rng = np.random.default_rng(0)
+    ids = np.arange(500, 800)
+    embeddings = rng.normal(size=(len(ids), 8))
+    index = build_ivf_index(embeddings, ids, num_lists=12)
+    query = embeddings[:3].mean(axis=0)
+    exact = get_similarity_matrix(np.vstack([query, embeddings]), range(len(ids) + 1)).values[0, 4:]
+
+    # Probing every list scores every film.
+    found, scores = index.search(query, 20, num_probes=12, exclude_ids=ids[:3])
+    assert found.tolist() == ids[3:][np.argsort(-exact, kind="stable")[:20]].tolist()
+    np.testing.assert_allclose(scores, np.sort(exact)[::-1][:20], rtol=1e-5)
+    assert len(index.search(query, 20, num_probes=2)[0]) == 20
+
+    # Films are added, updated and removed without rebuilding.
+    index.add(-embeddings[:1], ids=[500])
+    index.add(embeddings[:1], ids=[900])
+    index.remove([501])
+    assert len(index.ids) == len(ids) and 501 not in index.search(query, 300, num_probes=12)[0]
+    assert index.search(embeddings[0], 1, num_probes=12)[0].tolist() == [900]
+
+    texts = ["a wizard goes to school", "a wizard fights a dark lord", "detectives hunt a killer"]
+    vectorizer, features = get_vectorized_text_array(
+        pd.DataFrame({"overview": texts}), column="overview", tfidf_vectorizer=True
+    )
+    save_ivf_index("overview", build_ivf_index(features, [1, 2, 3], num_lists=2), str(tmp_path))
+    text_index = load_ivf_index("overview", str(tmp_path))
+    assert issparse(text_index.vectors)
+    found, _ = text_index.search(get_text_query(vectorizer, "A Dark Lord"), 1, num_probes=2)
+    assert found.tolist() == [2]
+
+
+def test_load_ratings_matrix_in_chunks(tmp_path):
+    ratings_path = tmp_path / "ratings.csv"
+    pd.DataFrame(
+        {
+            "userId": [1, 1, 1, 2, 3, 3, 4],
+            "movieId": [10, 20, 10, 10, 30, 99, 20],
+            "rating": [4.0, 3.0, 5.0, 2.0, 1.0, 5.0, 2.5],
+            "timestamp": 0,
+        }
+    ).to_csv(ratings_path, index=False)
+
+    matrix, user_ids = load_ratings_matrix(
+        str(ratings_path), film_ids=[30, 20, 10], chunksize=2, min_ratings_per_user=2
+    )
+    # User 3's rating of film 99 is not in the films, leaving them with too few ratings like users 2 and 4.
+    assert user_ids.tolist() == [1]
+    assert matrix.dtype == np.float32
+    assert matrix.toarray().tolist() == [[0.0, 3.0, 4.5]]
+
+
+def test_update_similarity_matches_rebuild(tmp_path):
+    rng = np.random.default_rng(1)
+    features = rng.normal(size=(40, 5))
+    ids = np.arange(40) + 500
+    full_path, update_path = str(tmp_path / "full"), str(tmp_path / "update")
+
+    build_similarity("cast", features, ids=ids, top_k=None, n_jobs=1, path=full_path)
+    build_similarity("keywords", features, ids=ids, top_k=6, n_jobs=1, path=full_path)
+    changed_features = features.copy()
+    changed_features[2] = rng.normal(size=5)
+    build_similarity(
+        "cast", changed_features[:32], ids=ids[:32], top_k=None, n_jobs=1, path=update_path
+    )
+    build_similarity("keywords", features[:32], ids=ids[:32], top_k=6, n_jobs=1, path=update_path)
+
+    # Film 2's features change back and 8 films are appended.
+    update_similarity("cast", features, ids=ids, changed=[2], block_size=7, path=update_path)
+    update_similarity("keywords", features, ids=ids, block_size=7, path=update_path)
+
+    expected, _ = load_similarity_matrix("cast", path=full_path)
+    matrix, matrix_ids = load_similarity_matrix("cast", path=update_path)
+    assert matrix_ids.tolist() == ids.tolist()
+    np.testing.assert_allclose(matrix, expected, atol=1e-6)
+
+    expected_graph, _ = load_neighbour_graph("keywords", path=full_path)
+    graph, _ = load_neighbour_graph("keywords", path=update_path)
+    assert graph.indptr.tolist() == expected_graph.indptr.tolist()
+    assert graph.indices.tolist() == expected_graph.indices.tolist()
+    np.testing.assert_allclose(graph.data, expected_graph.data, atol=1e-6)
+
+
+def test_title_search_ranks_by_match_and_popularity():
+    films = pd.DataFrame(
+        {
+            "id": [1, 2, 3, 4, 5],
+            "title": ["Heat", "Heat", "The Heat", "The Godfather", "Amélie"],
+            "release_date": ["1995-12-15", "1986-03-14", "2013-06-28", "1972-03-14", None],
+            "popularity": [17.0, 2.0, 30.0, 40.0, 10.0],
+        }
+    )
+    index = build_title_index(films)
+    assert search_titles(index, "").tolist() == [4, 3, 1, 5, 2]
+    # Exact titles, then titles starting with the query, then titles with a word starting with it.
+    assert search_titles(index, " HEAT").tolist() == [1, 2, 3]
+    # Typo matches fill the remaining suggestions.
+    assert search_titles(index, "he").tolist() == [1, 2, 3, 4]
+    assert search_titles(index, "god").tolist() == [4]
+    assert search_titles(index, "amelie").tolist() == [5]
+    assert search_titles(index, "the godfathr").tolist() == [4]
+    assert search_titles(index, "xyz").tolist() == []
+    assert search_titles(index, "heat", limit=1).tolist() == [1]
+    assert get_labels(index, [2, 1, 5]) == ["Heat (1986)", "Heat (1995)", "Amélie"]
+
+    rng = np.random.default_rng(0)
+    similarity_matrices = [
+        pd.DataFrame(get_similarity_matrix(rng.random((5, 3)), films.id).values, films.id, films.id)
+    ]
+    by_title = get_weighted_recommendations(
+        films=films, titles=["Heat"], similarity_matrices=similarity_matrices, weights=[1], top_n=4
+    )
+    by_id = get_weighted_recommendations(
+        films=films,
+        titles=None,
+        similarity_matrices=similarity_matrices,
+        weights=[1],
+        top_n=4,
+        film_ids=[1],
+    )
+    # A remake's title matches both films, its id only the one liked.
+    assert 2 not in by_title and 2 in by_id
+    # Films are shown in the order recommended, however many share a title.
+    assert get_films_by_id(films, by_id).id.tolist() == by_id
+
+
+def test_filter_index():
+    films = pd.DataFrame(
+        {
+            "id": [1, 2, 3, 4, 5],
+            "cast": [["A", "B"], ["B"], [], ["C"], ["A"]],
+            "director": pd.Categorical(["X", "Y", "X", np.nan, "Y"]),
+            "genres": [["Drama"], ["Comedy", "Drama"], ["Drama"], ["Comedy"], []],
+            "imdb_score": [6.0, 8.0, 7.0, 9.0, 5.0],
+        }
+    )
+    filter_index = build_filter_index(films)
+
+    assert get_filter_values(filter_index) == (["A", "B", "C"], ["X", "Y"], ["Comedy", "Drama"])
+    # Empty selections still require a value, as films without cast, director or genres have nothing to show.
+    assert apply_filters(films, filter_index, [], [], []).id.tolist() == [2, 1]
+    assert apply_filters(films, filter_index, ["A", "C"], [], []).id.tolist() == [1]
+    assert apply_filters(films, filter_index, ["B"], ["Y"], ["Drama"]).id.tolist() == [2]
+    assert apply_filters(films, filter_index, [], ["X"], ["Comedy"]).empty
+    assert apply_filters(films, filter_index, ["Unknown"], [], []).empty
+
+
+def test_catalogue_round_trip(tmp_path):
+    films = pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "title": ["Amélie", "Up", np.nan],
+            "adult": [False, True, False],
+            "cast": [["Audrey Tautou", "Mathieu Kassovitz"], [], ["Ed Asner"]],
+            "director": ["Jean-Pierre Jeunet", np.nan, "Pete Docter"],
+            "imdb_score": [7.9, 8.2, np.nan],
+        }
+    )
+    path = str(tmp_path / "films.npz")
+    save_catalogue(films, path=path)
+    loaded = load_catalogue(path)
+
+    assert loaded.dtypes.drop("director").equals(films.dtypes.drop("director"))
+    assert loaded.director.dtype == "category"
+    assert loaded.director.isna().tolist() == [False, True, False]
+    assert loaded.cast.tolist() == films.cast.tolist()
+    pd.testing.assert_frame_equal(
+        loaded.drop(columns=["cast", "director"]), films.drop(columns=["cast", "director"])
+    )
+
+    # Editing one column leaves the hash of the others unchanged.
+    cast_hash = hash_catalogue_columns(["id", "cast"], path=path)
+    save_catalogue(films.assign(title=["Amélie", "Up", "Heat"]), path=path)
+    assert hash_catalogue_columns(["id", "cast"], path=path) == cast_hash
+    save_catalogue(films.assign(cast=[["Audrey Tautou"], [], ["Ed Asner"]]), path=path)
+    assert hash_catalogue_columns(["id", "cast"], path=path) != cast_hash
+
+
+def get_png_bytes() -> bytes:
+    image = BytesIO()
+    Image.new("RGB", (4, 6)).save(image, format="PNG")
+    return image.getvalue()
+
+
+class PosterHandler(BaseHTTPRequestHandler):
+    """Serves good.png as an image, no_head.png without HEAD support, broken.png as HTML and nothing else."""
+
+    requests = []
+
+    def do_HEAD(self):
+        self.respond()
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self):
+        PosterHandler.requests.append((self.command, self.path, self.headers.get("Range")))
+        name = self.path.rsplit("/", 1)[-1]
+        if name not in ("good.png", "no_head.png", "broken.png"):
+            self.send_error(404)
+            return
+        if name == "no_head.png" and self.command == "HEAD":
+            self.send_error(405)
+            return
+        body, content_type = get_png_bytes(), "image/png"
+        if name == "broken.png":
+            body, content_type = b"<html></html>", "text/html"
+        status = 200
+        if self.headers.get("Range"):
+            end = int(self.headers["Range"].split("-")[1])
+            body, status = body[: end + 1], 206
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "GET":
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_update_poster_paths(tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PosterHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/"
+    films = pd.DataFrame(
+        {
+            "id": [1, 2, 3, 4, 5, 6],
+            "poster_path": [
+                "good.png",
+                "no_head.png",
+                "missing.png",
+                "broken.png",
+                np.nan,
+                "x.png",
+            ],
+            "poster_path_updated": [False, False, False, False, False, True],
+        }
+    )
+    looked_up = []
+
+    def find_poster_path(film_id):
+        looked_up.append(film_id)
+        return {3: "found.png", 4: "found.png"}.get(film_id)
+
+    checkpoint_path = str(tmp_path / "poster_paths.csv")
+    try:
+        updated = update_poster_paths(
+            films,
+            runtime_seconds=60,
+            checkpoint_path=checkpoint_path,
+            n_workers=3,
+            requests_per_second=None,
+            checkpoint_every=2,
+            base_url=base_url,
+            find_poster_path=find_poster_path,
+        )
+        assert updated.poster_path.fillna("").tolist() == [
+            "good.png",
+            "no_head.png",
+            "found.png",
+            "found.png",
+            "",
+            "x.png",
+        ]
+        assert updated.poster_path_updated.tolist() == [True, True, True, True, False, True]
+        assert sorted(looked_up) == [3, 4, 5]
+        # Posters are only ever partly downloaded and films already updated are not requested.
+        assert all(
+            range_header is not None
+            for method, _, range_header in PosterHandler.requests
+            if method == "GET"
+        )
+        assert "/x.png" not in [path for _, path, _ in PosterHandler.requests]
+        pd.testing.assert_frame_equal(pd.read_csv(checkpoint_path), updated)
+
+        # Resuming from the checkpoint only retries the film that could not be validated.
+        looked_up.clear()
+        update_poster_paths(
+            pd.read_csv(checkpoint_path),
+            runtime_seconds=60,
+            n_workers=3,
+            requests_per_second=None,
+            base_url=base_url,
+            find_poster_path=find_poster_path,
+        )
+        assert looked_up == [5]
+    finally:
+        server.shutdown()
+
+
+class TMDBHandler(BaseHTTPRequestHandler):
+    """Answers film lookups like the TMDB API, failing the first lookup of each film with a 503."""
+
+    requests = []
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        TMDBHandler.requests.append(path)
+        if TMDBHandler.requests.count(path) == 1:
+            self.send_error(503)
+            return
+        body = json.dumps(
+            {"id": int(path.rsplit("/", 1)[-1]), "poster_path": "/found.png"}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_tmdb_lookups_use_the_shared_session(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TMDBHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr("preprocessing.utils.get_tmdb_api_key", lambda: "key")
+    try:
+        poster_path = get_tmdb_poster_path(
+            862, session=get_session(2), api_url=f"http://127.0.0.1:{server.server_port}/3"
+        )
+        # The session retried the failed lookup.
+        assert poster_path == "/found.png"
+        assert TMDBHandler.requests == ["/3/movie/862", "/3/movie/862"]
+    finally:
+        server.shutdown()
+
+
+def test_cache_thumbnails(tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PosterHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/"
+    poster_paths = ["good.png", "no_head.png", "missing.png", np.nan, "good.png"]
+    try:
+        num_cached = cache_thumbnails(
+            poster_paths,
+            path=str(tmp_path),
+            width=2,
+            n_workers=2,
+            requests_per_second=None,
+            batch_size=1,
+            base_url=base_url,
+        )
+        assert num_cached == 2
+        # good.png and no_head.png are the same image so their thumbnail is stored once.
+        assert len(load_thumbnail_index(str(tmp_path))["blobs"]) == 1
+
+        locations, pack = load_thumbnail_cache(width=2, path=str(tmp_path))
+        assert get_thumbnail("missing.png", locations, pack) is None
+        thumbnail = Image.open(BytesIO(get_thumbnail("good.png", locations, pack)))
+        assert thumbnail.format == "WEBP" and thumbnail.size == (2, 3)
+        assert load_thumbnail_cache(width=3, path=str(tmp_path)) == ({}, None)
+
+        # Cached posters are not fetched again.
+        PosterHandler.requests.clear()
+        cache_thumbnails(
+            poster_paths, path=str(tmp_path), width=2, requests_per_second=None, base_url=base_url
+        )
+        assert [path for _, path, _ in PosterHandler.requests] == ["/missing.png"]
+    finally:
+        server.shutdown()
+
+
+def test_thumbnail_width_change_leaves_mapped_pack_intact(tmp_path):
+    add_thumbnails({"a.png": b"old"}, width=2, path=str(tmp_path))
+    locations, pack = load_thumbnail_cache(width=2, path=str(tmp_path))
+
+    add_thumbnails({"a.png": b"newer"}, width=3, path=str(tmp_path))
+    # A reader that mapped the old pack still reads it, and the old pack is no longer on disk.
+    assert get_thumbnail("a.png", locations, pack) == b"old"
+    assert get_thumbnail("a.png", *load_thumbnail_cache(width=3, path=str(tmp_path))) == b"newer"
+    assert sorted(os.listdir(tmp_path)) == ["thumbnails.json", "thumbnails_3.bin"]
+
+
+def test_model_registry_swaps_in_new_artifacts(tmp_path):
+    data_path = str(tmp_path / "films.npz")
+    similarity_path = str(tmp_path / "similarity")
+    films = pd.DataFrame(
+        {
+            "id": [1, 2],
+            "title": ["A", "B"],
+            "cast": [["X"], []],
+            "director": ["Y", np.nan],
+            "genres": [["Drama"], ["Comedy"]],
+            "imdb_score": [7.0, 6.0],
+        }
+    )
+    save_catalogue(films, path=data_path)
+    for name in config.SIMILARITY_SOURCES:
+        save_similarity_matrix(name, matrix=np.eye(2), ids=[1, 2], path=similarity_path)
+    generation_path = str(tmp_path / "generation.json")
+    paths = dict(
+        data_path=data_path,
+        similarity_path=similarity_path,
+        thumbnails_path=str(tmp_path / "thumbnails"),
+        generation_path=generation_path,
+        check_seconds=0,
+    )
+    publish_generation(generation_path)
+
+    models = get_models(**paths)
+    assert get_models(**paths) is models
+    # Copies would own their data and be writeable, the read-only memory maps are neither.
+    similarity = models.similarity_matrices[0].values
+    assert not similarity.flags.owndata and not similarity.flags.writeable
+    assert get_memory_footprint(models)["mapped_mb"] == 5 * 2 * 2 * 4 / 1e6
+
+    # Artifacts are only loaded once they are published.
+    save_similarity_matrix("cast", matrix=np.ones((2, 2)), ids=[1, 2], path=similarity_path)
+    assert get_models(**paths) is models
+    publish_generation(generation_path)
+    new_models = get_models(**paths)
+    assert new_models is not models
+    assert new_models.similarity_matrices[0].values.tolist() == [[1, 1], [1, 1]]
+    # Sessions still holding the previous generation keep reading it.
+    assert models.similarity_matrices[0].values.tolist() == [[1, 0], [0, 1]]
+
+    # A generation that fails to load, here with a different film order, leaves the current one in place.
+    save_similarity_matrix("director", matrix=np.eye(2), ids=[2, 1], path=similarity_path)
+    publish_generation(generation_path)
+    assert get_models(**paths) is new_models
+
+    # As does a catalogue with films the similarity sources do not have.
+    save_similarity_matrix("director", matrix=np.eye(2), ids=[1, 2], path=similarity_path)
+    save_catalogue(films.assign(id=[1, 3]), path=data_path)
+    publish_generation(generation_path)
+    assert get_models(**paths) is new_models
+    save_catalogue(films, path=data_path)
+    publish_generation(generation_path)
+    assert get_models(**paths) is not new_models
+
+
+def test_result_cache_evicts_least_recently_used_and_expired_entries():
+    now = [0.0]
+    cache = ResultCache(max_entries=2, max_bytes=100, ttl_seconds=10, clock=lambda: now[0])
+    cache.put("a", ("A",), size=10)
+    cache.put("b", ("B",), size=10)
+    assert cache.get("a") == ("A",)
+    cache.put("c", ("C",), size=10)
+    assert cache.get("b") is None
+    cache.put("d", ("D",), size=90)
+    # "d" takes the cache over max_bytes, so the least recently used "a" is evicted.
+    assert cache.get("a") is None and cache.get("c") == ("C",) and cache.get("d") == ("D",)
+    now[0] = 10.0
+    assert cache.get("d") is None
+    assert cache.get_stats() == {
+        "hits": 3,
+        "misses": 3,
+        "evictions": 2,
+        "expirations": 1,
+        "entries": 1,
+        "bytes": 10,
+    }
+
+
+def test_cached_recommendations_share_canonical_keys():
+    models = load_models()
+    cache = ResultCache(max_entries=10, max_bytes=10**6, ttl_seconds=60)
+    titles = ["Spirited Away", "Howl's Moving Castle"]
+    weights = [0.5, 0.5, 0.5, 0.5, 1.0]
+    expected = get_weighted_recommendations(
+        films=models.data,
+        titles=titles,
+        similarity_matrices=models.similarity_matrices,
+        weights=weights,
+        top_n=20,
+    )
+
+    assert get_cached_recommendations(models, titles, weights, top_n=20, cache=cache) == expected
+    assert (
+        get_cached_recommendations(
+            models, titles[::-1], [0.5, 0.5, 0.5, 0.500001, 1.0], top_n=20, cache=cache
+        )
+        == expected
+    )
+    assert cache.get_stats()["hits"] == 1 and cache.get_stats()["entries"] == 1
+
+    # A film liked twice counts once, whichever of the requests sharing a key is cached first.
+    film_ids = models.data.loc[models.data.title.isin(titles), "id"].tolist()
+    duplicated = [film_ids[0]] + film_ids
+    uncached = get_cached_recommendations(
+        models, None, weights, top_n=20, cache=ResultCache(1, 10**6, 60), film_ids=duplicated
+    )
+    assert uncached == expected
+    assert (
+        get_cached_recommendations(
+            models, None, weights, top_n=20, cache=cache, film_ids=duplicated
+        )
+        == uncached
+    )
+    assert cache.get_stats()["hits"] == 2
+
+
+def test_batch_recommendations_match_single_user(tmp_path):
+    rng = np.random.default_rng(0)
+    ids = np.arange(10, 40)
+    for name in config.SIMILARITY_SOURCES:
+        features = rng.random((len(ids), 4))
+        save_similarity_matrix(
+            name, matrix=get_similarity_matrix(features, ids).values, ids=ids, path=str(tmp_path)
+        )
+    films = pd.DataFrame({"id": ids, "title": [f"film {i}" for i in ids]})
+    liked = pd.DataFrame(
+        {"user_id": [1, 1, 2, 3, 3, 3, 3], "film_id": [10, 25, 39, 11, 12, 12, 999]}
+    )
+    liked.to_csv(tmp_path / "liked.csv", index=False)
+    weights = [0.2, 0.4, 0.6, 0.8, 1.0]
+
+    # Chunks never split a user's liked films.
+    chunks = list(read_liked_films(str(tmp_path / "liked.csv"), chunksize=3))
+    assert [chunk.user_id.unique().tolist() for chunk in chunks] == [[1], [2], [3]]
+
+    for n_jobs in [1, 2]:
+        output_path = str(tmp_path / f"recommendations_{n_jobs}.csv")
+        num_users = recommend_batch(
+            str(tmp_path / "liked.csv"),
+            output_path,
+            weights=weights,
+            top_n=5,
+            batch_size=2,
+            n_jobs=n_jobs,
+            similarity_path=str(tmp_path),
+        )
+        recommendations = pd.read_csv(output_path)
+        assert num_users == 3
+        for user_id, user_liked in liked[liked.film_id.isin(ids)].groupby("user_id"):
+            user_recommendations = recommendations[recommendations.user_id == user_id]
+            assert user_recommendations["rank"].tolist() == [1, 2, 3, 4, 5]
+            expected = get_weighted_recommendations(
+                films=films,
+                titles=[f"film {i}" for i in user_liked.film_id],
+                similarity_matrices=list(load_similarity_matrices(str(tmp_path))),
+                weights=weights,
+                top_n=5,
+            )
+            assert user_recommendations.film_id.tolist() == expected
+
+
+def test_evaluation_matches_single_user_recommendations(tmp_path):
+    rng = np.random.default_rng(0)
+    ids = np.arange(10, 40)
+    for name in config.SIMILARITY_SOURCES:
+        features = rng.random((len(ids), 4))
+        save_similarity_matrix(
+            name, matrix=get_similarity_matrix(features, ids).values, ids=ids, path=str(tmp_path)
+        )
+    films = pd.DataFrame({"id": ids, "title": [f"film {i}" for i in ids]})
+    num_ratings = 400
+    pd.DataFrame(
+        {
+            "userId": rng.integers(1, 40, num_ratings),
+            "movieId": rng.integers(10, 45, num_ratings),
+            "rating": rng.choice([2.0, 4.0, 5.0], num_ratings),
+            "timestamp": rng.integers(0, 1000, num_ratings),
+        }
+    ).to_csv(tmp_path / "ratings.csv", index=False)
+    weight_configs = [[0.2, 0.4, 0.6, 0.8, 1.0], [0.0, 0.0, 0.0, 0.0, 1.0]]
+
+    liked, relevant = split_ratings(str(tmp_path / "ratings.csv"), pd.Index(ids))
+    assert liked.film_id.isin(ids).all() and relevant.film_id.isin(ids).all()
+    assert set(liked.user_id) == set(relevant.user_id)
+    assert not relevant.merge(liked).shape[0]
+
+    expected = []
+    for weights in weight_configs:
+        precision, recall = [], []
+        for user_id, user_liked in liked.groupby("user_id"):
+            recommendations = get_weighted_recommendations(
+                films=films,
+                titles=[f"film {i}" for i in user_liked.film_id],
+                similarity_matrices=list(load_similarity_matrices(str(tmp_path))),
+                weights=weights,
+                top_n=5,
+            )
+            user_relevant = set(relevant[relevant.user_id == user_id].film_id)
+            num_hits = len(set(recommendations) & user_relevant)
+            precision.append(num_hits / 5)
+            recall.append(num_hits / len(user_relevant))
+        expected.append([np.mean(precision), np.mean(recall)])
+
+    for n_jobs in [1, 2]:
+        results = evaluate(
+            weight_configs,
+            ks=[1, 5],
+            ratings_path=str(tmp_path / "ratings.csv"),
+            batch_size=4,
+            n_jobs=n_jobs,
+            similarity_path=str(tmp_path),
+        )
+        assert results.attrs["num_users"] == liked.user_id.nunique()
+        np.testing.assert_allclose(results[["precision@5", "recall@5"]].values, expected)
+        assert (results[["ndcg@1", "ndcg@5"]].values <= 1).all()
+        np.testing.assert_allclose(results["ndcg@1"], results["precision@1"])
+
+    # Fitting collaborative before the split must not see the held out ratings.
+    ratings, is_held_out = read_ratings(str(tmp_path / "ratings.csv"), pd.Index(ids))
+    ratings.loc[is_held_out, "rating"] = 1.0
+    ratings.to_csv(tmp_path / "changed_ratings.csv", index=False)
+    fitted = []
+    for ratings_name in ["ratings.csv", "changed_ratings.csv"]:
+        np.random.seed(0)
+        output_path = str(tmp_path / f"fitted_{ratings_name}")
+        fit_collaborative_similarity(
+            str(tmp_path / ratings_name), pd.Index(ids), output_path, str(tmp_path), n_jobs=1
+        )
+        source = load_source("collaborative", output_path)
+        fitted.append(
+            source.get_rows(np.arange(len(ids)))
+            if hasattr(source, "get_rows")
+            else np.array(source)
+        )
+    assert np.abs(fitted[0]).sum() > 0
+    np.testing.assert_array_equal(fitted[0], fitted[1])
+    results = evaluate(
+        weight_configs,
+        ks=[5],
+        ratings_path=str(tmp_path / "ratings.csv"),
+        n_jobs=1,
+        similarity_path=str(tmp_path),
+        fit_collaborative=True,
+    )
+    assert results.attrs["num_users"] == liked.user_id.nunique()
+    metrics = results[["precision@5", "recall@5", "ndcg@5"]].values
+    assert ((metrics >= 0) & (metrics <= 1)).all()
+
+
+def test_service_endpoints(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecommendationHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        response = requests.get(
+            f"{base_url}/recommend",
+            params={"title": ["Spirited Away"], "weights": "1,1,1,1,5", "top_n": 5},
+        )
+        assert response.status_code == 200
+        ids = [film["id"] for film in response.json()["films"]]
+        assert ids == get_cached_recommendations(
+            get_models(), titles=["Spirited Away"], weights=[1, 1, 1, 1, 5], top_n=5
+        )
+        # A title shared by remakes likes both films, an id only the one given.
+        by_title = requests.get(
+            f"{base_url}/recommend", params={"title": "Beauty and the Beast", "top_n": 120}
+        ).json()["films"]
+        by_id = requests.get(f"{base_url}/recommend", params={"id": 321612, "top_n": 120}).json()[
+            "films"
+        ]
+        assert len(by_title) == len(by_id) == 120
+        assert 10020 not in {film["id"] for film in by_title}
+        assert 10020 in {film["id"] for film in by_id}
+        assert requests.get(f"{base_url}/recommend", params={"id": -1}).status_code == 400
+
+        films = requests.get(f"{base_url}/top-films", params={"genres": "Animation", "limit": 3})
+        assert len(films.json()["films"]) == 3
+        assert all("Animation" in film["genres"] for film in films.json()["films"])
+        assert "Animation" in requests.get(f"{base_url}/filters").json()["genres"]
+        assert (
+            requests.get(f"{base_url}/recommend", params={"title": "No Such Film"}).status_code
+            == 400
+        )
+        assert requests.get(f"{base_url}/unknown").status_code == 404
+
+        def fail(models, params):
+            raise KeyError("missing")
+
+        monkeypatch.setitem(ENDPOINTS, "/health", fail)
+        response = requests.get(f"{base_url}/health")
+        assert response.status_code == 500 and "error" in response.json()
+
+        endpoints = requests.get(f"{base_url}/metrics").json()["endpoints"]
+        assert endpoints["/recommend"]["count"] >= 2 and endpoints["/recommend"]["errors"] >= 1
+        assert endpoints["/top-films"]["p95_ms"] > 0
+        assert endpoints["/health"]["errors"] == 1
+    finally:
+        server.shutdown()
+
+
+def test_benchmarks_flag_regressions_against_baseline():
+    results = run_benchmarks(sizes=[200], repeats=1)
+    assert {"load_data", "recommend_x20", "filter_x20", "get_recommendations_x20"} <= {
+        result["stage"] for result in results
+    }
+    assert all(result["seconds"] > 0 and result["peak_mb"] >= 0 for result in results)
+    assert not compare_to_baseline(results, results).regression.any()
+
+    baseline = [
+        {"films": 200, "stage": "fast", "seconds": 0.001, "peak_mb": 0.1},
+        {"films": 200, "stage": "slow", "seconds": 1.0, "peak_mb": 10},
+        {"films": 200, "stage": "large", "seconds": 1.0, "peak_mb": 10},
+    ]
+    current = [
+        {"films": 200, "stage": "fast", "seconds": 0.01, "peak_mb": 0.5},
+        {"films": 200, "stage": "slow", "seconds": 2.0, "peak_mb": 10},
+        {"films": 200, "stage": "large", "seconds": 1.0, "peak_mb": 20},
+    ]
+    comparison = compare_to_baseline(current, baseline, threshold=1.25)
+    assert comparison.set_index("stage").regression.to_dict() == {
+        "fast": False,
+        "slow": True,
+        "large": True,
+    }
+
+
+def test_rerun_profile_records_nested_stages(tmp_path, monkeypatch):
+    def allocate():
+        return np.ones(10**6)
+
+    monkeypatch.setattr(config, "INSTRUMENTATION_ENABLED", False)
+    assert profiled(allocate) is allocate
+    assert start_rerun_profile("session") is None
+
+    monkeypatch.setattr(config, "INSTRUMENTATION_ENABLED", True)
+    log_path = str(tmp_path / "logs" / "reruns.jsonl")
+    kept = []
+    for _ in range(2):
+        profile = start_rerun_profile("session")
+        with profile_stage("recommend"):
+            kept.append(profiled(allocate)())
+        finish_rerun_profile(profile, log_path=log_path)
+    # Stages outside a rerun are not recorded.
+    with profile_stage("recommend"):
+        pass
+
+    assert [stage["stage"] for stage in profile.stages] == ["recommend/allocate", "recommend"]
+    assert all(stage["allocated_mb"] >= kept[0].nbytes / 1e6 for stage in profile.stages)
+    assert profile.seconds >= profile.stages[1]["seconds"]
+    summary = summarise_rerun_log(log_path)
+    assert summary.loc["recommend/allocate", "calls"] == 2
+    assert set(summary.index) == {"recommend", "recommend/allocate"}
+
+
+def write_raw_tmdb_files(path, num_films: int):
+    """Writes raw metadata, credits, keywords and poster path csvs in the format of the TMDB dataset."""
+    rng = np.random.default_rng(3)
+    ids = np.arange(num_films) + 1
+
+    def names(prefix, count):
+        return str([{"id": i, "name": f"{prefix} {i}"} for i in rng.integers(0, 20, count)])
+
+    metadata = pd.DataFrame(
+        {
+            "id": ids.astype(str),
+            "imdb_id": [f"tt{i}" for i in ids],
+            "title": [f"Film {i}" for i in ids],
+            "adult": False,
+            "original_language": rng.choice(["en", "fr", "hi"], num_films),
+            "poster_path": "/old.jpg",
+            "release_date": rng.choice(["1960-01-01", "1999-05-05", "2010-10-10"], num_films),
+            "revenue": 0,
+            "runtime": 90.0,
+            "vote_average": rng.uniform(1, 10, num_films).round(1),
+            "vote_count": rng.integers(0, 1000, num_films).astype(float),
+            "overview": "An overview",
+            "popularity": rng.uniform(0, 50, num_films).astype(str),
+            "genres": [names("Genre", rng.integers(0, 5)) for _ in ids],
+        }
+    )
+    # A malformed row with a date for an id, as in the raw dataset.
+    metadata.loc[len(metadata)] = metadata.iloc[0]
+    metadata.loc[len(metadata) - 1, "id"] = "1997-08-20"
+    crew = [
+        str([{"job": "Writer", "name": "W"}, {"job": "Director", "name": f"Director {i % 7}"}])
+        for i in ids
+    ]
+    crew[0] = "[]"
+    pd.DataFrame(
+        {"cast": [names("Actor", rng.integers(0, 6)) for _ in ids], "crew": crew, "id": ids}
+    ).to_csv(path / "credits.csv", index=False)
+    pd.DataFrame({"id": ids, "keywords": [names("Keyword", 4) for _ in ids]}).to_csv(
+        path / "keywords.csv", index=False
+    )
+    metadata.to_csv(path / "movies_metadata.csv", index=False)
+    pd.DataFrame(
+        {"id": ids, "poster_path": [f"/{i}.jpg" for i in ids], "poster_path_updated": ids % 5 > 0}
+    ).to_csv(path / "updated_poster_paths.csv", index=False)
+
+
+def test_preprocess_films_caches_stages(tmp_path, capsys):
+    write_raw_tmdb_files(tmp_path, num_films=60)
+    paths = {
+        "credits_path": str(tmp_path / "credits.csv"),
+        "keywords_path": str(tmp_path / "keywords.csv"),
+        "metadata_path": str(tmp_path / "movies_metadata.csv"),
+        "poster_paths_path": str(tmp_path / "updated_poster_paths.csv"),
+        "cache_path": str(tmp_path / "cache"),
+    }
+    films = preprocess_films(**paths, n_jobs=2)
+
+    assert films.columns.tolist() == config.USEFUL_COLUMNS + ["imdb_score"]
+    assert films.id.is_unique and len(films) <= config.NUM_FILMS_TO_KEEP
+    assert not films.original_language.isin(config.EXCLUDE_LANGUAGES).any()
+    assert films.poster_path_updated.all() and (films.release_date > config.MIN_FILM_DATE).all()
+    film = films.set_index("id").loc[2]
+    assert film.director == "Director 2" and film.poster_path == "/2.jpg"
+    assert len(film.keywords) == 3 and all(name.startswith("Keyword") for name in film.keywords)
+    expected_score = (film.vote_count * film.vote_average + config.m * config.C) / (
+        film.vote_count + config.m
+    )
+    assert film.imdb_score == pytest.approx(expected_score)
+    assert pd.isna(films.set_index("id").director.get(1, np.nan))
+
+    capsys.readouterr()
+    cached = preprocess_films(**paths, n_jobs=1)
+    assert "select_films: cached" in capsys.readouterr().out
+    pd.testing.assert_frame_equal(cached, films)
+
+    # Changing the poster paths reuses the parsed metadata.
+    poster_paths = pd.read_csv(paths["poster_paths_path"])
+    poster_paths["poster_path_updated"] = True
+    poster_paths.to_csv(paths["poster_paths_path"], index=False)
+    rerun = preprocess_films(**paths, n_jobs=1)
+    output = capsys.readouterr().out
+    assert "parse_metadata: cached" in output and "select_films: cached" not in output
+    assert len(rerun) > len(films)
+    assert len(os.listdir(paths["cache_path"])) == 4
+
+
+def write_build_output(input_path: str, output_path: str, n_jobs: int):
+    with open(input_path) as f, open(output_path, "a") as output:
+        output.write(f.read().upper())
+
+
+def test_run_build_skips_unchanged_nodes(tmp_path):
+    for name in ["a", "b"]:
+        (tmp_path / f"{name}.txt").write_text(name)
+    nodes = [
+        BuildNode(
+            name=name,
+            build=partial(
+                write_build_output, str(tmp_path / f"{name}.txt"), str(tmp_path / f"{name}.out")
+            ),
+            inputs=[str(tmp_path / f"{name}.txt")],
+            params={"upper": True},
+            depends_on=["a"] if name == "b" else [],
+        )
+        for name in ["b", "a"]
+    ]
+    built_keys = {}
+    build = partial(
+        run_build, get_built_key=built_keys.get, record_built_key=built_keys.__setitem__
+    )
+
+    assert build(nodes, n_jobs=2) == {"b": "built", "a": "built"}
+    assert (tmp_path / "a.out").read_text() == "A" and (tmp_path / "b.out").read_text() == "B"
+    assert build(nodes, n_jobs=2) == {"b": "skipped", "a": "skipped"}
+
+    # Changing a rebuilds b too, as b depends on it.
+    (tmp_path / "a.txt").write_text("c")
+    assert build(nodes, n_jobs=1) == {"b": "built", "a": "built"}
+    (tmp_path / "b.txt").write_text("d")
+    assert build(nodes, n_jobs=2) == {"b": "built", "a": "skipped"}
+    assert (tmp_path / "a.out").read_text() == "AC" and (tmp_path / "b.out").read_text() == "BBD"
+    assert build(nodes, n_jobs=1, force=True) == {"b": "built", "a": "built"}
+    assert build(nodes[:1] + [nodes[1]._replace(params={"upper": False})])["a"] == "built"
+
+
+def test_serving_imports_no_training_packages():
+    # Imported in a new interpreter, as at container start.
+    assert (
+        measure("import service, recommendation_cache, model_registry", 1)["training_packages"]
+        == ""
+    )
+    assert measure("import app.ui_utils", 1)["training_packages"] == "streamlit PIL"
@@ -0,0 +1,108 @@
+"""Text features of the films for training the content similarity sources, and similarity of new texts to them.
+
+Only training and incremental updates use these, so serving never imports scikit-learn.
+"""
+
+from typing import List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.utils.extmath import safe_sparse_dot
+
+
+def replace_spaces_with_underscores(x):
+    if isinstance(x, list):
+        return [str(text).lower().replace(" ", "_") for text in x]
+    elif isinstance(x, str):
+        return x.lower().replace(" ", "_")
+    else:
+        return ""
+
+
+def get_content_text(data: pd.DataFrame) -> pd.DataFrame:
+    """Turns the cast, director, genres, keywords and overview of each film into text for vectorizing.
+
+    Multi-word names become single tokens (e.g. "tom_hanks") so that only exact names match.
+
+    Args:
+        data (pd.DataFrame): Films dataframe with Python lists in the list columns.
+
+    Returns:
+        pd.DataFrame: Copy of data with the text columns as space separated strings.
+    """
+    data = data.copy()
+    data[["director", "overview"]] = data[["director", "overview"]].astype("str")
+
+    text_cols = ["keywords", "cast", "genres", "director"]
+    text_list_cols = ["keywords", "cast", "genres"]
+
+    data[text_cols] = data[text_cols].applymap(replace_spaces_with_underscores)
+    data["overview"] = data["overview"].apply(lambda x: x.lower())
+    data[text_list_cols] = data[text_list_cols].applymap(lambda x: " ".join(x))
+    return data
+
+
+def get_vectorized_text_array(
+    dataframe: pd.DataFrame, column: str, tfidf_vectorizer: bool = False
+) -> Tuple[Union[CountVectorizer, TfidfVectorizer], csr_matrix]:
+    """Fits a vectorizer to a text column.
+
+    Args:
+        dataframe (pd.DataFrame): Films dataframe with text columns.
+        column (str): Column to vectorize.
+        tfidf_vectorizer (bool): Use TF-IDF weighting rather than token counts.
+
+    Returns:
+        Tuple[Union[CountVectorizer, TfidfVectorizer], csr_matrix]: Fitted vectorizer and the sparse, L2 normalised
+            float32 feature vector of each film.
+    """
+    if tfidf_vectorizer:
+        vectorizer = TfidfVectorizer(stop_words="english", dtype=np.float32)
+    else:
+        vectorizer = CountVectorizer(stop_words="english", dtype=np.float32)
+    X = vectorizer.fit_transform(dataframe[column])
+    return vectorizer, normalize(X)
+
+
+def get_similarity_matrix(array, index):
+    X = normalize(array)
+    X = pd.DataFrame(safe_sparse_dot(X, X.T, dense_output=True), index=index, columns=index)
+    return X
+
+
+def get_text_similarity(
+    vectorizer: Union[CountVectorizer, TfidfVectorizer], features: csr_matrix, texts: List[str]
+) -> np.ndarray:
+    """Computes the cosine similarity of new texts to every film using an already fitted vocabulary.
+
+    Args:
+        vectorizer (Union[CountVectorizer, TfidfVectorizer]): Vectorizer fitted during training.
+        features (csr_matrix): L2 normalised feature vector of each film.
+        texts (List[str]): Texts prepared the same way as the training column, see get_content_text.
+
+    Returns:
+        np.ndarray: Similarity of each text (rows) to each film (columns).
+    """
+    X = normalize(vectorizer.transform(texts).astype("float32"))
+    return safe_sparse_dot(X, features.T, dense_output=True)
+
+
+def get_out_of_vocabulary_counts(
+    vectorizer: Union[CountVectorizer, TfidfVectorizer], texts: List[str]
+) -> Tuple[int, int]:
+    """Counts the tokens in new texts and how many of them a fitted vectorizer ignores as unknown.
+
+    Args:
+        vectorizer (Union[CountVectorizer, TfidfVectorizer]): Vectorizer fitted during training.
+        texts (List[str]): Texts prepared the same way as the training column, see get_content_text.
+
+    Returns:
+        Tuple[int, int]: Number of tokens and number of tokens missing from the vocabulary.
+    """
+    analyzer = vectorizer.build_analyzer()
+    tokens = [token for text in texts for token in analyzer(text)]
+    unknown_tokens = sum(token not in vectorizer.vocabulary_ for token in tokens)
+    return len(tokens), unknown_tokens
@@ -0,0 +1,115 @@
+"""Content-addressed cache of poster thumbnails packed into a single file.
+
+Thumbnails are appended to a pack file and found through config.THUMBNAIL_INDEX, a JSON file naming the pack and
+mapping each poster path to the SHA-256 digest of its thumbnail and each digest to its offset and length in the pack,
+so posters with identical thumbnails are stored once.
+
+Readers memory map the pack, so it is only ever appended to. Thumbnails of a new width go to a new pack, written in
+full before the index points to it.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import config
+
+
+def get_pack_name(width: int) -> str:
+    """File name of the pack of thumbnails of a width, e.g. thumbnails_300.bin."""
+    stem, extension = os.path.splitext(config.THUMBNAIL_PACK)
+    return f"{stem}_{width}{extension}"
+
+
+def load_thumbnail_index(path: str = config.BASE_THUMBNAILS_PATH) -> Dict:
+    index_path = os.path.join(path, config.THUMBNAIL_INDEX)
+    if not os.path.exists(index_path):
+        return {"width": None, "pack": None, "posters": {}, "blobs": {}}
+    with open(index_path) as f:
+        # Indexes written before packs were named by width use config.THUMBNAIL_PACK.
+        return {"pack": config.THUMBNAIL_PACK, **json.load(f)}
+
+
+def add_thumbnails(
+    thumbnails: Dict[str, bytes], width: int, path: str = config.BASE_THUMBNAILS_PATH
+):
+    """Appends thumbnails to the pack and records them in the index.
+
+    The index is replaced atomically after the pack has been written, so an interrupted write leaves the cache as it
+    was. A cache of thumbnails of another width is discarded: the new thumbnails are written to a temporary file
+    that replaces the pack of their width, and the old pack is removed once the index no longer names it. Processes
+    that have the old pack memory mapped keep reading it until they reload.
+
+    Args:
+        thumbnails (Dict[str, bytes]): Encoded thumbnail of each poster path.
+        width (int): Width of the thumbnails in pixels.
+        path (str): Directory of the cache.
+    """
+    os.makedirs(path, exist_ok=True)
+    index = load_thumbnail_index(path)
+    old_pack = index["pack"]
+    is_new_pack = index["width"] != width
+    if is_new_pack:
+        index = {"width": width, "pack": get_pack_name(width), "posters": {}, "blobs": {}}
+    pack_path = os.path.join(path, index["pack"])
+    write_path = pack_path + ".tmp" if is_new_pack else pack_path
+
+    with open(write_path, "wb" if is_new_pack else "ab") as f:
+        offset = f.seek(0, os.SEEK_END)
+        for poster_path, thumbnail in thumbnails.items():
+            digest = hashlib.sha256(thumbnail).hexdigest()
+            if digest not in index["blobs"]:
+                f.write(thumbnail)
+                index["blobs"][digest] = [offset, len(thumbnail)]
+                offset += len(thumbnail)
+            index["posters"][poster_path] = digest
+        f.flush()
+        os.fsync(f.fileno())
+    if is_new_pack:
+        os.replace(write_path, pack_path)
+
+    index_path = os.path.join(path, config.THUMBNAIL_INDEX)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+    if is_new_pack and old_pack not in (None, index["pack"]):
+        if os.path.exists(os.path.join(path, old_pack)):
+            os.remove(os.path.join(path, old_pack))
+
+
+def load_thumbnail_cache(
+    width: int = config.IMAGE_WIDTH, path: str = config.BASE_THUMBNAILS_PATH
+) -> Tuple[Dict[str, Tuple[int, int]], Optional[np.memmap]]:
+    """Loads the cache for reading with get_thumbnail. The pack is memory mapped rather than read.
+
+    Args:
+        width (int): Width of thumbnail wanted, the cache is treated as empty if it holds another width.
+        path (str): Directory of the cache.
+
+    Returns:
+        Tuple[Dict[str, Tuple[int, int]], Optional[np.memmap]]: Offset and length in the pack of each poster's
+            thumbnail, and the pack, or None if nothing is cached.
+    """
+    index = load_thumbnail_index(path)
+    if index["width"] != width or not index["blobs"]:
+        return {}, None
+    locations = {
+        poster_path: tuple(index["blobs"][digest])
+        for poster_path, digest in index["posters"].items()
+    }
+    pack = np.memmap(os.path.join(path, index["pack"]), dtype="uint8", mode="r")
+    return locations, pack
+
+
+def get_thumbnail(
+    poster_path: str, locations: Dict[str, Tuple[int, int]], pack: Optional[np.memmap]
+) -> Optional[bytes]:
+    if poster_path not in locations:
+        return None
+    offset, length = locations[poster_path]
+    return pack[offset : offset + length].tobytes()
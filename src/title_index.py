@@ -0,0 +1,195 @@
+"""Searches film titles as the user types, returning film ids so that remakes sharing a title stay distinct.
+
+Titles are normalised to lowercase ASCII words. Every word of a title starts an entry in a sorted array, so a query
+is a prefix of the matching entries and two binary searches find them all, e.g. "rings" finds "The Lord of the
+Rings". When fewer than the requested number of films match, films are also matched by the share of the query's
+trigrams their title contains, which tolerates typos and ignores the rest of the title, e.g. "lord of the rnigs".
+Films are stored in order of popularity, so ranking matches by position ranks them by popularity.
+"""
+
+import os
+import re
+import sys
+import unicodedata
+from typing import List, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+import config
+
+
+class TitleIndex(NamedTuple):
+    # Film id, display label and normalised title of each position, most popular first.
+    ids: np.ndarray
+    labels: np.ndarray
+    titles: np.ndarray
+    # Positions that sort ids, to look films up by id.
+    id_order: np.ndarray
+    # Sorted title suffixes starting at each word, the position of their film and whether they start the title.
+    prefixes: np.ndarray
+    prefix_positions: np.ndarray
+    prefix_is_start: np.ndarray
+    # Sorted distinct trigrams, with the positions of the films containing trigrams[i] at
+    # trigram_positions[trigram_offsets[i]:trigram_offsets[i + 1]].
+    trigrams: np.ndarray
+    trigram_offsets: np.ndarray
+    trigram_positions: np.ndarray
+
+
+def normalise_title(title: str) -> str:
+    """Lowercases a title, strips its accents and punctuation and separates its words with single spaces."""
+    title = unicodedata.normalize("NFKD", str(title)).encode("ascii", "ignore").decode()
+    return " ".join(re.findall(r"[a-z0-9]+", title.lower()))
+
+
+def get_trigrams(title: str) -> List[str]:
+    """Distinct three character substrings of a normalised title, padded so word starts and ends count."""
+    padded = f" {title} "
+    return sorted({padded[i : i + 3] for i in range(len(padded) - 2)})
+
+
+def get_title_labels(data: pd.DataFrame) -> np.ndarray:
+    """Title of each film followed by its release year, which tells remakes apart."""
+    if "release_date" not in data:
+        return data["title"].values.astype(object)
+    years = pd.to_datetime(data["release_date"], errors="coerce").dt.year
+    return np.array(
+        [
+            title if pd.isna(year) else f"{title} ({int(year)})"
+            for title, year in zip(data["title"], years)
+        ],
+        dtype=object,
+    )
+
+
+def build_title_index(data: pd.DataFrame, popularity_column: str = "popularity") -> TitleIndex:
+    """Indexes the title of every film in the catalogue.
+
+    Args:
+        data (pd.DataFrame): Films dataframe with id and title columns, and release_date if available.
+        popularity_column (str): Column ranking films that match equally well, highest first. Without it films
+            are ranked in catalogue order.
+
+    Returns:
+        TitleIndex: Index of the titles.
+    """
+    if popularity_column in data:
+        data = data.iloc[np.argsort(-data[popularity_column].fillna(0).values, kind="stable")]
+    titles = np.array([normalise_title(title) for title in data["title"]], dtype=object)
+
+    prefixes, prefix_positions, prefix_is_start = [], [], []
+    film_trigrams = []
+    for position, title in enumerate(titles):
+        for match in re.finditer(r"[a-z0-9]+", title):
+            prefixes.append(title[match.start() :])
+            prefix_positions.append(position)
+            prefix_is_start.append(match.start() == 0)
+        film_trigrams.append(get_trigrams(title))
+    # One character wider than the longest title, so the upper bound of any query that can match fits.
+    prefixes = np.array(prefixes, dtype=f"<U{max(map(len, prefixes), default=0) + 1}")
+    order = np.argsort(prefixes, kind="stable")
+
+    num_trigrams = [len(trigrams) for trigrams in film_trigrams]
+    trigram_films = np.repeat(np.arange(len(titles)), num_trigrams)
+    trigrams, film_trigram_ids = np.unique(
+        np.array([t for trigrams in film_trigrams for t in trigrams], dtype=str),
+        return_inverse=True,
+    )
+
+    return TitleIndex(
+        ids=data["id"].values.astype("int64"),
+        labels=get_title_labels(data),
+        titles=titles,
+        id_order=np.argsort(data["id"].values, kind="stable"),
+        prefixes=prefixes[order],
+        prefix_positions=np.array(prefix_positions, dtype="int64")[order],
+        prefix_is_start=np.array(prefix_is_start, dtype=bool)[order],
+        trigrams=trigrams,
+        trigram_offsets=np.concatenate(
+            [[0], np.cumsum(np.bincount(film_trigram_ids, minlength=len(trigrams)))]
+        ),
+        trigram_positions=trigram_films[np.argsort(film_trigram_ids, kind="stable")],
+    )
+
+
+def get_labels(index: TitleIndex, ids: List[int]) -> List[str]:
+    """Display labels of films given by id."""
+    positions = index.id_order[np.searchsorted(index.ids, ids, sorter=index.id_order)]
+    return index.labels[positions].tolist()
+
+
+def search_titles(
+    index: TitleIndex,
+    query: str,
+    limit: int = config.TITLE_SEARCH_SUGGESTIONS,
+    min_similarity: float = config.TITLE_SEARCH_MIN_SIMILARITY,
+) -> np.ndarray:
+    """Finds the films whose titles best match a partially typed query.
+
+    Exact title matches come first, then titles starting with the query, then titles with a word starting with it,
+    then titles containing at least min_similarity of the query's trigrams. Films within each group are ranked
+    by popularity, and an empty query gives the most popular films.
+
+    Args:
+        index (TitleIndex): Index of the titles, see build_title_index.
+        query (str): Query typed by the user.
+        limit (int): Maximum number of films to return.
+        min_similarity (float): Lowest share of the query's trigrams a title must contain to match despite typos.
+
+    Returns:
+        np.ndarray: Ids of the matching films, best match first.
+    """
+    query = normalise_title(query)
+    if not query:
+        return index.ids[:limit]
+
+    start, exact_end, end = 0, 0, 0
+    if len(query) < index.prefixes.dtype.itemsize // 4:
+        # Bounds of the same dtype as the prefixes, so numpy does not cast every prefix to compare them.
+        bounds = np.array([query, query + "\U0010ffff"], dtype=index.prefixes.dtype)
+        start, end = np.searchsorted(index.prefixes, bounds)
+        # Suffixes equal to the query sort before the others starting with it.
+        exact_end = np.searchsorted(index.prefixes, bounds[0], side="right")
+    positions = index.prefix_positions[start:end]
+    is_start = index.prefix_is_start[start:end]
+    groups = [
+        positions[: exact_end - start][is_start[: exact_end - start]],
+        positions[is_start],
+        positions,
+    ]
+    is_matched = np.zeros(len(index.ids), dtype=bool)
+    matches = np.array([], dtype="int64")
+    for group in groups:
+        # Flagging the group's films in film order ranks them by popularity without sorting every match.
+        in_group = np.zeros(len(index.ids), dtype=bool)
+        in_group[group] = True
+        found = np.flatnonzero(in_group & ~is_matched)[: limit - len(matches)]
+        is_matched[found] = True
+        matches = np.concatenate([matches, found])
+    if len(matches) == limit:
+        return index.ids[matches]
+
+    query_trigrams = np.array(get_trigrams(query), dtype=str)
+    found = np.minimum(np.searchsorted(index.trigrams, query_trigrams), len(index.trigrams) - 1)
+    found = found[index.trigrams[found] == query_trigrams]
+    required = max(int(np.ceil(min_similarity * len(query_trigrams))), 1)
+    if len(found) < required:
+        return index.ids[matches]
+    # Number of the query's trigrams each title contains.
+    shared = np.bincount(
+        np.concatenate(
+            [
+                index.trigram_positions[index.trigram_offsets[i] : index.trigram_offsets[i + 1]]
+                for i in found
+            ]
+        ),
+        minlength=len(index.ids),
+    )
+    shared[is_matched] = 0
+    for count in range(len(found), required - 1, -1):
+        if len(matches) == limit:
+            break
+        matches = np.concatenate([matches, np.flatnonzero(shared == count)[: limit - len(matches)]])
+    return index.ids[matches]
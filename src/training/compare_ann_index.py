@@ -0,0 +1,59 @@
+"""Measures the recall and query time of the approximate nearest neighbour indexes against an exact search of every
+film, to help choose config.ANN_NUM_LISTS and config.ANN_NUM_PROBES. Requires the indexes to have been trained.
+"""
+
+import sys
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from ann_index import load_ivf_index
+import config
+
+NUM_PROBES_VALUES = [1, 2, 4, 8, 16, 32]
+TOP_N = 10
+NUM_QUERIES = 200
+MAX_LIKED_FILMS = 5
+SEED = 0
+
+rng = np.random.default_rng(SEED)
+results = []
+for name in config.ANN_SOURCES:
+    index = load_ivf_index(name)
+    queries = []
+    for _ in range(NUM_QUERIES):
+        liked_ids = rng.choice(index.ids, size=rng.integers(1, MAX_LIKED_FILMS + 1), replace=False)
+        queries.append((np.asarray(index.get_vectors(liked_ids).mean(axis=0)), liked_ids))
+    exact = [
+        set(index.search(query, TOP_N, num_probes=len(index.centroids), exclude_ids=liked_ids)[0])
+        for query, liked_ids in queries
+    ]
+    for num_probes in NUM_PROBES_VALUES + [len(index.centroids)]:
+        start = time.perf_counter()
+        found = [
+            index.search(query, TOP_N, num_probes=num_probes, exclude_ids=liked_ids)[0]
+            for query, liked_ids in queries
+        ]
+        ms_per_query = (time.perf_counter() - start) / NUM_QUERIES * 1000
+        results.append(
+            {
+                "source": name,
+                "num_probes": num_probes,
+                f"recall@{TOP_N}": np.mean(
+                    [
+                        len(set(ids) & expected) / len(expected)
+                        for ids, expected in zip(found, exact)
+                    ]
+                ),
+                "ms_per_query": ms_per_query,
+            }
+        )
+
+print(
+    f"{config.ANN_NUM_LISTS} lists, {NUM_QUERIES} queries from the centroid of random liked films, recall against "
+    "probing every list"
+)
+print(pd.DataFrame(results).round(3).to_string(index=False))
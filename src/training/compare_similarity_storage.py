@@ -0,0 +1,96 @@
+"""Measures the size, row read time and recommendation agreement of each storage of the dense similarity matrices
+against float32, to help choose config.SIMILARITY_DTYPE and config.SIMILARITY_UPPER_TRIANGLE. Requires the float32
+dense similarity matrices to have been trained."""
+
+import sys
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from similarity_store import pack_similarity_matrix
+from utils import get_weighted_recommendations, load_data, load_similarity_matrices
+import config
+
+STORAGES = [
+    ("float32", True),
+    ("float16", False),
+    ("float16", True),
+    ("uint8", False),
+    ("uint8", True),
+]
+TOP_N_VALUES = [10, config.POSTERS_PER_ROW * config.NUM_POSTER_ROWS]
+NUM_QUERIES = 200
+MAX_LIKED_FILMS = 5
+SEED = 0
+
+rng = np.random.default_rng(SEED)
+data = load_data(config.DATA_PATH)
+similarity_matrices = list(load_similarity_matrices())
+ids = similarity_matrices[0].index
+
+queries = []
+for _ in range(NUM_QUERIES):
+    num_liked = rng.integers(1, MAX_LIKED_FILMS + 1)
+    titles = list(rng.choice(data.title.unique(), size=num_liked, replace=False))
+    weights = rng.uniform(config.PARAMETER_CONTROL_MIN, config.PARAMETER_CONTROL_MAX, size=5)
+    weights[-1] *= 2  # The similar user preferences slider has double the range.
+    queries.append((titles, list(weights)))
+
+
+def recommend_all(matrices):
+    start = time.perf_counter()
+    recommendations = [
+        get_weighted_recommendations(
+            films=data,
+            titles=titles,
+            similarity_matrices=matrices,
+            weights=weights,
+            top_n=max(TOP_N_VALUES),
+        )
+        for titles, weights in queries
+    ]
+    return recommendations, (time.perf_counter() - start) / NUM_QUERIES * 1000
+
+
+float32_recommendations, float32_ms = recommend_all(similarity_matrices)
+float32_mb = sum(similarity.values.nbytes for similarity in similarity_matrices) / 1e6
+results = [{"dtype": "float32", "upper_triangle": False, "storage_mb": float32_mb}]
+results[0].update({"ms_per_query": float32_ms, "max_error": 0.0})
+results[0].update({f"agreement@{top_n}": 1.0 for top_n in TOP_N_VALUES})
+
+for dtype, upper_triangle in STORAGES:
+    with tempfile.TemporaryDirectory() as path:
+        for name, similarity in zip(config.SIMILARITY_SOURCES, similarity_matrices):
+            pack_similarity_matrix(name, similarity.values, ids, dtype, upper_triangle, path=path)
+        packed_matrices = list(load_similarity_matrices(path))
+        recommendations, ms_per_query = recommend_all(packed_matrices)
+        sample = rng.choice(len(ids), size=100, replace=False)
+        max_error = max(
+            np.abs(packed.get_rows(sample) - similarity.values[sample]).max()
+            for packed, similarity in zip(packed_matrices, similarity_matrices)
+        )
+        result = {
+            "dtype": dtype,
+            "upper_triangle": upper_triangle,
+            "storage_mb": sum(packed.packed.nbytes for packed in packed_matrices) / 1e6,
+            "ms_per_query": ms_per_query,
+            "max_error": max_error,
+        }
+        for top_n in TOP_N_VALUES:
+            result[f"agreement@{top_n}"] = np.mean(
+                [
+                    len(set(packed[:top_n]) & set(expected[:top_n])) / len(expected[:top_n])
+                    for packed, expected in zip(recommendations, float32_recommendations)
+                ]
+            )
+        results.append(result)
+        del packed_matrices
+
+print(
+    f"{len(ids)} films, {NUM_QUERIES} random queries, agreement is the overlap with the float32 top N"
+)
+print(pd.DataFrame(results).round(4).to_string(index=False))
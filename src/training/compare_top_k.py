@@ -0,0 +1,83 @@
+"""Measures how closely top-k neighbour graphs reproduce the dense recommendations, to help choose
+config.SIMILARITY_TOP_K. Requires the dense similarity matrices to have been trained."""
+
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from similarity_store import get_top_k_neighbours
+from utils import (
+    get_neighbour_recommendations,
+    get_weighted_recommendations,
+    load_data,
+    load_similarity_matrices,
+)
+import config
+
+TOP_K_VALUES = [10, 25, 50, 100, 200, 400]
+TOP_N_VALUES = [10, config.POSTERS_PER_ROW * config.NUM_POSTER_ROWS]
+NUM_QUERIES = 200
+MAX_LIKED_FILMS = 5
+SEED = 0
+
+rng = np.random.default_rng(SEED)
+data = load_data(config.DATA_PATH)
+similarity_matrices = list(load_similarity_matrices())
+ids = similarity_matrices[0].index
+
+queries = []
+for _ in range(NUM_QUERIES):
+    num_liked = rng.integers(1, MAX_LIKED_FILMS + 1)
+    titles = list(rng.choice(data.title.unique(), size=num_liked, replace=False))
+    weights = rng.uniform(config.PARAMETER_CONTROL_MIN, config.PARAMETER_CONTROL_MAX, size=5)
+    weights[-1] *= 2  # The similar user preferences slider has double the range.
+    queries.append((titles, list(weights)))
+
+dense_recommendations = [
+    get_weighted_recommendations(
+        films=data,
+        titles=titles,
+        similarity_matrices=similarity_matrices,
+        weights=weights,
+        top_n=max(TOP_N_VALUES),
+    )
+    for titles, weights in queries
+]
+
+results = []
+for top_k in TOP_K_VALUES:
+    neighbour_graphs = []
+    for similarity in similarity_matrices:
+        indptr, indices, scores = get_top_k_neighbours(similarity.values, k=top_k)
+        neighbour_graphs.append(csr_matrix((scores, indices, indptr), shape=similarity.shape))
+    storage_mb = (
+        sum(
+            graph.data.nbytes + graph.indices.nbytes + graph.indptr.nbytes
+            for graph in neighbour_graphs
+        )
+        / 1e6
+    )
+    recalls = {top_n: [] for top_n in TOP_N_VALUES}
+    for (titles, weights), expected in zip(queries, dense_recommendations):
+        recommendations = get_neighbour_recommendations(
+            films=data,
+            titles=titles,
+            neighbour_graphs=neighbour_graphs,
+            ids=ids,
+            weights=weights,
+            top_n=max(TOP_N_VALUES),
+        )
+        for top_n in TOP_N_VALUES:
+            overlap = set(recommendations[:top_n]) & set(expected[:top_n])
+            recalls[top_n].append(len(overlap) / len(expected[:top_n]))
+    result = {"top_k": top_k, "storage_mb": round(storage_mb, 1)}
+    result.update({f"recall@{top_n}": np.mean(recalls[top_n]) for top_n in TOP_N_VALUES})
+    results.append(result)
+
+dense_mb = sum(similarity.values.nbytes for similarity in similarity_matrices) / 1e6
+print(f"Dense storage: {dense_mb:.1f} MB over {len(ids)} films, {NUM_QUERIES} random queries")
+print(pd.DataFrame(results).round(3).to_string(index=False))
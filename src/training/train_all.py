@@ -0,0 +1,37 @@
+"""Trains every similarity source, skipping those whose inputs and parameters are unchanged since they were last
+trained and training the rest in parallel.
+
+Usage:
+    python src/training/train_all.py          # retrain what has changed
+    python src/training/train_all.py --force  # retrain everything
+    python src/training/train_all.py --top-k 100  # keep each film's 100 nearest neighbours per source
+"""
+
+import sys
+import os
+from typing import Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from build_graph import run_build
+from model_registry import publish_generation
+from similarity_store import get_build_key, record_build_key
+from training.train_collaborative import get_collaborative_node
+from training.train_content_similarity import get_content_nodes, get_parser
+import config
+
+
+def main(force: bool = False, top_k: Optional[int] = config.SIMILARITY_TOP_K):
+    status = run_build(
+        get_content_nodes(top_k) + [get_collaborative_node(top_k)],
+        get_built_key=get_build_key,
+        record_built_key=record_build_key,
+        n_jobs=config.SIMILARITY_N_JOBS,
+        force=force,
+    )
+    print(", ".join(f"{name} {result}" for name, result in status.items()))
+    publish_generation()
+
+
+if __name__ == "__main__":
+    args = get_parser("Trains every similarity source.").parse_args()
+    main(force=args.force, top_k=args.top_k)
@@ -1,39 +1,98 @@
 import sys
 import os
+from functools import partial
+from typing import Optional, Tuple
 
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn.decomposition import TruncatedSVD
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from ann_index import build_ivf_index, save_ivf_index
+from build_graph import BuildNode, run_build
+from catalogue_store import hash_catalogue_columns, load_catalogue
+from feature_store import save_svd_features
+from model_registry import publish_generation
+from profiling import log_stage
+from ratings_store import load_ratings_matrix
+from similarity_builder import build_similarity
+from similarity_store import get_build_key, record_build_key
+from training.train_content_similarity import get_ann_params, get_parser, get_similarity_params
 import config
 
-data = pd.read_csv("film_features/film_features.csv")
-ratings = pd.read_csv("data/ratings.csv")
-ratings = ratings[ratings["movieId"].isin(data.id)]
-valid_users = ratings.userId.value_counts() > 1
-ratings = ratings[ratings["userId"].isin(valid_users.index.values)]
-user_film_matrix = pd.crosstab(
-    index=ratings.userId, columns=ratings.movieId, values=ratings.rating, aggfunc="mean"
-).fillna(0)
-film_user_matrix = user_film_matrix.T
-film_ids = film_user_matrix.reset_index().movieId.to_list()
-SVD = TruncatedSVD(n_components=25)
-X = SVD.fit_transform(film_user_matrix)
-collaborative_similarity = cosine_similarity(X, X)
-user_embedding_similarity = pd.DataFrame(collaborative_similarity, index=film_ids, columns=film_ids)
-
-# There are some with no views from users that must be added to the similarity matrix
-missing_indices = list(set(data.id.values) - set(user_embedding_similarity.index.values))
-missing_indices_df_cols = pd.DataFrame(columns=[str(id) for id in missing_indices])
-missing_indices_df_index = pd.DataFrame(index=[str(id) for id in missing_indices])
-collaborative_similarity_df = pd.concat(
-    [user_embedding_similarity, missing_indices_df_index], axis=0
-)
-collaborative_similarity_df = pd.concat(
-    [collaborative_similarity_df, missing_indices_df_cols], axis=1
-)
-collaborative_similarity_df = collaborative_similarity_df.fillna(0)
-collaborative_similarity_df.to_csv(
-    config.BASE_SIMILARITY_PATH + "collaborative_similarity.csv", index=False
-)
+SVD_COMPONENTS = 25
+
+
+def fit_svd(user_film_matrix: csr_matrix) -> Tuple[np.ndarray, TruncatedSVD]:
+    """Embeds each film from its ratings, returning the embeddings and the fitted SVD."""
+    # Films with no ratings have a zero row, so their zero embedding gives a similarity of 0 to every film.
+    # Embeddings come from transform rather than fit_transform so that they match films folded in later.
+    film_user_matrix = user_film_matrix.T.tocsr()
+    SVD = TruncatedSVD(n_components=SVD_COMPONENTS)
+    SVD.fit(film_user_matrix)
+    return SVD.transform(film_user_matrix), SVD
+
+
+def build_collaborative_similarity(
+    n_jobs: int,
+    top_k: Optional[int] = config.SIMILARITY_TOP_K,
+    data_path: str = config.DATA_PATH,
+    ratings_path: str = config.RATINGS_PATH,
+    features_path: str = config.BASE_FEATURES_PATH,
+    ann_path: str = config.BASE_ANN_PATH,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+):
+    data = load_catalogue(data_path)
+    with log_stage("Load ratings"):
+        user_film_matrix, user_ids = load_ratings_matrix(ratings_path, film_ids=data.id)
+    print(f"{user_film_matrix.nnz} ratings from {user_film_matrix.shape[0]} users")
+
+    with log_stage("Fit SVD"):
+        X, SVD = fit_svd(user_film_matrix)
+        save_svd_features(
+            X, components=SVD.components_, user_ids=user_ids, ids=data.id, path=features_path
+        )
+    if "collaborative" in config.ANN_SOURCES:
+        with log_stage("Build ANN index"):
+            save_ivf_index("collaborative", build_ivf_index(X, ids=data.id), path=ann_path)
+
+    with log_stage("Build similarity"):
+        build_similarity(
+            "collaborative",
+            features=X,
+            ids=data.id,
+            top_k=top_k,
+            n_jobs=n_jobs,
+            path=similarity_path,
+        )
+
+
+def get_collaborative_node(top_k: Optional[int] = config.SIMILARITY_TOP_K) -> BuildNode:
+    return BuildNode(
+        name="collaborative",
+        build=partial(build_collaborative_similarity, top_k=top_k),
+        inputs=[config.RATINGS_PATH],
+        # Only the films' ids are read from the catalogue.
+        input_hashes=[partial(hash_catalogue_columns, ["id"])],
+        params={
+            "components": SVD_COMPONENTS,
+            "min_ratings_per_user": config.MIN_RATINGS_PER_USER,
+            **get_similarity_params(top_k),
+            **get_ann_params("collaborative"),
+        },
+    )
+
+
+def main(force: bool = False, top_k: Optional[int] = config.SIMILARITY_TOP_K):
+    run_build(
+        [get_collaborative_node(top_k)],
+        get_built_key=get_build_key,
+        record_built_key=record_build_key,
+        force=force,
+    )
+    publish_generation()
+
+
+if __name__ == "__main__":
+    args = get_parser("Trains the collaborative similarity source.").parse_args()
+    main(force=args.force, top_k=args.top_k)
@@ -1,40 +1,112 @@
-from ast import literal_eval
+import argparse
 import sys
 import os
-
-import pandas as pd
+from functools import partial
+from typing import List, Optional
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
-from utils import (
-    replace_spaces_with_underscores,
-    get_vectorized_text_array,
-    get_similarity_matrix,
-)
+from ann_index import build_ivf_index, save_ivf_index
+from build_graph import BuildNode, run_build
+from catalogue_store import hash_catalogue_columns, load_catalogue
+from feature_store import save_text_features
+from model_registry import publish_generation
+from similarity_builder import build_similarity
+from similarity_store import get_build_key, record_build_key
+from text_features import get_content_text, get_vectorized_text_array
 import config
 
-data = pd.read_csv("film_features/film_features.csv")
+# Similarity source name, text column and whether to use TF-IDF weighting.
+CONTENT_SOURCES = [
+    ("cast", "cast", False),
+    ("director", "director", False),
+    ("keywords", "keywords", False),
+    ("overview", "overview", True),
+]
+
+
+def build_content_similarity(
+    name: str,
+    column: str,
+    tfidf_vectorizer: bool,
+    n_jobs: int,
+    top_k: Optional[int],
+    data_path: str = config.DATA_PATH,
+    features_path: str = config.BASE_FEATURES_PATH,
+    ann_path: str = config.BASE_ANN_PATH,
+    similarity_path: str = config.BASE_SIMILARITY_PATH,
+):
+    """Vectorizes one text column of the catalogue, saving the features, their index and their similarity."""
+    data = load_catalogue(data_path)
+    data = get_content_text(data)
+    vectorizer, X = get_vectorized_text_array(
+        dataframe=data, column=column, tfidf_vectorizer=tfidf_vectorizer
+    )
+    save_text_features(name, vectorizer=vectorizer, features=X, ids=data.id, path=features_path)
+    if name in config.ANN_SOURCES:
+        save_ivf_index(name, build_ivf_index(X, ids=data.id), path=ann_path)
+    build_similarity(
+        name, features=X, ids=data.id, top_k=top_k, n_jobs=n_jobs, path=similarity_path
+    )
+
+
+def get_similarity_params(top_k: Optional[int]) -> dict:
+    """Settings that change the stored similarity artifacts, so trigger a rebuild when they change."""
+    return {
+        "top_k": top_k,
+        "dtype": config.SIMILARITY_DTYPE,
+        "upper_triangle": config.SIMILARITY_UPPER_TRIANGLE,
+    }
+
+
+def get_ann_params(name: str) -> dict:
+    """Settings of the source's approximate nearest neighbour index, if it has one."""
+    if name not in config.ANN_SOURCES:
+        return {}
+    return {"ann": {"lists": config.ANN_NUM_LISTS, "iterations": config.ANN_KMEANS_ITERATIONS}}
+
+
+def get_content_nodes(top_k: Optional[int] = config.SIMILARITY_TOP_K) -> List[BuildNode]:
+    return [
+        BuildNode(
+            name=name,
+            build=partial(build_content_similarity, name, column, tfidf_vectorizer, top_k=top_k),
+            # Only a film's id and the column vectorized change its features.
+            input_hashes=[partial(hash_catalogue_columns, ["id", column])],
+            params={
+                "column": column,
+                "tfidf": tfidf_vectorizer,
+                **get_similarity_params(top_k),
+                **get_ann_params(name),
+            },
+        )
+        for name, column, tfidf_vectorizer in CONTENT_SOURCES
+    ]
 
-data[["director", "overview"]] = data[["director", "overview"]].astype("str")
 
-text_cols = ["keywords", "cast", "genres", "director"]
-text_list_cols = ["keywords", "cast", "genres"]
+def get_parser(description: str) -> argparse.ArgumentParser:
+    """Command line options shared by the training scripts."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--force", action="store_true", help="retrain even if nothing has changed")
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=config.SIMILARITY_TOP_K,
+        help="keep each film's top K neighbours instead of the dense matrices, default config.SIMILARITY_TOP_K",
+    )
+    return parser
 
-data[text_list_cols] = data[text_list_cols].applymap(literal_eval)
-data[text_cols] = data[text_cols].applymap(replace_spaces_with_underscores)
-data["overview"] = data["overview"].apply(lambda x: x.lower())
-data[text_list_cols] = data[text_list_cols].applymap(lambda x: " ".join(x))
 
-X_cast = get_vectorized_text_array(dataframe=data, column="cast")
-X_director = get_vectorized_text_array(dataframe=data, column="director")
-X_keywords = get_vectorized_text_array(dataframe=data, column="keywords")
-X_overview = get_vectorized_text_array(dataframe=data, column="overview", tfidf_vectorizer=True)
+def main(force: bool = False, top_k: Optional[int] = config.SIMILARITY_TOP_K):
+    run_build(
+        get_content_nodes(top_k),
+        get_built_key=get_build_key,
+        record_built_key=record_build_key,
+        n_jobs=config.SIMILARITY_N_JOBS,
+        force=force,
+    )
+    publish_generation()
 
-cast_similarity = get_similarity_matrix(array=X_cast, index=data.id)
-director_similarity = get_similarity_matrix(array=X_director, index=data.id)
-keywords_similarity = get_similarity_matrix(array=X_keywords, index=data.id)
-overview_similarity = get_similarity_matrix(array=X_overview, index=data.id)
 
-cast_similarity.to_csv(config.BASE_SIMILARITY_PATH + "cast_similarity.csv")
-director_similarity.to_csv(config.BASE_SIMILARITY_PATH + "director_similarity.csv")
-keywords_similarity.to_csv(config.BASE_SIMILARITY_PATH + "keywords_similarity.csv")
-overview_similarity.to_csv(config.BASE_SIMILARITY_PATH + "overview_similarity.csv")
+if __name__ == "__main__":
+    args = get_parser("Trains the content similarity sources.").parse_args()
+    main(force=args.force, top_k=args.top_k)
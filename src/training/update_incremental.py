@@ -0,0 +1,161 @@
+"""Folds new films, edited films and ratings into the trained artifacts instead of retraining from scratch.
+
+Every film's text is vectorized with the saved content vocabularies, so films whose text was edited are
+found as well as new ones. New films are projected into the saved SVD latent space using their ratings.
+Only the similarity rows and columns of new and edited films, and of films whose ratings have changed,
+are computed, and those films are re-added to the approximate nearest neighbour indexes. Each source
+records which films have been folded in since it was trained, and everything is retrained once any
+source drifts past config.FOLD_IN_DRIFT_THRESHOLD.
+"""
+
+import sys
+import os
+from typing import Dict, List
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from ann_index import load_ivf_index, save_ivf_index
+from catalogue_store import load_catalogue
+from feature_store import (
+    load_svd_features,
+    load_text_features,
+    save_svd_features,
+    save_text_features,
+)
+from model_registry import publish_generation
+from profiling import log_stage
+from ratings_store import load_ratings_matrix
+from similarity_builder import update_similarity
+from similarity_store import load_manifest, load_similarity_ids, record_fold_in
+from training.train_all import main as train_all
+from text_features import get_content_text, get_out_of_vocabulary_counts
+from training.train_content_similarity import CONTENT_SOURCES
+import config
+
+
+def get_folded_ids(fold_in: Dict, ids: np.ndarray, rows: np.ndarray) -> List[int]:
+    """Distinct ids of the films folded in since training, adding those at rows of ids."""
+    return np.union1d(fold_in.get("folded_ids", []), ids[rows]).astype("int64").tolist()
+
+
+def get_drift(fold_in: Dict, num_films: int) -> float:
+    """Share of films folded in since training, or share of the input the trained model could not see, whichever
+    is larger. A film folded in by several runs counts once.
+
+    Args:
+        fold_in (Dict): Fold-in statistics of a source, see record_fold_in.
+        num_films (int): Number of films in the source after folding in.
+
+    Returns:
+        float: Drift between 0 and 1.
+    """
+    unseen_share = fold_in["unseen"] / fold_in["total"] if fold_in["total"] else 0.0
+    return max(len(fold_in["folded_ids"]) / num_films, unseen_share)
+
+
+def retrain():
+    train_all(force=True)
+
+
+def main():
+    data = load_catalogue(config.DATA_PATH)
+    sources = load_manifest()["sources"]
+    stored_ids = load_similarity_ids(config.SIMILARITY_SOURCES[0])
+
+    if not np.isin(stored_ids, data.id).all():
+        print("Films have been removed from the catalogue, retraining")
+        retrain()
+        return
+    new_films = data[~data.id.isin(stored_ids)]
+    ids = np.concatenate([stored_ids, new_films.id.values])
+    new_rows = np.arange(len(stored_ids), len(ids))
+    print(f"Folding in {len(new_films)} new films")
+
+    updates = {}
+    with log_stage("Vectorize films"):
+        text = get_content_text(data.set_index("id").loc[ids].reset_index())
+        for name, column, _ in CONTENT_SOURCES:
+            vectorizer, features, feature_ids = load_text_features(name)
+            if not np.array_equal(feature_ids, stored_ids):
+                raise ValueError(f"{name} features are out of step with the other sources, retrain")
+            folded_features = normalize(vectorizer.transform(text[column]).astype("float32"))
+            # The vocabulary and its weights are fixed, so only films whose text was edited get a new vector.
+            difference = abs(folded_features[: len(stored_ids)] - features).sum(axis=1)
+            changed = np.flatnonzero(np.asarray(difference).ravel() > 1e-5)
+            folded_text = text[column].values[np.concatenate([changed, new_rows])]
+            tokens, unknown_tokens = get_out_of_vocabulary_counts(vectorizer, folded_text)
+            fold_in = sources[name].get("fold_in", {"total": 0, "unseen": 0})
+            fold_in = {
+                "folded_ids": get_folded_ids(fold_in, ids, np.concatenate([changed, new_rows])),
+                "total": fold_in["total"] + tokens,
+                "unseen": fold_in["unseen"] + unknown_tokens,
+            }
+            updates[name] = (vectorizer, folded_features, changed, fold_in)
+            print(f"{len(changed)} trained films have edited {column}")
+
+    with log_stage("Project ratings"):
+        embeddings, components, user_ids, embedding_ids = load_svd_features()
+        if not np.array_equal(embedding_ids, stored_ids):
+            raise ValueError(
+                "Collaborative embeddings are out of step with the other sources, retrain"
+            )
+        ratings, rating_user_ids = load_ratings_matrix(
+            config.RATINGS_PATH, film_ids=ids, min_ratings_per_user=1
+        )
+        # Only users the SVD was fitted on have a column in the components.
+        user_positions = np.minimum(np.searchsorted(user_ids, rating_user_ids), len(user_ids) - 1)
+        is_known_user = user_ids[user_positions] == rating_user_ids
+        known_ratings = ratings[is_known_user]
+        to_trained_users = csr_matrix(
+            (
+                np.ones(is_known_user.sum(), dtype="float32"),
+                (user_positions[is_known_user], np.arange(is_known_user.sum())),
+            ),
+            shape=(len(user_ids), is_known_user.sum()),
+        )
+        film_user_matrix = (to_trained_users @ known_ratings).T.tocsr()
+        folded_embeddings = np.asarray(film_user_matrix @ components.T)
+        changed = np.flatnonzero(
+            ~np.isclose(folded_embeddings[: len(stored_ids)], embeddings, rtol=1e-3, atol=1e-5).all(
+                axis=1
+            )
+        )
+        fold_in = sources["collaborative"].get("fold_in", {})
+        fold_in = {
+            "folded_ids": get_folded_ids(fold_in, ids, np.concatenate([changed, new_rows])),
+            "total": int(ratings.nnz),
+            "unseen": int(ratings.nnz - known_ratings.nnz),
+        }
+        updates["collaborative"] = (None, folded_embeddings, changed, fold_in)
+    print(f"{len(changed)} trained films have new ratings")
+
+    drift = {name: get_drift(update[-1], len(ids)) for name, update in updates.items()}
+    print("Drift: " + ", ".join(f"{name} {value:.3f}" for name, value in drift.items()))
+    if max(drift.values()) > config.FOLD_IN_DRIFT_THRESHOLD:
+        print(f"Drift is above {config.FOLD_IN_DRIFT_THRESHOLD}, retraining")
+        retrain()
+        return
+
+    with log_stage("Update similarity"):
+        for name, (vectorizer, features, changed, fold_in) in updates.items():
+            rows = np.concatenate([changed, new_rows]).astype(int)
+            if not len(rows):
+                continue
+            if name == "collaborative":
+                save_svd_features(features, components=components, user_ids=user_ids, ids=ids)
+            else:
+                save_text_features(name, vectorizer=vectorizer, features=features, ids=ids)
+            if name in config.ANN_SOURCES:
+                index = load_ivf_index(name)
+                index.add(features[rows], ids=ids[rows])
+                save_ivf_index(name, index)
+            update_similarity(name, features=features, ids=ids, changed=changed)
+            record_fold_in(name, fold_in)
+    publish_generation()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,114 +1,361 @@
 import sys
 import os
+from typing import Dict, List, Optional, Tuple, Union
 
 import pandas as pd
 import numpy as np
-import tmdbsimple as tmdb
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
-import streamlit as st
-from sklearn.metrics.pairwise import cosine_similarity
-
-import pandas as pd
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 import config
+from catalogue_store import load_catalogue
+from profiling import profiled
+from similarity_store import (
+    PackedSimilarityMatrix,
+    get_similarity_entry,
+    load_neighbour_graph,
+    load_packed_similarity_matrix,
+    load_similarity_matrix,
+)
+
+FILTER_COLUMNS = ["cast", "director", "genres"]
+
+
+def get_film_values(data: pd.DataFrame, column: str) -> List[list]:
+    """Values of a cast, director or genres column as a list per film, skipping missing values."""
+    if column == "director":
+        return [[x] if isinstance(x, str) else [] for x in data[column]]
+    return list(data[column])
+
+
+@profiled
+def build_filter_index(data: pd.DataFrame, sort_column: str = "imdb_score") -> Dict:
+    """Builds an inverted index from each cast member, director and genre to the films that have it.
 
+    Films are numbered by their rank when sorted by sort_column, so a posting list is a sorted array of ranks and
+    filtered films come out already ordered.
 
-tmdb.API_KEY = config.TMDB_API_KEY
+    Args:
+        data (pd.DataFrame): Films dataframe.
+        sort_column (str): Column to order filtered films by, descending.
 
+    Returns:
+        Dict: "order" holding the row position of each rank, "postings" mapping each column and value to its
+            sorted ranks, and "has_value" holding a mask over ranks of films with any value for each column.
+    """
+    order = np.argsort(-data[sort_column].values, kind="stable")
+    ranks = np.empty(len(order), dtype="int32")
+    ranks[order] = np.arange(len(order), dtype="int32")
+    filter_index = {"order": order, "postings": {}, "has_value": {}}
+    for column in FILTER_COLUMNS:
+        film_values = get_film_values(data, column)
+        lengths = np.array([len(values) for values in film_values])
+        value_ranks = np.repeat(ranks, lengths)
+        codes, unique_values = pd.factorize(
+            pd.Series([value for values in film_values for value in values], dtype="object"),
+            sort=True,
+        )
+        sort_order = np.lexsort((value_ranks, codes))
+        value_ranks = value_ranks[sort_order]
+        bounds = np.searchsorted(codes[sort_order], np.arange(len(unique_values) + 1))
+        filter_index["postings"][column] = {
+            value: value_ranks[bounds[i] : bounds[i + 1]] for i, value in enumerate(unique_values)
+        }
+        has_value = np.zeros(len(order), dtype=bool)
+        has_value[value_ranks] = True
+        filter_index["has_value"][column] = has_value
+    return filter_index
 
-def get_unique_list_values(series):
-    return set(i for x in series.to_list() for i in eval(x))
 
+@profiled
+def get_filter_values(filter_index: Dict) -> Tuple[List[str], ...]:
+    """Lists the cast, director and genre values that can be filtered on.
 
-def get_filter_values(data):
-    cast = sorted(list(get_unique_list_values(data.cast)))
-    director = sorted(list(data.director.apply(str).unique()))
-    genres = sorted(list(get_unique_list_values(data.genres)))
-    return cast, director, genres
+    Args:
+        filter_index (Dict): Index from build_filter_index.
 
+    Returns:
+        Tuple[List[str], ...]: Sorted cast, director and genre values.
+    """
+    return tuple(list(filter_index["postings"][column]) for column in FILTER_COLUMNS)
 
-def apply_filters(data, cast, director, genres, sort_column="imdb_score"):
-    cast_mask = data["cast"].apply(lambda x: bool(set(eval(x)).intersection(set(cast))))
-    director_mask = data["director"].isin(director)
-    genre_mask = data["genres"].apply(lambda x: bool(set(eval(x)).intersection(set(genres))))
-    filtered_films = data[cast_mask & director_mask & genre_mask]
-    filtered_films = filtered_films.sort_values(by=sort_column, ascending=False)
-    return filtered_films
 
+@profiled
+def apply_filters(
+    data: pd.DataFrame, filter_index: Dict, cast: list, director: list, genres: list
+) -> pd.DataFrame:
+    """Finds films matching any of the selected values of every column, in the order the index was built with.
 
-def replace_spaces_with_underscores(x):
-    if isinstance(x, list):
-        return [str(text).lower().replace(" ", "_") for text in x]
-    elif isinstance(x, str):
-        return x.lower().replace(" ", "_")
-    else:
-        return ""
+    An empty selection for a column matches every film with a value for it.
 
+    Args:
+        data (pd.DataFrame): Films dataframe the index was built from.
+        filter_index (Dict): Index from build_filter_index.
+        cast (list): Selected cast members.
+        director (list): Selected directors.
+        genres (list): Selected genres.
 
-@st.cache
+    Returns:
+        pd.DataFrame: Matching films, sorted.
+    """
+    mask = np.ones(len(data), dtype=bool)
+    for column, selected in zip(FILTER_COLUMNS, [cast, director, genres]):
+        if not selected:
+            mask &= filter_index["has_value"][column]
+            continue
+        postings = filter_index["postings"][column]
+        column_mask = np.zeros(len(data), dtype=bool)
+        for value in selected:
+            column_mask[postings.get(value, [])] = True
+        mask &= column_mask
+    return data.iloc[filter_index["order"][mask]]
+
+
+@profiled
 def load_data(path):
-    data = pd.read_csv(path)
+    data = load_catalogue(path)
     return data
 
 
-@st.cache
-def load_similarity_matrices():
-    cast_similarity = pd.read_csv(config.BASE_SIMILARITY_PATH + "cast_similarity.csv").set_index(
-        "id"
-    )
-    director_similarity = pd.read_csv(
-        config.BASE_SIMILARITY_PATH + "director_similarity.csv"
-    ).set_index("id")
-    overview_similarity = pd.read_csv(
-        config.BASE_SIMILARITY_PATH + "overview_similarity.csv"
-    ).set_index("id")
-    keywords_similarity = pd.read_csv(
-        config.BASE_SIMILARITY_PATH + "keywords_similarity.csv"
-    ).set_index("id")
-    user_embedding_similarity = pd.read_csv(
-        config.BASE_SIMILARITY_PATH + "collaborative_similarity.csv"
-    )
-    user_embedding_similarity.index = user_embedding_similarity.columns
-    return (
-        cast_similarity,
-        director_similarity,
-        keywords_similarity,
-        overview_similarity,
-        user_embedding_similarity,
-    )
-
-
-def get_vectorized_text_array(dataframe: pd.DataFrame, column: str, tfidf_vectorizer: bool = False):
-    if tfidf_vectorizer:
-        vectorizer = TfidfVectorizer(stop_words="english")
-    else:
-        vectorizer = CountVectorizer(stop_words="english")
-    X = vectorizer.fit_transform(dataframe[column])
-    return X.toarray().astype("float32")
-
-
-def get_similarity_matrix(array, index):
-    X = pd.DataFrame(cosine_similarity(array, array), index=index, columns=index)
-    return X
+@profiled
+def load_similarity_matrices(path: str = config.BASE_SIMILARITY_PATH):
+    """Memory-maps each similarity source and checks they all share the same film id order.
+
+    Args:
+        path (str): Directory containing the similarity artifacts.
+
+    Returns:
+        Tuple[Union[pd.DataFrame, PackedSimilarityMatrix], ...]: Cast, director, keywords, overview and
+            collaborative similarity matrices, indexed by film id on both axes. The underlying arrays are read-only
+            memory maps. Sources stored in a packed format are returned as PackedSimilarityMatrix, read with
+            get_similarity_rows.
+    """
+    similarity_matrices = []
+    reference_ids = None
+    for name in config.SIMILARITY_SOURCES:
+        if get_similarity_entry(name, path).get("format", "dense") == "packed":
+            matrix, ids = load_packed_similarity_matrix(name, path)
+        else:
+            matrix, ids = load_similarity_matrix(name, path)
+        if reference_ids is None:
+            reference_ids = ids
+        elif not np.array_equal(ids, reference_ids):
+            raise ValueError(
+                f"{name} similarity film order does not match {config.SIMILARITY_SOURCES[0]}, "
+                "rerun the training scripts against the same film features"
+            )
+        if isinstance(matrix, PackedSimilarityMatrix):
+            similarity_matrices.append(matrix)
+            continue
+        index = pd.Index(ids, name="id")
+        similarity_matrices.append(pd.DataFrame(matrix, index=index, columns=index, copy=False))
+    return tuple(similarity_matrices)
+
+
+@profiled
+def load_neighbour_graphs(path: str = config.BASE_SIMILARITY_PATH):
+    """Memory-maps the top-k neighbour graph of each similarity source.
 
+    Args:
+        path (str): Directory containing the similarity artifacts.
 
+    Returns:
+        Tuple[list, pd.Index]: Cast, director, keywords, overview and collaborative neighbour graphs, and the film
+            ids labelling their rows and columns.
+    """
+    neighbour_graphs = []
+    reference_ids = None
+    for name in config.SIMILARITY_SOURCES:
+        graph, ids = load_neighbour_graph(name, path)
+        if reference_ids is None:
+            reference_ids = ids
+        elif not np.array_equal(ids, reference_ids):
+            raise ValueError(
+                f"{name} neighbour film order does not match {config.SIMILARITY_SOURCES[0]}, "
+                "rerun the training scripts against the same film features"
+            )
+        neighbour_graphs.append(graph)
+    return neighbour_graphs, pd.Index(reference_ids, name="id")
+
+
+def get_similarity_rows(
+    similarity: Union[pd.DataFrame, PackedSimilarityMatrix], positions: np.ndarray
+) -> np.ndarray:
+    """Rows of a similarity matrix at positions as float32, without reading the rest of the matrix."""
+    if isinstance(similarity, PackedSimilarityMatrix):
+        return similarity.get_rows(positions)
+    return np.asarray(similarity.values[positions], dtype="float32")
+
+
+@profiled
 def generate_weighted_similarity_matrix(arrays: list, weights: list):
     df = arrays[0]
     indices = df.index.values
-    arrays = [np.array(array, dtype="float32") for array in arrays]
-    weighted_similarity_matrix = np.average(np.array(arrays), axis=0, weights=weights)
+    arrays = [
+        array if array.index.equals(df.index) else array.reindex(index=indices, columns=indices)
+        for array in arrays
+    ]
+    # Accumulate in row blocks so no source is copied whole.
+    weighted_similarity_matrix = np.zeros((len(indices), len(indices)), dtype="float32")
+    for start in range(0, len(indices), config.SIMILARITY_BLOCK_SIZE):
+        end = min(start + config.SIMILARITY_BLOCK_SIZE, len(indices))
+        for array, weight in zip(arrays, weights):
+            weighted_similarity_matrix[start:end] += np.float32(weight) * get_similarity_rows(
+                array, np.arange(start, end)
+            )
+    weighted_similarity_matrix /= np.float32(sum(weights))
     return pd.DataFrame(weighted_similarity_matrix, index=indices, columns=indices)
 
 
+@profiled
 def get_recommendations(
     films: pd.DataFrame, titles: list, similarity_matrix: pd.DataFrame, top_n: int
 ):
+    closest_films = get_recommended_ids(films, titles, similarity_matrix, top_n)
+    id_title_map = dict(zip(films.id, films.title))
+    closest_films = [id_title_map[idx] for idx in closest_films]
+    return closest_films
+
+
+def get_recommended_ids(
+    films: pd.DataFrame, titles: list, similarity_matrix: pd.DataFrame, top_n: int
+) -> list:
+    """Ids of the films get_recommendations recommends from a full weighted similarity matrix, most similar first."""
     film_indices = films.loc[films.title.isin(titles), "id"].values
     closest_films = similarity_matrix[film_indices].mean(axis=1)
     closest_films = closest_films.drop(labels=film_indices)
     closest_films = closest_films.sort_values(ascending=False)
     closest_films = closest_films[:top_n]
-    id_title_map = dict(zip(films.id, films.title))
-    closest_films = [id_title_map[idx] for idx in closest_films.index.values]
-    return closest_films
+    return closest_films.index.tolist()
+
+
+def get_films_by_id(films: pd.DataFrame, film_ids: list) -> pd.DataFrame:
+    """Rows of films in the order of film_ids, e.g. to show recommendations."""
+    positions = pd.Index(films["id"]).get_indexer(film_ids)
+    if (positions < 0).any():
+        raise KeyError(f"Films {np.asarray(film_ids)[positions < 0]} are not in the catalogue")
+    return films.iloc[positions]
+
+
+def get_liked_ids(
+    films: pd.DataFrame, titles: Optional[list], film_ids: Optional[list] = None
+) -> np.ndarray:
+    """Ids of the films the user likes, given by id or else by title.
+
+    A title shared by remakes matches every film with that title, so callers that know the ids should pass them.
+    """
+    if film_ids is not None:
+        return np.asarray(film_ids, dtype="int64")
+    return films.loc[films.title.isin(titles), "id"].values
+
+
+def get_top_n_indices(scores: np.ndarray, top_n: int) -> np.ndarray:
+    """Finds the positions of the highest scores without sorting the full array.
+
+    Args:
+        scores (np.ndarray): 1D array of scores.
+        top_n (int): Number of positions to return.
+
+    Returns:
+        np.ndarray: Positions of the top_n highest scores, highest first.
+    """
+    top_n = min(top_n, len(scores))
+    if top_n <= 0:
+        return np.array([], dtype="int64")
+    candidates = np.argpartition(-scores, top_n - 1)[:top_n]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+@profiled
+def get_weighted_recommendations(
+    films: pd.DataFrame,
+    titles: list,
+    similarity_matrices: list,
+    weights: list,
+    top_n: int,
+    film_ids: Optional[list] = None,
+):
+    """Recommends films by blending only the liked films' rows of each similarity matrix.
+
+    Gives the same recommendations as get_recommended_ids on the output of generate_weighted_similarity_matrix, as
+    the similarity matrices are symmetric, but costs O(k * N) for k liked films instead of building the N x N
+    weighted matrix.
+
+    Args:
+        films (pd.DataFrame): Films dataframe.
+        titles (list): Titles of the films the user likes.
+        similarity_matrices (list): Similarity matrices indexed by film id on both axes.
+        weights (list): Weighting of each similarity matrix.
+        top_n (int): Number of recommendations to return.
+        film_ids (Optional[list]): Ids of the films the user likes, used instead of titles, see get_liked_ids.
+
+    Returns:
+        list: Ids of the recommended films, most similar first.
+    """
+    film_indices = get_liked_ids(films, titles, film_ids)
+    ids = similarity_matrices[0].index
+    rows = []
+    for similarity in similarity_matrices:
+        positions = similarity.index.get_indexer(film_indices)
+        if (positions < 0).any():
+            raise KeyError(
+                f"Films {film_indices[positions < 0]} are missing from a similarity matrix"
+            )
+        source_rows = get_similarity_rows(similarity, positions)
+        if not similarity.columns.equals(ids):
+            source_rows = source_rows[:, similarity.columns.get_indexer(ids)]
+        rows.append(source_rows)
+    closest_films = np.average(np.array(rows), axis=0, weights=weights).mean(axis=0)
+    return rank_recommendations(ids, closest_films, film_indices, top_n)
+
+
+@profiled
+def get_neighbour_recommendations(
+    films: pd.DataFrame,
+    titles: list,
+    neighbour_graphs: list,
+    ids: pd.Index,
+    weights: list,
+    top_n: int,
+    film_ids: Optional[list] = None,
+):
+    """Recommends films by blending the liked films' top-k neighbour lists from each similarity source.
+
+    Films outside a liked film's stored neighbours count as having 0 similarity to it, so this approximates
+    get_weighted_recommendations while only touching k * K scores per source.
+
+    Args:
+        films (pd.DataFrame): Films dataframe.
+        titles (list): Titles of the films the user likes.
+        neighbour_graphs (list): Sparse neighbour graphs, one per similarity source.
+        ids (pd.Index): Film ids labelling the rows and columns of every graph.
+        weights (list): Weighting of each similarity source.
+        top_n (int): Number of recommendations to return.
+        film_ids (Optional[list]): Ids of the films the user likes, used instead of titles, see get_liked_ids.
+
+    Returns:
+        list: Ids of the recommended films, most similar first.
+    """
+    film_indices = get_liked_ids(films, titles, film_ids)
+    positions = ids.get_indexer(film_indices)
+    if (positions < 0).any():
+        raise KeyError(f"Films {film_indices[positions < 0]} are missing from the neighbour graphs")
+    rows = [np.asarray(graph[positions].mean(axis=0)).ravel() for graph in neighbour_graphs]
+    closest_films = np.average(np.array(rows), axis=0, weights=weights)
+    return rank_recommendations(ids, closest_films, film_indices, top_n)
+
+
+def rank_recommendations(ids: pd.Index, scores: np.ndarray, liked_ids: np.ndarray, top_n: int):
+    """Orders films by score, leaving out the films already liked.
+
+    Args:
+        ids (pd.Index): Film ids corresponding to each score.
+        scores (np.ndarray): Similarity of each film to the liked films.
+        liked_ids (np.ndarray): Ids of the films the user likes.
+        top_n (int): Number of recommendations to return.
+
+    Returns:
+        list: Ids of the recommended films, most similar first.
+    """
+    candidates = np.flatnonzero(~ids.isin(liked_ids))
+    top = candidates[get_top_n_indices(scores[candidates], top_n)]
+    return ids.values[top].tolist()